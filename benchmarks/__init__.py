@@ -0,0 +1,18 @@
+# coding: utf-8
+
+# Power Net Analyzer for KiCad - benchmarks
+#
+# The benchmarks run on synthetic boards built with the pcbnew stand-in in fakepcbnew/, so
+# they need neither KiCad nor a board file. Run them outside of KiCad (a live pcbnew module
+# would be used instead of the stand-in):
+#
+#     python -m benchmarks.run --output results.json
+#     python -m benchmarks.run --baseline results.json
+
+import os
+import sys
+
+FAKE_PCBNEW_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fakepcbnew')
+
+if FAKE_PCBNEW_DIR not in sys.path:
+    sys.path.insert(0, FAKE_PCBNEW_DIR)
@@ -0,0 +1,92 @@
+# coding: utf-8
+
+# Power Net Analyzer for KiCad - synthetic boards for the benchmarks
+#
+# A board is a power net spread over its copper layers: a pour with a few cutouts on every
+# layer, stitching vias between the layers, a through hole source pad, SMD load pads and
+# tracks scattered over the pour. Everything is placed from a seeded random generator, so the
+# same parameters always give the same board.
+
+import random
+
+import pcbnew
+
+NET = "+3V3"
+SOURCE_PAD = "J1-Pad1"
+
+MM = 1000000 # nanometers
+
+# named boards the benchmarks run on
+BOARDS = {
+    'small': dict(pour_size=10, pads=8, tracks=20, layers=2),
+    'medium': dict(pour_size=30, pads=32, tracks=100, layers=4),
+    'large': dict(pour_size=60, pads=64, tracks=300, layers=4),
+}
+
+
+def _rectangle(x0, y0, x1, y1):
+    return [(x0, y0), (x1, y0), (x1, y1), (x0, y1)]
+
+
+def synthetic_board(pour_size=30, pads=32, tracks=100, layers=4, vias=None, cutouts=4, seed=0):
+    # pour_size is the side of the square pours (units: millimeters). Without a via count
+    # there is one stitching via per 4 square millimeters of pour.
+    rng = random.Random(seed)
+    size = int(pour_size * MM)
+    board = pcbnew.BOARD(layers)
+    net = board.net(NET)
+    copper_layers = board.GetEnabledLayers().CuStack()
+
+    def position(margin=MM):
+        return (rng.randint(margin, size - margin), rng.randint(margin, size - margin))
+
+    # pours with chamfered corners and rectangular cutouts, shifted a little on every layer
+    chamfer = size // 10
+    for k, layer in enumerate(copper_layers):
+        shift = k * MM // 4
+        outline = [(chamfer, shift), (size - chamfer, shift), (size, chamfer), (size, size - chamfer),
+                   (size - chamfer, size), (chamfer, size), (shift, size - chamfer), (shift, chamfer)]
+        holes = []
+        for n in range(cutouts):
+            # at least 1 x 0.5 mm, even on pours too small for the usual cutout sizes
+            x, y = position(size // 5)
+            holes.append(_rectangle(x, y, x + rng.randint(MM, max(MM, size // 8)),
+                                    y + rng.randint(MM // 2, max(MM // 2, size // 20))))
+        board.Add(pcbnew.ZONE_CONTAINER(net, layer, pcbnew.SHAPE_POLY_SET([(outline, holes)])))
+
+    # through hole source pad on the left edge and SMD loads on the outer layers
+    board.Add(pcbnew.D_PAD(net, copper_layers, pcbnew.MODULE("J1"), "1", pcbnew.PAD_SHAPE_CIRCLE,
+                           (2 * MM, size // 2), (2 * MM, 2 * MM), attribute=pcbnew.PAD_ATTRIB_STANDARD,
+                           drill=MM))
+    for n in range(pads):
+        layer = copper_layers[-1] if n % 2 else copper_layers[0]
+        shape = rng.choice([pcbnew.PAD_SHAPE_RECT, pcbnew.PAD_SHAPE_ROUNDRECT, pcbnew.PAD_SHAPE_OVAL])
+        width = rng.randint(MM // 2, 2 * MM)
+        height = rng.randint(MM // 2, 2 * MM)
+        board.Add(pcbnew.D_PAD(net, [layer], pcbnew.MODULE("U{}".format(n + 1)), "1", shape, position(),
+                               (width, height), orientation=rng.choice([0, 900, 450]),
+                               corner_radius=min(width, height) // 4))
+
+    # tracks on the outer layers, a few of them wandering off the pour
+    for n in range(tracks):
+        layer = copper_layers[-1] if n % 2 else copper_layers[0]
+        start = position()
+        end = (start[0] + rng.randint(-size // 4, size // 4), start[1] + rng.randint(-size // 4, size // 4))
+        board.Add(pcbnew.TRACK(net, layer, start, end, rng.choice([MM // 4, MM // 2, MM])))
+
+    if len(copper_layers) > 1:
+        if vias is None:
+            vias = int(pour_size * pour_size / 4)
+        for n in range(vias):
+            board.Add(pcbnew.VIA(net, copper_layers, position(), 6 * MM // 10, 3 * MM // 10))
+
+    # a second net, so collecting the net has something to skip
+    other = board.net("GND")
+    for n in range(pads // 4):
+        board.Add(pcbnew.D_PAD(other, [copper_layers[0]], pcbnew.MODULE("C{}".format(n + 1)), "2",
+                               pcbnew.PAD_SHAPE_RECT, position(), (MM, MM)))
+    return board
+
+
+def named_board(name, seed=0):
+    return synthetic_board(seed=seed, **BOARDS[name])
@@ -0,0 +1,410 @@
+# coding: utf-8
+
+# Power Net Analyzer for KiCad - pcbnew stand-in for the benchmarks
+#
+# Just enough of KiCad 5's pcbnew API for the analysis to run on synthetic boards outside of
+# a KiCad session: boards with pads, tracks, vias and filled zones, and the getters and hit
+# tests the analysis calls on them. Geometry is in nanometers and angles in tenths of a
+# degree, like pcbnew. Boards are built in Python (see benchmarks/boards.py), there is no file
+# format behind them.
+
+import math
+
+# pad shapes, in the order of pcbnew's PAD_SHAPE_T
+(PAD_SHAPE_CIRCLE, PAD_SHAPE_RECT, PAD_SHAPE_OVAL, PAD_SHAPE_TRAPEZOID, PAD_SHAPE_ROUNDRECT,
+ PAD_SHAPE_CHAMFERED_RECT, PAD_SHAPE_CUSTOM) = range(7)
+
+# pad attributes
+PAD_ATTRIB_STANDARD, PAD_ATTRIB_SMD, PAD_ATTRIB_CONN, PAD_ATTRIB_HOLE_NOT_PLATED = range(4)
+
+# item types
+PCB_PAD_T = 5
+PCB_TRACE_T = 10
+PCB_VIA_T = 11
+PCB_ZONE_AREA_T = 25
+
+# copper layers
+F_Cu = 0
+B_Cu = 31
+
+
+def In_Cu(n):
+    # layer id of the nth inner layer, from 1
+    return n
+
+
+def _point_in_polygon(x, y, points):
+    # even-odd rule
+    inside = False
+    count = len(points)
+    for k in range(count):
+        x0, y0 = points[k]
+        x1, y1 = points[(k + 1) % count]
+        if (y0 > y) != (y1 > y) and x < x0 + (y - y0) * (x1 - x0) / float(y1 - y0):
+            inside = not inside
+    return inside
+
+
+def _segment_distance(px, py, x0, y0, x1, y1):
+    dx = float(x1 - x0)
+    dy = float(y1 - y0)
+    length_sq = dx * dx + dy * dy
+    if length_sq == 0:
+        return math.hypot(px - x0, py - y0)
+    t = min(max(((px - x0) * dx + (py - y0) * dy) / length_sq, 0.0), 1.0)
+    return math.hypot(px - (x0 + t * dx), py - (y0 + t * dy))
+
+
+class wxPoint(object):
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+
+wxSize = wxPoint
+
+
+class EDA_RECT(object):
+    def __init__(self, x, y, width, height):
+        self._x = int(x)
+        self._y = int(y)
+        self._width = int(width)
+        self._height = int(height)
+
+    @classmethod
+    def around(cls, x0, y0, x1, y1):
+        return cls(x0, y0, x1 - x0, y1 - y0)
+
+    def GetX(self):
+        return self._x
+
+    def GetY(self):
+        return self._y
+
+    def GetWidth(self):
+        return self._width
+
+    def GetHeight(self):
+        return self._height
+
+
+class SHAPE_LINE_CHAIN(object):
+    def __init__(self, points):
+        self.points = [(int(x), int(y)) for x, y in points]
+
+    def PointCount(self):
+        return len(self.points)
+
+    def CPoint(self, k):
+        return wxPoint(*self.points[k])
+
+
+class SHAPE_POLY_SET(object):
+    # polygons as (outline, [hole, ...]) pairs of point lists
+    def __init__(self, polygons=()):
+        self.polygons = [(list(outline), [list(hole) for hole in holes]) for outline, holes in polygons]
+
+    def OutlineCount(self):
+        return len(self.polygons)
+
+    def Outline(self, n):
+        return SHAPE_LINE_CHAIN(self.polygons[n][0])
+
+    def HoleCount(self, n):
+        return len(self.polygons[n][1])
+
+    def Hole(self, n, h):
+        return SHAPE_LINE_CHAIN(self.polygons[n][1][h])
+
+    def BBox(self):
+        points = [point for outline, holes in self.polygons for point in outline]
+        if len(points) == 0:
+            return EDA_RECT(0, 0, 0, 0)
+        xs = [x for x, y in points]
+        ys = [y for x, y in points]
+        return EDA_RECT.around(min(xs), min(ys), max(xs), max(ys))
+
+    def Contains(self, x, y):
+        for outline, holes in self.polygons:
+            if _point_in_polygon(x, y, outline) and not any(_point_in_polygon(x, y, hole) for hole in holes):
+                return True
+        return False
+
+
+class NETINFO_ITEM(object):
+    def __init__(self, name, code):
+        self._name = name
+        self._code = code
+
+    def GetNetname(self):
+        return self._name
+
+    def GetNet(self):
+        return self._code
+
+
+class MODULE(object):
+    def __init__(self, reference):
+        self._reference = reference
+
+    def GetReference(self):
+        return self._reference
+
+
+class BOARD_CONNECTED_ITEM(object):
+    def __init__(self, net, layers):
+        self._net = net
+        self._layers = frozenset(layers)
+
+    def GetNet(self):
+        return self._net
+
+    def GetNetCode(self):
+        return self._net.GetNet()
+
+    def IsOnLayer(self, layer):
+        return layer in self._layers
+
+
+class D_PAD(BOARD_CONNECTED_ITEM):
+    def __init__(self, net, layers, parent, name, shape, position, size, orientation=0,
+                 attribute=PAD_ATTRIB_SMD, drill=0, corner_radius=0):
+        BOARD_CONNECTED_ITEM.__init__(self, net, layers)
+        self._parent = parent
+        self._name = name
+        self._shape = shape
+        self._position = wxPoint(*position)
+        self._size = wxSize(*size)
+        self._orientation = orientation
+        self._attribute = attribute
+        self._drill = wxSize(drill, drill)
+        self._corner_radius = corner_radius
+
+    def Type(self):
+        return PCB_PAD_T
+
+    def GetParent(self):
+        return self._parent
+
+    def GetPadName(self):
+        return self._name
+
+    def GetShape(self):
+        return self._shape
+
+    def GetPosition(self):
+        return self._position
+
+    def GetOffset(self):
+        return wxPoint(0, 0)
+
+    def GetOrientation(self):
+        return self._orientation
+
+    def GetSize(self):
+        return self._size
+
+    def GetDelta(self):
+        return wxSize(0, 0)
+
+    def GetAttribute(self):
+        return self._attribute
+
+    def GetDrillSize(self):
+        return self._drill
+
+    def GetRoundRectCornerRadius(self):
+        return self._corner_radius
+
+    def TransformShapeWithClearanceToPolygon(self, poly_set, clearance, *args):
+        # every shape as its rotated rectangle, grown by the clearance
+        angle = math.radians(self._orientation / 10.0)
+        half_x = self._size.x / 2.0 + clearance
+        half_y = self._size.y / 2.0 + clearance
+        corners = []
+        for x, y in ((-half_x, -half_y), (half_x, -half_y), (half_x, half_y), (-half_x, half_y)):
+            corners.append((self._position.x + x * math.cos(angle) + y * math.sin(angle),
+                            self._position.y - x * math.sin(angle) + y * math.cos(angle)))
+        poly_set.polygons.append((corners, []))
+
+    def _local(self, x, y):
+        # point in the pad's frame
+        angle = math.radians(self._orientation / 10.0)
+        dx = x - self._position.x
+        dy = y - self._position.y
+        return dx * math.cos(angle) - dy * math.sin(angle), dy * math.cos(angle) + dx * math.sin(angle)
+
+    def GetBoundingBox(self):
+        angle = math.radians(self._orientation / 10.0)
+        half_x = (abs(self._size.x * math.cos(angle)) + abs(self._size.y * math.sin(angle))) / 2.0
+        half_y = (abs(self._size.x * math.sin(angle)) + abs(self._size.y * math.cos(angle))) / 2.0
+        return EDA_RECT.around(math.floor(self._position.x - half_x), math.floor(self._position.y - half_y),
+                               math.ceil(self._position.x + half_x), math.ceil(self._position.y + half_y))
+
+    def HitTest(self, point):
+        local_x, local_y = self._local(point.x, point.y)
+        half_x = self._size.x / 2.0
+        half_y = self._size.y / 2.0
+        if self._shape == PAD_SHAPE_CIRCLE:
+            return math.hypot(local_x, local_y) <= half_x
+        if self._shape == PAD_SHAPE_OVAL:
+            if half_x > half_y:
+                return _segment_distance(local_x, local_y, -(half_x - half_y), 0, half_x - half_y, 0) <= half_y
+            return _segment_distance(local_x, local_y, 0, -(half_y - half_x), 0, half_y - half_x) <= half_x
+        if self._shape == PAD_SHAPE_ROUNDRECT:
+            radius = self._corner_radius
+            outside_x = max(abs(local_x) - (half_x - radius), 0)
+            outside_y = max(abs(local_y) - (half_y - radius), 0)
+            return math.hypot(outside_x, outside_y) <= radius
+        return abs(local_x) <= half_x and abs(local_y) <= half_y
+
+
+class TRACK(BOARD_CONNECTED_ITEM):
+    def __init__(self, net, layer, start, end, width):
+        BOARD_CONNECTED_ITEM.__init__(self, net, [layer])
+        self._start = wxPoint(*start)
+        self._end = wxPoint(*end)
+        self._width = width
+
+    def Type(self):
+        return PCB_TRACE_T
+
+    def GetStart(self):
+        return self._start
+
+    def GetEnd(self):
+        return self._end
+
+    def GetPosition(self):
+        return self._start
+
+    def GetWidth(self):
+        return self._width
+
+    def GetBoundingBox(self):
+        radius = self._width // 2
+        return EDA_RECT.around(min(self._start.x, self._end.x) - radius, min(self._start.y, self._end.y) - radius,
+                               max(self._start.x, self._end.x) + radius, max(self._start.y, self._end.y) + radius)
+
+    def HitTest(self, point):
+        distance = _segment_distance(point.x, point.y, self._start.x, self._start.y, self._end.x, self._end.y)
+        return distance <= self._width / 2.0
+
+
+class VIA(TRACK):
+    # through via, on every copper layer of the board
+    def __init__(self, net, layers, position, width, drill):
+        TRACK.__init__(self, net, layers[0], position, position, width)
+        self._layers = frozenset(layers)
+        self._drill = drill
+
+    def Type(self):
+        return PCB_VIA_T
+
+    def GetDrillValue(self):
+        return self._drill
+
+
+def Cast_to_VIA(track):
+    return track
+
+
+class ZONE_CONTAINER(BOARD_CONNECTED_ITEM):
+    def __init__(self, net, layer, fill):
+        BOARD_CONNECTED_ITEM.__init__(self, net, [layer])
+        self._fill = fill
+
+    def Type(self):
+        return PCB_ZONE_AREA_T
+
+    def GetLayer(self):
+        return min(self._layers)
+
+    def GetFilledPolysList(self):
+        return self._fill
+
+    def GetBoundingBox(self):
+        return self._fill.BBox()
+
+    def HitTestFilledArea(self, point):
+        return self._fill.Contains(point.x, point.y)
+
+
+class LSET(object):
+    def __init__(self, layers):
+        self._layers = list(layers)
+
+    def CuStack(self):
+        return list(self._layers)
+
+
+class BOARD_DESIGN_SETTINGS(object):
+    def __init__(self, board_thickness):
+        self._board_thickness = board_thickness
+
+    def GetBoardThickness(self):
+        return self._board_thickness
+
+
+class BOARD(object):
+    def __init__(self, copper_layers=2, board_thickness=1600000):
+        self.copper_layers = [F_Cu] + [In_Cu(n) for n in range(1, copper_layers - 1)] + [B_Cu][:copper_layers - 1]
+        self._design_settings = BOARD_DESIGN_SETTINGS(board_thickness)
+        self._nets = {"": NETINFO_ITEM("", 0)}
+        self._pads = []
+        self._tracks = []
+        self._zones = []
+
+    def net(self, name):
+        # the net of the given name, added to the board if it's new
+        if name not in self._nets:
+            self._nets[name] = NETINFO_ITEM(name, len(self._nets))
+        return self._nets[name]
+
+    def Add(self, item):
+        if isinstance(item, D_PAD):
+            self._pads.append(item)
+        elif isinstance(item, ZONE_CONTAINER):
+            self._zones.append(item)
+        else:
+            self._tracks.append(item)
+
+    def FindNet(self, name):
+        return self._nets.get(name)
+
+    def GetNetsByName(self):
+        return dict(self._nets)
+
+    def GetPads(self):
+        return list(self._pads)
+
+    def GetPadCount(self):
+        return len(self._pads)
+
+    def GetTracks(self):
+        return list(self._tracks)
+
+    def GetNumSegmTrack(self):
+        return len(self._tracks)
+
+    def TracksInNet(self, code):
+        return [track for track in self._tracks if track.GetNetCode() == code]
+
+    def GetAreaCount(self):
+        return len(self._zones)
+
+    def GetArea(self, i):
+        return self._zones[i]
+
+    def GetEnabledLayers(self):
+        return LSET(self.copper_layers)
+
+    def GetLayerName(self, layer):
+        if layer == F_Cu:
+            return "F.Cu"
+        if layer == B_Cu:
+            return "B.Cu"
+        return "In{}.Cu".format(layer)
+
+    def GetDesignSettings(self):
+        return self._design_settings
@@ -0,0 +1,235 @@
+# coding: utf-8
+
+# Power Net Analyzer for KiCad - benchmark runner
+#
+# Times every stage of the analysis on synthetic boards at several grid spacings:
+#
+#     snapshot          the net's copper taken out of the board into arrays
+#     rasterize         node maps of every layer, pads and zones only
+#     rasterize-tracks  node maps of every layer with the tracks rasterized too
+#     network           node index and edge arrays of the layers, lumped tracks and via barrels
+#     netlist           the network formatted as SPICE netlist text
+#     native            SciPy solve of the network
+#     multigrid         multigrid preconditioned CG solve of the network
+#     ngspice-load      netlist written to a file and sourced by ngspice
+#     ngspice-solve     ngspice operating point analysis and reading the voltages back
+#
+# The best time of a few runs is kept. Results are written as JSON; with --baseline the
+# run is compared against an earlier results file and the exit status is nonzero if a case
+# got slower than the tolerance allows.
+
+import argparse
+import datetime
+import json
+import platform
+import sys
+import time
+
+import numpy as np
+import scipy
+
+from benchmarks.boards import BOARDS, NET, SOURCE_PAD, MM, named_board
+from netanalysis.snapshot import BoardIndex
+from netanalysis.raster import AnalysisGrid, COPPER
+from netanalysis.layers import LayerStack, rasterize_layers, layer_network
+from netanalysis.solver import named_pads, solve_network
+from netanalysis.netlist import netlist_lines
+from netanalysis.progress import Progress
+from netanalysis.stats import current_rss
+
+# bump when the meaning of a case changes, so old results aren't compared with new ones
+RESULTS_VERSION = 2
+
+DEFAULT_BOARDS = ['small', 'medium']
+DEFAULT_SPACINGS = [0.8, 0.4, 0.2] # millimeters
+DEFAULT_REPEAT = 3
+DEFAULT_TOLERANCE = 0.25 # a case may take 25 % longer than its baseline
+
+# slowdowns shorter than this are timer noise, never regressions (units: seconds)
+NOISE_FLOOR = 0.002
+
+# current drawn by all load pads together (units: amperes)
+TOTAL_LOAD = 2.0
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+def _best(function, repeat):
+    # shortest time of repeat calls, and the value of the last one
+    times = []
+    for n in range(repeat):
+        started = _clock()
+        value = function()
+        times.append(_clock() - started)
+    return min(times), value
+
+
+def ngspice_available():
+    try:
+        from lyngspice.lyngspice import NgSpice
+        NgSpice()
+    except Exception:
+        return False
+    return True
+
+
+def load_currents(copper, node_maps=None):
+    # the total load shared by every pad but the source. With node maps, only by the pads on
+    # the grid: a coarse grid misses the smallest pads, and those can't be loads.
+    on_grid = set(range(copper.n_pads))
+    if node_maps is not None:
+        on_grid = set((np.unique(node_maps[node_maps > COPPER]) - 1).tolist())
+    loads = [pad for pad, name in enumerate(copper.pad_names) if name != SOURCE_PAD and pad in on_grid]
+    return [TOTAL_LOAD / len(loads) if pad in loads else 0.0 for pad in range(copper.n_pads)]
+
+
+def benchmark_net(board_name, spacing, repeat=DEFAULT_REPEAT, ngspice=False):
+    # results of every case on one board at one grid spacing (units: millimeters)
+    board = named_board(board_name)
+    board_index = BoardIndex(board)
+    board_index.refresh()
+    stack = LayerStack.from_board(board)
+    sheet_resistances = [0.0005] * len(stack.layers)
+
+    results = []
+
+    def add(case, seconds, **counters):
+        result = {'name': "{}/{}mm/{}".format(board_name, spacing, case), 'board': board_name,
+                  'grid_spacing': spacing, 'case': case, 'seconds': seconds, 'rss': current_rss()}
+        result.update(counters)
+        results.append(result)
+        sys.stderr.write("{:<32} {:9.4f} s\n".format(result['name'], seconds))
+
+    seconds, copper = _best(lambda: board_index.collect(NET), repeat)
+    add('snapshot', seconds, pads=copper.n_pads)
+    grid = AnalysisGrid.around(copper.index.bounds(), int(spacing * MM))
+    source_pad = copper.pad_names.index(SOURCE_PAD)
+
+    seconds, (present, node_maps) = _best(lambda: rasterize_layers(copper.index, grid, stack, tracks=False), repeat)
+    add('rasterize', seconds, cells=int(node_maps.size), layers=len(present))
+    currents = load_currents(copper, node_maps)
+
+    seconds, (track_layers, track_maps) = _best(lambda: rasterize_layers(copper.index, grid, stack), repeat)
+    add('rasterize-tracks', seconds, cells=int(track_maps.size), layers=len(track_layers))
+
+    seconds, network = _best(lambda: layer_network(copper.index, grid, stack, present, node_maps,
+                                                   sheet_resistances[:len(present)],
+                                                   named_pads(currents, source_pad), lumped_tracks=True), repeat)
+    node_index, pad_nodes, n_nodes, src, dst, conductance, positions = network
+    add('network', seconds, nodes=n_nodes, edges=len(src))
+
+    def netlist():
+        return sum(len(line) + 1 for line in netlist_lines(src, dst, conductance, pad_nodes, copper.pad_names,
+                                                           currents, source_pad, 3.3))
+
+    seconds, n_bytes = _best(netlist, repeat)
+    add('netlist', seconds, netlist_bytes=n_bytes)
+
+    seconds, voltages = _best(lambda: solve_network(n_nodes, src, dst, conductance, pad_nodes, currents,
+                                                    source_pad, 3.3), repeat)
+    add('native', seconds, nodes=n_nodes, edges=len(src), max_drop=3.3 - float(np.nanmin(voltages)))
+
+    progress = Progress()
+    seconds, voltages = _best(lambda: solve_network(n_nodes, src, dst, conductance, pad_nodes, currents,
+                                                    source_pad, 3.3, method='multigrid', progress=progress,
+                                                    node_positions=positions), repeat)
+    progress.finish()
+    counters = progress.stats.stages[-1].counters
+    add('multigrid', seconds, nodes=n_nodes, edges=len(src), max_drop=3.3 - float(np.nanmin(voltages)),
+        levels=counters['levels'], iterations=counters['iterations'])
+
+    if ngspice:
+        # the stage statistics of the solve split it into loading and solving
+        load, solve = [], []
+        for n in range(repeat):
+            progress = Progress()
+            solve_network(n_nodes, src, dst, conductance, pad_nodes, currents, source_pad, 3.3,
+                          progress=progress, backend='ngspice', pad_names=copper.pad_names)
+            progress.finish()
+            stages = dict((stage.name, stage.wall) for stage in progress.stats.stages)
+            load.append(stages["Writing netlist"])
+            solve.append(stages["Solving (ngspice)"] + stages["Reading voltages"])
+        add('ngspice-load', min(load), netlist_bytes=n_bytes)
+        add('ngspice-solve', min(solve), nodes=n_nodes, edges=len(src))
+
+    return results
+
+
+def run_benchmarks(boards=DEFAULT_BOARDS, spacings=DEFAULT_SPACINGS, repeat=DEFAULT_REPEAT, ngspice=None):
+    if ngspice is None:
+        ngspice = ngspice_available()
+    cases = []
+    for board_name in boards:
+        for spacing in spacings:
+            cases += benchmark_net(board_name, spacing, repeat, ngspice)
+    return {
+        'version': RESULTS_VERSION,
+        'created': datetime.datetime.now().isoformat(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'repeat': repeat,
+        'cases': cases,
+    }
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    # (name, baseline seconds, seconds, ratio, regressed) of every case in both runs
+    if baseline.get('version') != results['version']:
+        raise ValueError("Baseline is from another version of the benchmarks")
+    before = dict((case['name'], case['seconds']) for case in baseline['cases'])
+    rows = []
+    for case in results['cases']:
+        if case['name'] in before:
+            ratio = case['seconds'] / max(before[case['name']], 1e-9)
+            regressed = ratio > 1.0 + tolerance and case['seconds'] - before[case['name']] > NOISE_FLOOR
+            rows.append((case['name'], before[case['name']], case['seconds'], ratio, regressed))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the power net analysis on synthetic boards")
+    parser.add_argument('--boards', nargs='+', choices=sorted(BOARDS), default=DEFAULT_BOARDS,
+                        help="boards to run on (default: %(default)s)")
+    parser.add_argument('--spacing', nargs='+', type=float, default=DEFAULT_SPACINGS,
+                        help="grid spacings in millimeters (default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help="runs of every case, the best is kept (default: %(default)s)")
+    parser.add_argument('--no-ngspice', action='store_true', help="skip the ngspice cases")
+    parser.add_argument('-o', '--output', default=None, help="write the results to this JSON file")
+    parser.add_argument('--baseline', default=None, help="compare with the results in this JSON file")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="slowdown over the baseline that counts as a regression (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    ngspice = False if args.no_ngspice else ngspice_available()
+    if not ngspice and not args.no_ngspice:
+        sys.stderr.write("ngspice is not available, skipping the ngspice cases\n")
+
+    # the ngspice solve prints the netlist size, keep it off the report
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        results = run_benchmarks(args.boards, args.spacing, args.repeat, ngspice)
+    finally:
+        sys.stdout = stdout
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline is None:
+        return 0
+
+    with open(args.baseline) as f:
+        rows = compare(results, json.load(f), args.tolerance)
+    print("{:<32} {:>10} {:>10} {:>7}".format("case", "baseline", "now", "ratio"))
+    for name, before, seconds, ratio, regressed in rows:
+        print("{:<32} {:9.4f}s {:9.4f}s {:6.2f}x{}".format(name, before, seconds, ratio,
+                                                          "  SLOWER" if regressed else ""))
+    return 1 if any(row[4] for row in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -63,8 +63,11 @@ Results are returned as simple dictionaries. See the examples for extra tips.
 """
 
 import platform
+import os
 import os.path
 import sys
+import tempfile
+import itertools
 import numpy as np
 # Compatibility Python 2/3 for Queue library
 try:
@@ -90,6 +93,10 @@ _LIB_PATHS = {
 
 _encoding = 'iso8859_15'
 
+# Lines encoded and written at a time by write_netlist, and the size of the file buffer
+_WRITE_CHUNK = 4096
+_WRITE_BUFFER = 1 << 20
+
 _UNITS = [
         '',
         's',
@@ -186,6 +193,22 @@ class VecValuesAll(Structure):
                 ('vecsa', POINTER(POINTER(VecValues))) # values of actual set of vectors, indexed from 0 to veccount − 1
                 ] 
 
+def write_netlist(lines, f):
+  '''Write an iterable of netlist lines to a binary file object, a chunk of lines at a time, so
+  the netlist never needs to be in memory as a whole. Returns (bytes, lines) written.'''
+  n_bytes = 0
+  n_lines = 0
+  lines = iter(lines)
+  while True:
+    chunk = list(itertools.islice(lines, _WRITE_CHUNK))
+    if not chunk:
+      break
+    data = ('\n'.join(chunk) + '\n').encode(_encoding)
+    f.write(data)
+    n_bytes += len(data)
+    n_lines += len(chunk)
+  return n_bytes, n_lines
+
 class Dataset(dict):
   def __init__(self, *args, **kwargs):
     super(Dataset, self).__init__(*args, **kwargs)
@@ -230,7 +253,7 @@ class NgSpice(object):
   
   def command(self, command):
     self._msg_queue_flush()
-    self._shared.ngSpice_Command(c_char_p(command.encode(_encoding)))
+    return self._shared.ngSpice_Command(c_char_p(command.encode(_encoding)))
       
   def version(self):
     self.command('version -f')
@@ -273,13 +296,27 @@ class NgSpice(object):
       c_netlist[-1] = c_char_p(None)
       return self._shared.ngSpice_Circ(c_netlist)
 
+  # Load circuit from an iterable of lines (e.g. a generator) streamed through a temporary file,
+  # instead of an array of strings in memory. Returns (error, bytes, lines) written.
+  def source_lines(self, lines, directory=None):
+    handle, path = tempfile.mkstemp(suffix='.cir', dir=directory)
+    try:
+      with os.fdopen(handle, 'wb', _WRITE_BUFFER) as f:
+        n_bytes, n_lines = write_netlist(lines, f)
+      # ngspice takes forward slashes on every platform, and the quotes keep spaces in the path
+      error = self.command('source "%s"' % path.replace('\\', '/'))
+    finally:
+      os.remove(path)
+    return error, n_bytes, n_lines
+
   def add_external_source(self, name, fun):
     self._external_sources[name] = fun
     
   def set_thread_callback(self, fun):
     self._thread_callback = fun
   
-  # Reload ngspice shared library. Use periodically to minimize leaks
+  # Reload ngspice shared library. Use periodically to minimize leaks. Views returned by
+  # get_data() and get_vectors(copy=False) dangle afterwards
   def reset(self):
     self.__detach()
     self.__attach()
@@ -353,7 +390,55 @@ class NgSpice(object):
         i+= 1
     
     return data, units
-    
+
+  def get_vectors(self, plot, names=None, copy=False):
+    '''Fetch only the named vectors of a plot (all of them if names is None), as a dict of name to
+    NumPy array. Names ngspice doesn't know are left out.
+
+    With copy=False the arrays are read-only views of ngspice's own memory. They are only valid
+    until ngspice frees its plots: the next run, bg_run, load_netlist, source_lines, 'destroy',
+    reset() or the NgSpice object being deleted. Copy what you need before any of those.
+
+    With copy=True all vectors are copied into one contiguous preallocated block (one for real
+    and one for complex vectors) and the arrays are slices of it, owned by Python.'''
+    if names is None:
+      all_vectors = self._shared.ngSpice_AllVecs(c_char_p(plot.encode(_encoding)))
+      names = []
+      i = 0
+      while all_vectors[i]!=None:
+        names.append(all_vectors[i].decode(_encoding))
+        i+= 1
+
+    views = []
+    for name in names:
+      vec = self._shared.ngGet_Vec_Info(c_char_p(('%s.%s' % (plot, name)).encode(_encoding)))
+      if not vec:
+        continue
+      vec = vec.contents
+      if vec.v_length <= 0:
+        z = np.zeros(0)
+      elif self.is_complex(vec.v_flags):
+        x_jy = np.ctypeslib.as_array(cast(vec.v_compdata, POINTER(c_double)), (2*vec.v_length,))
+        z = x_jy.view(np.complex128)
+      else:
+        z = np.ctypeslib.as_array(vec.v_realdata, (vec.v_length,))
+      z.flags.writeable = False
+      views.append((name, z))
+
+    if not copy:
+      return dict(views)
+
+    vectors = {}
+    for dtype in (np.float64, np.complex128):
+      selected = [(name, z) for name, z in views if z.dtype == dtype]
+      block = np.empty(sum(len(z) for name, z in selected), dtype=dtype)
+      start = 0
+      for name, z in selected:
+        block[start:start + len(z)] = z
+        vectors[name] = block[start:start + len(z)]
+        start += len(z)
+    return vectors
+
   def __attach(self):
     self._shared = self.__lib_loader(self.lib_path)
     
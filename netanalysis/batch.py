@@ -0,0 +1,240 @@
+# coding: utf-8
+
+# Power Net Analyzer for KiCad - headless batch analysis
+#
+# Analyzes the power nets of many boards without the pcbnew GUI, e.g. from CI:
+#
+#     python -m netanalysis.batch nets.json --jobs 8 --output results.json
+#
+# Unlike the plugin it needs Python 3 (concurrent.futures). The config file lists the boards
+# and the nets to analyze on each. Board paths are relative to the config file. Settings (see
+# AnalysisSettings) are merged file, then board, then net.
+#
+#     {
+#         "settings": {"grid_spacing": 100000, "sheet_resistance": 0.0005},
+#         "boards": [
+#             {"file": "power.kicad_pcb",
+#              "nets": [
+#                  {"net": "+3V3", "source": "U1-Pad2", "loads": {"U3-Pad7": "250m", "U4-Pad1": 1.2},
+#                   "max_drop": 0.05, "settings": {"source_voltage": 3.3}}
+#              ]}
+#         ]
+#     }
+#
+# A net with "scenarios" (a list of "loads" objects) instead of "loads" is a current sweep:
+# its conductance matrix is factored once and every scenario is a cheap extra solve.
+#
+# A net with "port_model" also writes the net's port resistance matrix (see netanalysis.ports)
+# to that file, relative to the config file: .json, .csv, or a SPICE subcircuit otherwise. The
+# ports are the pads of its loads, or of all its scenarios.
+#
+# Every (board, net) pair is a job for a pool of worker processes, so jobs scale with the
+# cores. The result of every job is written as a JSON object, with the time, CPU time,
+# memory and counters of every stage under "stats"; the exit status is nonzero if a job failed
+# or a net dropped more than its max_drop. With --stats-log every stage also appends a JSON
+# line to a log as it ends, for following long runs and comparing runs.
+#
+# Nets with the ngspice backend are simulated by ngspice processes every worker starts on its
+# first such net and keeps for the rest of the run (see netanalysis.spicepool), --spice-workers
+# per worker, so ngspice is loaded once instead of once per net.
+
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+import traceback
+
+from netanalysis.core import AnalysisSettings, NetSweep, analyze_net
+from netanalysis.ports import build_port_model
+from netanalysis.snapshot import BoardIndex, load_board
+from netanalysis.layers import LayerStack
+from netanalysis.solver import spice_number, set_spice_pool, AnalysisError
+from netanalysis.spicepool import SpicePool, SpiceError
+from netanalysis.cache import RasterCache, DEFAULT_CACHE_DIR
+from netanalysis.progress import Progress
+from netanalysis.stats import AnalysisStats
+
+# BoardIndex of every board loaded by this worker process, loading a board takes longer than
+# most analyses
+_boards = {}
+
+# node map cache shared by the workers, None to always rasterize
+_cache = None
+
+# file the workers append stage statistics to, None for no log
+_stats_log = None
+
+# ngspice processes of every worker, started on its first ngspice net. With no processes
+# ngspice runs in the worker itself.
+_spice_workers = 0
+_spice_pool = None
+
+
+def load_jobs(config_file):
+    # one (board file, net config, settings) job per net of every board
+    with open(config_file) as f:
+        config = json.load(f)
+
+    root = os.path.dirname(os.path.abspath(config_file))
+    jobs = []
+    for board in config.get('boards', []):
+        filename = os.path.join(root, board['file'])
+        for net in board.get('nets', []):
+            settings = dict(config.get('settings', {}))
+            settings.update(board.get('settings', {}))
+            settings.update(net.get('settings', {}))
+            if 'port_model' in net:
+                net = dict(net, port_model=os.path.join(root, net['port_model']))
+            jobs.append((filename, net, settings))
+    return jobs
+
+
+def _load_board(filename):
+    if filename not in _boards:
+        _boards[filename] = BoardIndex(load_board(filename))
+    return _boards[filename]
+
+
+def _pad_index(copper, name):
+    if name not in copper.pad_names:
+        raise AnalysisError("Net {} has no pad {}".format(copper.netname, name))
+    return copper.pad_names.index(name)
+
+
+def pad_currents(copper, loads):
+    # current of every pad of the net from a {pad name: current} config
+    currents = [0.0] * copper.n_pads
+    for name, current in loads.items():
+        currents[_pad_index(copper, name)] = spice_number(str(current))
+    return currents
+
+
+def load_pads(copper, net):
+    # pads drawing current in the net's loads or in any of its scenarios
+    current_sets = [pad_currents(copper, loads) for loads in net.get('scenarios', [net.get('loads', {})])]
+    return set(pad for currents in current_sets for pad, current in enumerate(currents) if current != 0)
+
+
+def analyze_job(board, copper, net, settings, progress=None):
+    # results of the net's single analysis, or of every scenario of a sweep
+    stack = LayerStack.from_board(board)
+    source_pad = _pad_index(copper, net['source'])
+    if 'scenarios' not in net:
+        return [analyze_net(copper, stack, settings, pad_currents(copper, net.get('loads', {})), source_pad,
+                            progress, _cache)]
+
+    current_sets = [pad_currents(copper, loads) for loads in net['scenarios']]
+    sweep = NetSweep(copper, stack, settings, source_pad, load_pads(copper, net), progress, _cache)
+    return sweep.solve_many(current_sets)
+
+
+def export_port_model(board, copper, net, settings, progress=None):
+    # write the net's port model with its loads as the ports, the file's extension picks the
+    # format
+    stack = LayerStack.from_board(board)
+    model = build_port_model(copper, stack, settings, _pad_index(copper, net['source']), load_pads(copper, net),
+                             progress, _cache)
+    model.write(net['port_model'])
+    return {'file': net['port_model'], 'ports': model.n_ports}
+
+
+def _start_spice_pool():
+    global _spice_pool
+    if _spice_pool is None and _spice_workers > 0:
+        _spice_pool = SpicePool(_spice_workers)
+        set_spice_pool(_spice_pool)
+
+
+def run_job(job):
+    filename, net, settings = job
+    started = time.time()
+    record = {'board': filename, 'net': net['net']}
+    progress = Progress(stats=AnalysisStats(_stats_log, record))
+    try:
+        progress.stage("Loading board")
+        board_index = _load_board(filename)
+        progress.stage("Isolating net")
+        copper = board_index.collect(net['net'])
+        settings = AnalysisSettings.from_dict(settings)
+        if settings.backend == 'ngspice':
+            _start_spice_pool()
+        results = analyze_job(board_index.board, copper, net, settings, progress)
+        if 'port_model' in net:
+            record['port_model'] = export_port_model(board_index.board, copper, net, settings, progress)
+    except (AnalysisError, SpiceError, ValueError) as error:
+        record['error'] = str(error)
+    except Exception:
+        record['error'] = traceback.format_exc()
+    else:
+        if 'scenarios' in net:
+            record['scenarios'] = [result.summary() for result in results]
+        else:
+            record.update(results[0].summary())
+        if 'max_drop' in net:
+            record['max_drop_limit'] = net['max_drop']
+            record['passed'] = all(result.max_drop <= net['max_drop'] for result in results)
+    progress.finish()
+    record['stats'] = progress.stats.to_dict()
+    record['seconds'] = time.time() - started
+    return record
+
+
+def _init_worker(cache_dir, stats_log, spice_workers):
+    global _cache, _stats_log, _spice_workers
+    # the analysis prints its stages, keep them out of results written to stdout
+    sys.stdout = sys.stderr
+    if cache_dir is not None:
+        _cache = RasterCache(cache_dir)
+    if stats_log is not None:
+        # lines are short and flushed one at a time, so the workers can share the file
+        _stats_log = open(stats_log, 'a')
+    _spice_workers = spice_workers
+
+
+def run_batch(jobs, processes=None, cache_dir=None, stats_log=None, spice_workers=1):
+    # unlike a multiprocessing.Pool's, these workers aren't daemons, so they can start ngspice
+    # processes of their own. Those are daemons and end with their worker.
+    with concurrent.futures.ProcessPoolExecutor(processes, initializer=_init_worker,
+                                                initargs=(cache_dir, stats_log, spice_workers)) as executor:
+        results = []
+        for record in executor.map(run_job, jobs):
+            status = 'error' if 'error' in record else 'ok' if record.get('passed', True) else 'FAIL'
+            sys.stderr.write("{} {} {}: {:.1f} s\n".format(status, record['board'], record['net'], record['seconds']))
+            results.append(record)
+        return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Analyze the power nets of KiCad boards")
+    parser.add_argument('config', help="JSON file listing the boards and nets to analyze")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="number of worker processes (default: one per core)")
+    parser.add_argument('-o', '--output', default=None, help="write the results here instead of stdout")
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help="where rasterized nets are cached between runs (default: %(default)s)")
+    parser.add_argument('--no-cache', action='store_true', help="always rasterize the nets")
+    parser.add_argument('--stats-log', default=None,
+                        help="append a JSON line with the time and memory of every stage to this file")
+    parser.add_argument('--spice-workers', type=int, default=1,
+                        help="ngspice processes of every worker for nets with the ngspice backend, 0 to run "
+                             "ngspice in the worker itself (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    cache_dir = None if args.no_cache else args.cache_dir
+    results = run_batch(load_jobs(args.config), args.jobs, cache_dir, args.stats_log, args.spice_workers)
+
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    failed = [r for r in results if 'error' in r or not r.get('passed', True)]
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,138 @@
+# coding: utf-8
+
+# Power Net Analyzer for KiCad - on-disk cache of rasterized nets
+#
+# Rasterizing a net is the slow part of an analysis that only changed its currents or source
+# voltage. Node maps are stored compressed under a hash of the net's copper geometry and the
+# analysis grid, so the next run with the same copper goes straight to the solve. The cache
+# is bounded in size and evicts the least recently used entries first.
+
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+from netanalysis.layers import rasterize_layers
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'kicad-power-net-analyzer')
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024 # bytes
+
+# bump when the node map format changes, so old entries are never read back
+CACHE_VERSION = 2
+
+# atomic rename over an existing file (os.rename can't on Windows under Python 2)
+_replace = getattr(os, 'replace', os.rename)
+
+
+def geometry_hash(index, stack):
+    # hash of everything the rasterizers look at: every array of the net's geometry
+    digest = hashlib.sha1()
+    geometry = index.geometry
+    digest.update(repr((CACHE_VERSION, tuple(stack.layers), tuple(geometry.layers))).encode('utf-8'))
+
+    arrays = geometry.arrays()
+    for name in sorted(arrays):
+        array = np.ascontiguousarray(arrays[name])
+        digest.update(repr((name, array.dtype.str, array.shape)).encode('utf-8'))
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+class RasterCache(object):
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def key(self, *parts):
+        return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def load(self, key):
+        # arrays stored under the key, or None
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                arrays = dict((name, data[name]) for name in data.files)
+        except (IOError, OSError, ValueError):
+            return None
+
+        # the modification time orders the entries for eviction
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return arrays
+
+    def store(self, key, **arrays):
+        # store the arrays under the key. A cache directory that can't be written (read-only,
+        # full disk) only leaves the entry out, like a miss on load; returns whether it's stored.
+        temp_path = None
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+
+            # write to a temporary file and rename it, so concurrent batch workers never read a
+            # partial entry
+            handle, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+            with os.fdopen(handle, 'wb') as f:
+                np.savez_compressed(f, **arrays)
+            _replace(temp_path, self._path(key))
+        except (IOError, OSError):
+            if temp_path is not None:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+            return False
+        self.evict()
+        return True
+
+    def evict(self):
+        # remove the least recently used entries until the cache fits
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            if name.endswith('.npz'):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+def grid_key(grid):
+    # the analysis grid as a part of a cache key
+    return (grid.root_x, grid.root_y, grid.shape, grid.spacing)
+
+
+def cached_rasterize_layers(cache, netname, index, grid, stack, progress=None, tracks=True):
+    # rasterize_layers, through the cache when there is one
+    if cache is None:
+        return rasterize_layers(index, grid, stack, progress, tracks)
+
+    key = cache.key('layers' if tracks else 'layers-no-tracks', netname, grid_key(grid),
+                    geometry_hash(index, stack))
+    arrays = cache.load(key)
+    if arrays is not None:
+        return [int(layer) for layer in arrays['present']], arrays['node_maps']
+
+    present, node_maps = rasterize_layers(index, grid, stack, progress, tracks)
+    cache.store(key, present=np.array(present, dtype=np.int32), node_maps=node_maps)
+    return present, node_maps
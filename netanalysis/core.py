@@ -0,0 +1,376 @@
+# coding: utf-8
+
+# Power Net Analyzer for KiCad - analysis core
+#
+# Everything needed to analyze a net of a board, without any GUI: the net's copper, the
+# analysis settings, and the pipeline itself. Used by the pcbnew plugin and the batch command
+# line tool. Nothing here touches pcbnew, the copper comes from netanalysis.snapshot.
+
+import numpy as np
+
+from netanalysis.raster import AnalysisGrid, OFF_NET, COPPER
+from netanalysis.spatial import SpatialIndex
+from netanalysis.quadtree import build_layer_meshes, solve_adaptive
+from netanalysis.layers import solve_layers, layer_network, node_describer
+from netanalysis.cache import cached_rasterize_layers
+from netanalysis.solver import AnalysisError, FactoredNetwork, cell_voltages, prune_network, expand_voltages
+from netanalysis.progress import Progress
+
+# coarsest grid of progressive analyses, fast enough for a first look (units: nanometers)
+PREVIEW_SPACING = 1000000
+
+
+class AnalysisSettings(object):
+    # lengths in nanometers, resistances in ohms per square
+    def __init__(self, grid_spacing=100000, sheet_resistance=0.0005, layer_sheet_resistance=None,
+                 source_voltage=3.3, backend='native', mesh='uniform', finest_spacing=20000,
+                 coarse_spacing=1280000, tracks='lumped'):
+        self.grid_spacing = grid_spacing                # 100000 nm (0.1 mm, 10 nodes per mm)
+        self.sheet_resistance = sheet_resistance        # 5milliohms/sq (copper)
+        self.layer_sheet_resistance = dict(layer_sheet_resistance or {}) # per layer name overrides
+        self.source_voltage = source_voltage
+        self.backend = backend                          # 'native', or 'ngspice' to cross-check
+        self.mesh = mesh                                # 'uniform', or 'adaptive'
+        self.finest_spacing = finest_spacing            # smallest adaptive cell
+        self.coarse_spacing = coarse_spacing            # largest adaptive cell
+        self.tracks = tracks                            # 'lumped' resistors or 'raster' cells, uniform mesh
+
+    @classmethod
+    def from_dict(cls, values):
+        settings = cls()
+        for key, value in values.items():
+            if not hasattr(settings, key):
+                raise ValueError("Unknown analysis setting: {}".format(key))
+            setattr(settings, key, value)
+        return settings
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+    def copy(self, **changes):
+        values = self.to_dict()
+        values.update(changes)
+        return AnalysisSettings.from_dict(values)
+
+
+class NetCopper(object):
+    # the copper of one net as a NetGeometry snapshot, and its spatial index. Plain data only,
+    # so it can be analyzed on any thread, pickled to worker processes, or built without
+    # KiCad. netanalysis.snapshot makes them from boards.
+    def __init__(self, geometry):
+        self.geometry = geometry
+        self.netname = geometry.netname
+        self.pad_names = list(geometry.pad_names)
+        self.index = SpatialIndex.from_geometry(geometry)
+
+    @property
+    def n_pads(self):
+        return self.geometry.n_pads
+
+
+def pad_voltages(node_map, voltages, n_pads):
+    # mean voltage over the cells of every pad, NaN for pads that aren't on the grid
+    values = node_map.ravel()
+    on_pad = values > COPPER
+    pads = values[on_pad] - 1
+    sums = np.bincount(pads, weights=voltages.ravel()[on_pad], minlength=n_pads)
+    counts = np.bincount(pads, minlength=n_pads)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+
+class AnalysisResult(object):
+    def __init__(self, netname, grid, layer_names, voltages, pad_names, pad_currents, pad_voltages,
+                 source_pad, source_voltage, node_count):
+        self.netname = netname
+        self.grid = grid
+        self.layer_names = layer_names
+        self.voltages = voltages        # (layer, x, y), NaN off the net
+        self.pad_names = pad_names
+        self.pad_currents = pad_currents
+        self.pad_voltages = pad_voltages
+        self.source_pad = source_pad
+        self.source_voltage = source_voltage
+        self.node_count = node_count
+        self.stats = None               # AnalysisStats of the run that produced the result
+        self.warnings = []              # e.g. copper islands without a path to the source
+
+    @property
+    def min_voltage(self):
+        return float(np.nanmin(self.voltages))
+
+    @property
+    def max_drop(self):
+        return self.source_voltage - self.min_voltage
+
+    def summary(self):
+        # plain values only, for machine readable output
+        pads = {}
+        for name, current, voltage in zip(self.pad_names, self.pad_currents, self.pad_voltages):
+            pads[name] = {'current': current, 'voltage': None if np.isnan(voltage) else float(voltage)}
+        return {
+            'net': self.netname,
+            'source': self.pad_names[self.source_pad],
+            'source_voltage': self.source_voltage,
+            'layers': list(self.layer_names),
+            'nodes': self.node_count,
+            'min_voltage': self.min_voltage,
+            'max_drop': self.max_drop,
+            'pads': pads,
+            'warnings': list(self.warnings),
+        }
+
+
+def resample_voltages(result, grid, layer_names):
+    # voltages of a result on another grid, shaped (layer, x, y): bilinear between the points
+    # of its own grid that are on copper, NaN where none of them is and on layers it doesn't have
+    source = result.grid
+
+    def corners(points, source_points):
+        # the source points below and above every point, and the weight of the one above
+        position = np.clip((points - source_points[0]) / float(source.spacing), 0, len(source_points) - 1)
+        low = np.minimum(np.floor(position).astype(np.int64), len(source_points) - 1)
+        high = np.minimum(low + 1, len(source_points) - 1)
+        return low, high, position - low
+
+    i0, i1, u = corners(grid.xs, source.xs)
+    j0, j1, v = corners(grid.ys, source.ys)
+    voltages = np.full((len(layer_names),) + grid.shape, np.nan)
+    for k, name in enumerate(layer_names):
+        if name not in result.layer_names:
+            continue
+        plane = result.voltages[result.layer_names.index(name)]
+        total = np.zeros(grid.shape)
+        weights = np.zeros(grid.shape)
+        for i, wi in ((i0, 1 - u), (i1, u)):
+            for j, wj in ((j0, 1 - v), (j1, v)):
+                values = plane[np.ix_(i, j)]
+                weight = np.outer(wi, wj) * ~np.isnan(values)
+                total += weight * np.nan_to_num(values)
+                weights += weight
+        with np.errstate(invalid='ignore', divide='ignore'):
+            voltages[k] = total / weights
+    return voltages
+
+
+def analyze_net(copper, stack, settings, pad_currents, source_pad, progress=None, cache=None, initial=None):
+    # run the whole pipeline for one net. pad_currents has one entry per pad of the net.
+    # With a RasterCache, node maps of copper that was analyzed before are not rasterized again.
+    # The timing of every stage ends up in result.stats. initial, a result of the net on
+    # another grid, warm starts the solve on the uniform mesh.
+    if progress is None:
+        progress = Progress()
+
+    def stage(name):
+        print("    - {}".format(name))
+        progress.stage(name)
+
+    # only mesh the area around the net's copper (units: nanometers)
+    copper_bounds = copper.index.bounds()
+    if copper_bounds is None:
+        raise AnalysisError("Net has no copper to analyze")
+    grid = AnalysisGrid.around(copper_bounds, settings.grid_spacing)
+    n_pads = copper.n_pads
+
+    if settings.mesh == 'adaptive':
+        stage("Creating adaptive mesh")
+        present, meshes = build_layer_meshes(copper.index, stack, settings.finest_spacing, settings.coarse_spacing,
+                                             progress)
+        if len(present) == 0:
+            raise AnalysisError("Net has no copper on the analysis grid")
+        layer_names = [stack.name(layer) for layer in present]
+        print("    - Need to process {} cells on {} layers".format(sum(mesh.leaf_count() for mesh in meshes),
+                                                                    len(present)))
+
+        print("    - Solving (adaptive mesh, {} backend)".format(settings.backend))
+        sheet_resistances = [settings.layer_sheet_resistance.get(name, settings.sheet_resistance)
+                             for name in layer_names]
+        leaf_voltages = solve_adaptive(copper.index, stack, present, meshes, pad_currents, source_pad,
+                                       settings.source_voltage, sheet_resistances, progress=progress,
+                                       backend=settings.backend, pad_names=copper.pad_names)
+        print("    - Refined to {} cells".format(sum(mesh.leaf_count() for mesh in meshes)))
+
+        stage("Mapping voltages")
+        start = 0
+        voltages = []
+        for mesh in meshes:
+            voltages.append(mesh.sample(grid, leaf_voltages[start:start + mesh.leaf_count()]))
+            start += mesh.leaf_count()
+        leaf_values = np.concatenate([mesh.leaf_values() for mesh in meshes])
+        pads = pad_voltages(leaf_values, leaf_voltages, n_pads)
+        progress.finish()
+
+        result = AnalysisResult(copper.netname, grid, layer_names, np.array(voltages), copper.pad_names,
+                                pad_currents, pads, source_pad, settings.source_voltage,
+                                int(np.count_nonzero(leaf_values != OFF_NET)))
+        result.stats = progress.stats
+        result.warnings = list(progress.warnings)
+        return result
+
+    lumped_tracks = settings.tracks == 'lumped'
+    stage("Creating nodes")
+    present, node_maps = cached_rasterize_layers(cache, copper.netname, copper.index, grid, stack, progress,
+                                                 not lumped_tracks)
+    if len(present) == 0:
+        raise AnalysisError("Net has no copper on the analysis grid")
+    layer_names = [stack.name(layer) for layer in present]
+
+    nodes_to_process = int(np.count_nonzero(node_maps != OFF_NET))
+    print("    - Need to process {} nodes on {} layers of a {}x{} grid".format(
+        nodes_to_process, len(present), *grid.shape))
+
+    print("    - Solving ({} backend)".format(settings.backend))
+    sheet_resistances = [settings.layer_sheet_resistance.get(name, settings.sheet_resistance)
+                         for name in layer_names]
+    initial_voltages = None if initial is None else resample_voltages(initial, grid, layer_names)
+    voltages = solve_layers(copper.index, grid, stack, present, node_maps, sheet_resistances, pad_currents,
+                            source_pad, settings.source_voltage, progress, settings.backend, copper.pad_names,
+                            lumped_tracks, initial_voltages)
+    pads = pad_voltages(node_maps, voltages, n_pads)
+    progress.finish()
+
+    result = AnalysisResult(copper.netname, grid, layer_names, voltages, copper.pad_names, pad_currents, pads,
+                            source_pad, settings.source_voltage, nodes_to_process)
+    result.stats = progress.stats
+    result.warnings = list(progress.warnings)
+    return result
+
+
+def progressive_spacings(settings, preview_spacing=PREVIEW_SPACING):
+    # grid spacings of a progressive analysis: the preview spacing halved while that stays
+    # at least twice the analysis spacing, then the analysis spacing itself
+    spacings = []
+    spacing = preview_spacing
+    while spacing >= 2 * settings.grid_spacing:
+        spacings.append(spacing)
+        spacing //= 2
+    return spacings + [settings.grid_spacing]
+
+
+def analyze_progressive(copper, stack, settings, pad_currents, source_pad, progress=None, cache=None,
+                        preview_spacing=PREVIEW_SPACING):
+    # analyze_net on ever finer grids, coarsest first, yielding the result of each. Every
+    # level's solve starts from the one before. The last result is at settings.grid_spacing;
+    # stop iterating (or cancel) to keep a coarser one. The adaptive mesh and ngspice get a
+    # single analysis.
+    if progress is None:
+        progress = Progress()
+    if settings.mesh != 'uniform' or settings.backend != 'native':
+        yield analyze_net(copper, stack, settings, pad_currents, source_pad, progress, cache)
+        return
+
+    result = None
+    skipped = []
+    spacings = progressive_spacings(settings, preview_spacing)
+    for spacing in spacings:
+        print("    - Grid spacing {:g} mm".format(spacing / 1e6))
+        # warnings are about the grid of the level, e.g. islands a coarse grid cut off, plus
+        # the previews skipped since the last result
+        progress.warnings = list(skipped)
+        if spacing == spacings[-1]:
+            yield analyze_net(copper, stack, settings, pad_currents, source_pad, progress, cache, result)
+            return
+
+        # a coarse grid may miss a small source or load pad, or cut a load off the source
+        # through a narrow neck; that level is skipped, only the analysis spacing can fail
+        try:
+            preview = analyze_net(copper, stack, settings.copy(grid_spacing=spacing), pad_currents, source_pad,
+                                  progress, cache, result)
+        except AnalysisError as error:
+            reason = str(error)
+        else:
+            missing = [pad for pad, current in enumerate(pad_currents)
+                       if current != 0 and np.isnan(preview.pad_voltages[pad])]
+            if len(missing) == 0:
+                skipped = []
+                result = preview
+                yield result
+                continue
+            reason = "Load pads not on the grid: {}".format(", ".join(copper.pad_names[pad] for pad in missing))
+        message = "Skipped the {:g} mm preview: {}".format(spacing / 1e6, reason)
+        print("    - {}".format(message))
+        skipped.append(message)
+
+
+class NetSweep(object):
+    # a net rasterized and its conductance matrix factored once, for sweeping load currents and
+    # the source voltage. The pads that may draw current are fixed up front since each becomes
+    # a single node of the network. Native backend on the uniform mesh only.
+    def __init__(self, copper, stack, settings, source_pad, load_pads, progress=None, cache=None):
+        if settings.backend != 'native' or settings.mesh != 'uniform':
+            raise AnalysisError("Current sweeps need the native backend on the uniform mesh")
+        if progress is None:
+            progress = Progress()
+
+        self.copper = copper
+        self.settings = settings
+        self.source_pad = source_pad
+        self.progress = progress
+
+        copper_bounds = copper.index.bounds()
+        if copper_bounds is None:
+            raise AnalysisError("Net has no copper to analyze")
+        self.grid = AnalysisGrid.around(copper_bounds, settings.grid_spacing)
+
+        lumped_tracks = settings.tracks == 'lumped'
+        progress.stage("Creating nodes")
+        present, self.node_maps = cached_rasterize_layers(cache, copper.netname, copper.index, self.grid, stack,
+                                                          progress, not lumped_tracks)
+        if len(present) == 0:
+            raise AnalysisError("Net has no copper on the analysis grid")
+        self.layer_names = [stack.name(layer) for layer in present]
+
+        progress.stage("Factoring")
+        self.pad_is_named = [pad == source_pad or pad in load_pads for pad in range(copper.n_pads)]
+        sheet_resistances = [settings.layer_sheet_resistance.get(name, settings.sheet_resistance)
+                             for name in self.layer_names]
+        self.node_index, pad_nodes, n_nodes, src, dst, conductance, positions = layer_network(
+            copper.index, self.grid, stack, present, self.node_maps, sheet_resistances, self.pad_is_named,
+            lumped_tracks)
+        progress.record('nodes', n_nodes)
+        progress.record('edges', len(src))
+        if source_pad not in pad_nodes:
+            raise AnalysisError("Source pad is not on the analysis grid")
+
+        # copper without a path to the source is left out of the factorization
+        describe_node = node_describer(self.grid, stack, present, positions)
+        self.kept, network = prune_network(n_nodes, src, dst, conductance, pad_nodes,
+                                           [float(pad in load_pads) for pad in range(copper.n_pads)], source_pad,
+                                           progress, copper.pad_names, describe_node)
+        n_connected, src, dst, conductance, connected_pads = network
+        self.network = FactoredNetwork(n_connected, src, dst, conductance, connected_pads, source_pad,
+                                       self.pad_is_named, progress)
+
+    def _result(self, node_voltages, pad_currents, source_voltage):
+        voltages = cell_voltages(self.node_index, node_voltages)
+        result = AnalysisResult(self.copper.netname, self.grid, self.layer_names, voltages,
+                                self.copper.pad_names, list(pad_currents),
+                                pad_voltages(self.node_maps, voltages, self.copper.n_pads),
+                                self.source_pad, source_voltage, int(np.count_nonzero(self.node_index >= 0)))
+        # the statistics of the sweep so far, factoring included
+        result.stats = self.progress.stats
+        result.warnings = list(self.progress.warnings)
+        return result
+
+    def solve(self, pad_currents, source_voltage=None):
+        if source_voltage is None:
+            source_voltage = self.settings.source_voltage
+        self.progress.stage("Solving (sweep)")
+        node_voltages = expand_voltages(self.kept, self.network.solve(pad_currents, source_voltage))
+        self.progress.stage("Mapping voltages")
+        result = self._result(node_voltages, pad_currents, source_voltage)
+        self.progress.finish()
+        return result
+
+    def solve_many(self, current_sets, source_voltages=None):
+        # one result per set of pad currents, solved together as a multi column right hand side
+        if source_voltages is None:
+            source_voltages = [self.settings.source_voltage] * len(current_sets)
+        self.progress.stage("Solving (sweep)")
+        self.progress.record('scenarios', len(current_sets))
+        node_voltages = expand_voltages(self.kept, self.network.solve_many(current_sets, source_voltages))
+        self.progress.stage("Mapping voltages")
+        results = [self._result(v, currents, voltage)
+                   for v, currents, voltage in zip(node_voltages, current_sets, source_voltages)]
+        self.progress.finish()
+        return results
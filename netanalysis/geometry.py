@@ -0,0 +1,87 @@
+# coding: utf-8
+
+# Power Net Analyzer for KiCad - copper geometry of a net as plain arrays
+#
+# netanalysis.snapshot takes the pads, tracks, vias and zone fills of a net out of pcbnew in
+# one pass and stores them here. Everything after that works on these arrays only, so the
+# analysis never calls back into pcbnew, and a NetGeometry pickles for worker processes and
+# can be analyzed outside of KiCad. Coordinates and sizes are in nanometers.
+#
+# Items of every kind have an (n, 4) array of (x0, y0, x1, y1) bounding boxes and an
+# (n, layers) array telling which of the snapshot's copper layers they are on.
+
+import numpy as np
+
+from netanalysis.spatial import PAD, TRACK, ZONE
+
+# pad shapes the rasterizer handles analytically, every other shape is a polygon
+PAD_CIRCLE = 0
+PAD_RECT = 1
+PAD_OVAL = 2
+PAD_ROUNDRECT = 3
+PAD_POLYGON = 4
+
+
+def _boxes(n=0):
+    return np.zeros((n, 4), dtype=np.int64)
+
+
+class NetGeometry(object):
+    def __init__(self, netname, layers):
+        self.netname = netname
+        self.layers = list(layers)     # layer ids of the columns of the layer arrays
+
+        # pads: shape code, center, offset of the shape from the center, size, rotation
+        # (units: degrees), rounded rectangle corner radius, plated hole drill (0 for SMD and
+        # unplated pads) and the edges of polygon pads, None for the analytic shapes
+        self.pad_names = []
+        self.pad_shape = np.zeros(0, dtype=np.int8)
+        self.pad_position = np.zeros((0, 2))
+        self.pad_offset = np.zeros((0, 2))
+        self.pad_size = np.zeros((0, 2))
+        self.pad_orientation = np.zeros(0)
+        self.pad_corner_radius = np.zeros(0)
+        self.pad_drill = np.zeros(0)
+        self.pad_polygons = []
+        self.pad_box = _boxes()
+        self.pad_layers = np.zeros((0, len(self.layers)), dtype=bool)
+
+        # tracks and vias: a via is a zero length track with a drill
+        self.track_start = np.zeros((0, 2))
+        self.track_end = np.zeros((0, 2))
+        self.track_width = np.zeros(0)
+        self.track_drill = np.zeros(0)
+        self.track_box = _boxes()
+        self.track_layers = np.zeros((0, len(self.layers)), dtype=bool)
+
+        # zone fills as (x0, y0, x1, y1) edge arrays of every outline and hole
+        self.zone_edges = []
+        self.zone_box = _boxes()
+        self.zone_layers = np.zeros((0, len(self.layers)), dtype=bool)
+
+    @property
+    def n_pads(self):
+        return len(self.pad_shape)
+
+    def count(self, kind):
+        return len(self.boxes(kind))
+
+    def boxes(self, kind):
+        return {PAD: self.pad_box, TRACK: self.track_box, ZONE: self.zone_box}[kind]
+
+    def on_layer(self, kind, layer):
+        # which items of a kind are on a copper layer, as a bool array
+        matrix = {PAD: self.pad_layers, TRACK: self.track_layers, ZONE: self.zone_layers}[kind]
+        if layer not in self.layers:
+            return np.zeros(len(matrix), dtype=bool)
+        return matrix[:, self.layers.index(layer)]
+
+    def arrays(self):
+        # every array of the geometry by name, e.g. for hashing
+        arrays = dict((name, value) for name, value in vars(self).items() if isinstance(value, np.ndarray))
+        for k, edges in enumerate(self.zone_edges):
+            arrays['zone_edges_{}'.format(k)] = edges
+        for k, edges in enumerate(self.pad_polygons):
+            if edges is not None:
+                arrays['pad_polygon_{}'.format(k)] = edges
+        return arrays
@@ -0,0 +1,223 @@
+# coding: utf-8
+
+# Power Net Analyzer for KiCad - multi-layer mesh
+#
+# Every copper layer the net uses gets its own plane of grid nodes with its own sheet
+# resistance. Via barrels and plated through hole pads connect the planes with vertical
+# resistors. Layers without copper on the net are left out, and off-net cells never become
+# nodes, so the node count only grows with the copper that is actually there. With lumped
+# tracks the planes only hold pads and zone fills, and tracks and vias are added to the network
+# as resistors by netanalysis.tracks.
+
+import math
+
+import numpy as np
+
+from netanalysis.spatial import PAD, TRACK, ZONE
+from netanalysis.raster import rasterize_net, pad_mask, track_mask, OFF_NET
+from netanalysis.solver import build_node_index, named_pads, grid_edges, solve_network, cell_voltages
+from netanalysis.netlist import edge_resistance
+from netanalysis.multigrid import node_positions
+from netanalysis.tracks import track_network
+from netanalysis.progress import Progress
+
+COPPER_RESISTIVITY = 1.72e-8 # ohm meters
+PLATING_THICKNESS = 25000 # 25 um of plating in via barrels (units: nanometers)
+
+
+class LayerStack(object):
+    # copper layers of a board from top to bottom (thickness units: nanometers)
+    def __init__(self, layers, names, board_thickness):
+        self.layers = list(layers)
+        self.names = list(names)
+        self.board_thickness = board_thickness
+
+    @classmethod
+    def from_board(cls, board):
+        layers = list(board.GetEnabledLayers().CuStack())
+        names = [board.GetLayerName(layer) for layer in layers]
+        return cls(layers, names, board.GetDesignSettings().GetBoardThickness())
+
+    def name(self, layer):
+        return self.names[self.layers.index(layer)]
+
+    def depth(self, layer):
+        # distance of a layer from the top of the board, assuming evenly spaced layers
+        position = self.layers.index(layer)
+        return self.board_thickness * position / float(max(len(self.layers) - 1, 1))
+
+
+def barrel_resistance(drill, height):
+    # resistance of a plated barrel of the given finished drill and height (units: nanometers)
+    radius = drill / 2.0
+    area = math.pi * ((radius + PLATING_THICKNESS) ** 2 - radius ** 2) * 1e-18
+    return COPPER_RESISTIVITY * height * 1e-9 / area
+
+
+def _barrels(geometry):
+    # (kind, item, mask function, drill) of every via and plated hole of the net
+    barrels = []
+    for i in np.flatnonzero(geometry.track_drill > 0):
+        barrels.append((TRACK, i, track_mask, geometry.track_drill[i]))
+    for i in np.flatnonzero(geometry.pad_drill > 0):
+        barrels.append((PAD, i, pad_mask, geometry.pad_drill[i]))
+    return barrels
+
+
+def used_layers(index, stack):
+    # layers where the net has copper that can carry current sideways. Via and plated hole
+    # rings on a layer with nothing else only connect the barrel to itself, so they don't count.
+    geometry = index.geometry
+    not_barrel = {PAD: geometry.pad_drill == 0, TRACK: geometry.track_drill == 0,
+                  ZONE: np.ones(geometry.count(ZONE), dtype=bool)}
+    return [layer for layer in stack.layers
+            if any((geometry.on_layer(kind, layer) & not_barrel[kind]).any() for kind in not_barrel)]
+
+
+def rasterize_layers(index, grid, stack, progress=None, tracks=True):
+    # node map of every used layer, stacked as (layer, x, y). Without tracks, layers with only
+    # tracks on them are kept with an empty node map for the lumped track model.
+    if progress is None:
+        progress = Progress()
+
+    geometry = index.geometry
+    present = []
+    node_maps = []
+    layers = used_layers(index, stack)
+    for k, layer in enumerate(layers):
+        progress.update(k / float(len(layers)))
+        node_map = rasterize_net(index, grid, layer, progress, tracks)
+        has_tracks = not tracks and (geometry.on_layer(TRACK, layer) & (geometry.track_drill == 0)).any()
+        if has_tracks or (node_map != OFF_NET).any():
+            present.append(layer)
+            node_maps.append(node_map)
+
+    if len(node_maps) == 0:
+        return present, np.full((0,) + grid.shape, OFF_NET, dtype=np.int32)
+    return present, np.array(node_maps)
+
+
+def barrel_edges(index, grid, stack, present, node_index, vias=True):
+    # vertical resistors between consecutive planes a barrel passes through. The barrel's
+    # conductance is shared between the cells its annular ring covers on both planes. Without
+    # vias, only plated pad holes.
+    geometry = index.geometry
+    src, dst, conductance = [], [], []
+    for kind, item, mask_function, drill in _barrels(geometry):
+        if kind == TRACK and not vias:
+            continue
+        planes = [k for k, layer in enumerate(present) if geometry.on_layer(kind, layer)[item]]
+        if len(planes) < 2:
+            continue
+
+        hit = mask_function(geometry, item, grid)
+        if hit is not None and hit[2].any():
+            i0, j0, mask = hit
+            i, j = np.nonzero(mask)
+            i = i + i0
+            j = j + j0
+        else:
+            # smaller than a grid cell, use the cell it sits in
+            x, y = geometry.pad_position[item] if kind == PAD else geometry.track_start[item]
+            i = np.array([min(np.searchsorted(grid.xs, x), len(grid.xs) - 1)])
+            j = np.array([min(np.searchsorted(grid.ys, y), len(grid.ys) - 1)])
+
+        for a, b in zip(planes[:-1], planes[1:]):
+            na = node_index[a][i, j]
+            nb = node_index[b][i, j]
+            keep = (na >= 0) & (nb >= 0) & (na != nb)
+            count = np.count_nonzero(keep)
+            if count == 0:
+                continue
+            height = stack.depth(present[b]) - stack.depth(present[a])
+            src.append(na[keep])
+            dst.append(nb[keep])
+            conductance.append(np.full(count, 1.0 / (barrel_resistance(drill, height) * count)))
+
+    if len(src) == 0:
+        return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32), np.zeros(0)
+    return np.concatenate(src), np.concatenate(dst), np.concatenate(conductance)
+
+
+def via_edges(geometry, stack, present, via_nodes):
+    # barrels of the vias of the lumped track model, between their nodes on consecutive planes
+    src, dst, conductance = [], [], []
+    for via, planes in sorted(via_nodes.items()):
+        for (a, na), (b, nb) in zip(planes[:-1], planes[1:]):
+            if na != nb:
+                height = stack.depth(present[b]) - stack.depth(present[a])
+                src.append(na)
+                dst.append(nb)
+                conductance.append(1.0 / barrel_resistance(geometry.track_drill[via], height))
+    return np.array(src, dtype=np.int64), np.array(dst, dtype=np.int64), np.array(conductance, dtype=np.float64)
+
+
+def layer_network(index, grid, stack, present, node_maps, sheet_resistances, pad_is_named, lumped_tracks=False):
+    # resistor network of the planes and the barrels between them, as the node index of every
+    # cell, the named pad nodes, the node count, (src, dst, conductance) edge arrays and the
+    # (plane, i, j) position of every node. Named pads are one node across all of their layers.
+    # With lumped_tracks the node maps hold no tracks (see rasterize_layers) and the tracks'
+    # nodes come after the grid's.
+    node_index, pad_nodes, n_nodes = build_node_index(node_maps, pad_is_named)
+    positions = node_positions(node_index, n_nodes)
+
+    src, dst, conductance = [], [], []
+    for k in range(len(present)):
+        s, d = grid_edges(node_index[k])
+        src.append(s)
+        dst.append(d)
+        conductance.append(np.full(len(s), 1.0 / edge_resistance(sheet_resistances[k], 1, 1)))
+
+    s, d, g = barrel_edges(index, grid, stack, present, node_index, vias=not lumped_tracks)
+    src.append(s)
+    dst.append(d)
+    conductance.append(g)
+
+    if lumped_tracks:
+        n_nodes, s, d, g, track_positions, via_nodes = track_network(index, grid, present, node_index, n_nodes,
+                                                                     sheet_resistances)
+        positions = np.vstack([positions, track_positions])
+        src.append(s)
+        dst.append(d)
+        conductance.append(g)
+        s, d, g = via_edges(index.geometry, stack, present, via_nodes)
+        src.append(s)
+        dst.append(d)
+        conductance.append(g)
+
+    return (node_index, pad_nodes, n_nodes, np.concatenate(src), np.concatenate(dst), np.concatenate(conductance),
+            positions)
+
+
+def node_describer(grid, stack, present, positions):
+    # function telling where a node of a layer network is, for warnings
+    def describe_node(node):
+        layer, i, j = positions[node]
+        return "({:.2f}, {:.2f}) mm on {}".format(grid.xs[i] / 1e6, grid.ys[j] / 1e6, stack.name(present[layer]))
+    return describe_node
+
+
+def solve_layers(index, grid, stack, present, node_maps, sheet_resistances, pad_currents, source_pad,
+                 source_voltage, progress=None, backend='native', pad_names=None, lumped_tracks=False,
+                 initial_voltages=None):
+    # voltage of every cell of every plane, shaped like node_maps (NaN off the net and on
+    # copper without a path to the source). initial_voltages, a guess shaped like node_maps,
+    # warm starts the solve.
+    if progress is None:
+        progress = Progress()
+
+    progress.stage("Building network")
+    node_index, pad_nodes, n_nodes, src, dst, conductance, positions = layer_network(
+        index, grid, stack, present, node_maps, sheet_resistances, named_pads(pad_currents, source_pad),
+        lumped_tracks)
+    if initial_voltages is not None:
+        # the guess of the cell every node sits on
+        initial_voltages = initial_voltages[tuple(positions.T)]
+    node_voltages = solve_network(n_nodes, src, dst, conductance, pad_nodes, pad_currents, source_pad,
+                                  source_voltage, progress=progress, backend=backend, pad_names=pad_names,
+                                  node_positions=positions,
+                                  describe_node=node_describer(grid, stack, present, positions),
+                                  initial_voltages=initial_voltages)
+
+    progress.stage("Mapping voltages")
+    return cell_voltages(node_index, node_voltages)
@@ -0,0 +1,146 @@
+# coding: utf-8
+
+# Power Net Analyzer for KiCad - geometric multigrid solver
+#
+# The coarse levels come from the grid the nodes sit on: every level merges the nodes of 2x2
+# blocks of cells on a layer into one node. The conductance between two coarse nodes is the
+# sum of the fine conductances crossing between their blocks (the Galerkin operator P^T A P of
+# piecewise constant interpolation), so holes in the copper, merged pads and via barrels
+# coarsen exactly and every level is again a resistor network. Damped Jacobi smoothing and a
+# V-cycle over the levels precondition conjugate gradients, which then converges in a number
+# of iterations that hardly grows with the grid. The levels together are about a third larger
+# than the network, so work and memory are proportional to the number of nodes.
+
+import numpy as np
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
+
+from netanalysis.progress import Progress
+
+# levels stop coarsening at this many nodes, the coarsest is solved directly
+COARSEST_NODES = 2000
+
+# a level is only added when it has at most this fraction of the nodes of the level below,
+# otherwise its blocks are doubled again
+MIN_COARSENING = 0.7
+
+# damped Jacobi sweeps before and after the coarse correction, and their weight
+SMOOTHING_STEPS = 2
+JACOBI_WEIGHT = 0.7
+
+# piecewise constant interpolation undershoots smooth errors, scale the coarse correction up
+COARSE_CORRECTION_SCALE = 1.8
+
+MAX_LEVELS = 30
+
+
+def node_positions(node_index, n_nodes):
+    # (layer, i, j) of a cell of every node of a node index of shape (x, y) or (layer, x, y).
+    # Merged pad nodes sit on one of their cells.
+    if node_index.ndim == 2:
+        node_index = node_index[None]
+    cells = np.argwhere(node_index >= 0)
+    positions = np.zeros((n_nodes, 3), dtype=np.int64)
+    positions[node_index[tuple(cells.T)]] = cells
+    return positions
+
+
+def aggregate_nodes(positions, n_nodes):
+    # coarse node of every node and (layer, i, j) of the coarse nodes on their own grid. Blocks
+    # are 2x2 cells, or larger where the mesh is already coarse, e.g. over the big leaves of
+    # an adaptive mesh.
+    layer, i, j = positions.T
+    for shift in range(1, 63):
+        blocks_i = (i.max() >> shift) + 1
+        blocks_j = (j.max() >> shift) + 1
+        keys = (layer * blocks_i + (i >> shift)) * blocks_j + (j >> shift)
+        keys, aggregate = np.unique(keys, return_inverse=True)
+        if len(keys) <= MIN_COARSENING * n_nodes or blocks_i * blocks_j == 1:
+            break
+
+    aggregate = aggregate.ravel()
+    coarse_positions = np.zeros((len(keys), 3), dtype=np.int64)
+    coarse_positions[aggregate] = positions
+    coarse_positions[:, 1:] >>= shift
+    return aggregate, coarse_positions
+
+
+class MultigridSolver(object):
+    def __init__(self, matrix, positions):
+        # matrix: symmetric positive definite conductance matrix, positions: (layer, i, j) of
+        # every node on the grid
+        self.matrices = [sp.csr_matrix(matrix)]
+        self.diagonals = [self.matrices[0].diagonal()]
+        self.interpolations = []
+
+        positions = np.asarray(positions, dtype=np.int64)
+        while self.matrices[-1].shape[0] > COARSEST_NODES and len(self.matrices) < MAX_LEVELS:
+            n_nodes = self.matrices[-1].shape[0]
+            aggregate, positions = aggregate_nodes(positions, n_nodes)
+            if len(positions) >= n_nodes:
+                break
+
+            # a 1 for every node in the column of its coarse node
+            interpolation = sp.csr_matrix((np.ones(n_nodes), (np.arange(n_nodes), aggregate)),
+                                          shape=(n_nodes, len(positions)))
+            coarse = (interpolation.T.tocsr() * self.matrices[-1] * interpolation).tocsr()
+            self.interpolations.append(interpolation)
+            self.matrices.append(coarse)
+            self.diagonals.append(coarse.diagonal())
+
+        self.coarsest = spla.splu(self.matrices[-1].tocsc())
+
+    @property
+    def n_levels(self):
+        return len(self.matrices)
+
+    def _cycle(self, k, rhs):
+        # approximate solution of level k for the right hand side, starting from zero
+        if k == len(self.matrices) - 1:
+            return self.coarsest.solve(rhs)
+
+        matrix = self.matrices[k]
+        weight = JACOBI_WEIGHT / self.diagonals[k]
+        x = weight * rhs
+        for step in range(SMOOTHING_STEPS - 1):
+            x += weight * (rhs - matrix.dot(x))
+
+        interpolation = self.interpolations[k]
+        coarse = self._cycle(k + 1, interpolation.T.dot(rhs - matrix.dot(x)))
+        x += COARSE_CORRECTION_SCALE * interpolation.dot(coarse)
+
+        for step in range(SMOOTHING_STEPS):
+            x += weight * (rhs - matrix.dot(x))
+        return x
+
+    def solve(self, rhs, x0=None, tolerance=1e-12, max_iterations=500, progress=None):
+        # conjugate gradients preconditioned with one V-cycle per iteration. Returns the
+        # solution and the iteration count, or raises ArithmeticError if it doesn't converge.
+        # progress is updated every iteration, so cancelling stops the solve right away.
+        if progress is None:
+            progress = Progress()
+        matrix = self.matrices[0]
+        x = np.zeros(matrix.shape[0]) if x0 is None else np.array(x0, dtype=np.float64)
+
+        residual = rhs - matrix.dot(x)
+        target = tolerance * max(np.linalg.norm(rhs), 1e-300)
+        if np.linalg.norm(residual) <= target:
+            return x, 0
+
+        z = self._cycle(0, residual)
+        direction = z.copy()
+        rz = residual.dot(z)
+        for iteration in range(1, max_iterations + 1):
+            progress.update()
+            product = matrix.dot(direction)
+            step = rz / direction.dot(product)
+            x += step * direction
+            residual -= step * product
+            if np.linalg.norm(residual) <= target:
+                return x, iteration
+
+            z = self._cycle(0, residual)
+            rz, previous = residual.dot(z), rz
+            direction = z + (rz / previous) * direction
+
+        raise ArithmeticError("Multigrid solver did not converge")
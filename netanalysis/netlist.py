@@ -0,0 +1,46 @@
+# coding: utf-8
+
+# Power Net Analyzer for KiCad - SPICE netlist generation
+#
+# The analysis works on resistor networks held as NumPy arrays: an int32 node index per cell
+# and (src, dst, conductance) edge arrays. Text is only produced here, when a network is handed
+# to ngspice. Node k of the network is the SPICE node "n<k>".
+
+# edges formatted per batch, whole edge arrays as Python lists would take many times the
+# memory of the arrays
+NETLIST_CHUNK = 65536
+
+
+def edge_resistance(sheet_resistance, length, width):
+    # resistance of a rectangle of copper carrying current along its length
+    return sheet_resistance * float(length) / float(width)
+
+
+def spice_node(node):
+    return "n{}".format(node)
+
+
+def netlist_lines(src, dst, conductance, pad_nodes, pad_names, pad_currents, source_pad, source_voltage):
+    # lines of the netlist of a network driven by the source and load pads, generated one at a
+    # time so the whole netlist never has to be held in memory
+    yield 'analysis' # first line is name of netlist, in this case 'analysis'
+
+    # one resistor per edge
+    for start in range(0, len(src), NETLIST_CHUNK):
+        stop = start + NETLIST_CHUNK
+        edges = zip(src[start:stop].tolist(), dst[start:stop].tolist(), (1.0 / conductance[start:stop]).tolist())
+        for n, (a, b, resistance) in enumerate(edges, start + 1):
+            yield "R{} n{} n{} {!r}".format(n, a, b, resistance)
+
+    # add a voltage source to the selected source pad node
+    yield "* source {}".format(pad_names[source_pad])
+    yield "V1 {} 0 {!r}".format(spice_node(pad_nodes[source_pad]), float(source_voltage))
+
+    # add current sources to each load pad node
+    for pad, current in enumerate(pad_currents):
+        if current != 0 and pad in pad_nodes:
+            yield "* load {}".format(pad_names[pad])
+            yield "I{} {} 0 {!r}".format(pad, spice_node(pad_nodes[pad]), float(current))
+
+    yield ".op"
+    yield ".end"
@@ -0,0 +1,203 @@
+# coding: utf-8
+
+# Power Net Analyzer for KiCad - port-reduced resistance model
+#
+# For sign-off only the voltages at the pads matter, and those are linear in the pad
+# currents. The ports are the load pads, the pads that may draw current; like in a full
+# analysis each of them and the source is a single node of the network, and every other pad
+# is the copper under it. One solve per port through a single factorization gives the drop at
+# every pad per ampere drawn at every port, the transfer matrix T. Its port rows are the port
+# resistance matrix R, where R[i, j] is the drop at port i per ampere drawn at port j (the
+# Schur complement of the network onto its ports, inverted). Any set of load currents then
+# gives the pad voltages as V_source - T I, a small dense product instead of a solve, and the
+# same voltages a full analysis of those loads gives. Models are cached per geometry, settings
+# and ports, and can be written out as a SPICE subcircuit for system-level simulation.
+
+import json
+import re
+
+import numpy as np
+import scipy.sparse as sp
+
+from netanalysis.raster import AnalysisGrid, COPPER
+from netanalysis.core import NetSweep
+from netanalysis.cache import geometry_hash, grid_key
+from netanalysis.solver import AnalysisError, expand_voltages
+from netanalysis.progress import Progress
+
+# bump when the stored model changes, so old cache entries are never read back
+PORT_MODEL_VERSION = 2
+
+# unit current solves per call through the factorization, each holds the voltage of every node
+PORT_CHUNK = 32
+
+# couplings below this fraction of the largest port conductance are left out of subcircuits
+SUBCIRCUIT_MIN_CONDUCTANCE = 1e-12
+
+
+def _spice_name(text):
+    return re.sub(r'[^A-Za-z0-9_]', '_', text)
+
+
+class PortModel(object):
+    # ports: pad of every port. transfer: drop at every pad per ampere drawn at every port, NaN
+    # for pads off the analysis grid or on copper without a path to the source.
+    def __init__(self, netname, pad_names, source_pad, ports, transfer):
+        self.netname = netname
+        self.pad_names = list(pad_names)
+        self.source_pad = source_pad
+        self.ports = np.asarray(ports, dtype=np.int64)
+        self.transfer = np.asarray(transfer, dtype=np.float64)         # ohms, (pad, port)
+
+    @property
+    def n_ports(self):
+        return len(self.ports)
+
+    @property
+    def resistance(self):
+        # port resistance matrix (units: ohms)
+        return self.transfer[self.ports]
+
+    def port_currents(self, pad_currents):
+        # current of every port from the current of every pad
+        pad_currents = np.asarray(pad_currents, dtype=np.float64)
+        loads = np.flatnonzero(pad_currents != 0)
+        others = [pad for pad in loads.tolist() if pad not in self.ports]
+        if len(others) > 0:
+            raise AnalysisError("Load pads not in the port model, build it again: {}".format(
+                ", ".join(self.pad_names[pad] for pad in others)))
+        return pad_currents[self.ports]
+
+    def pad_voltages(self, pad_currents, source_voltage):
+        # voltage of every pad for a set of pad currents, NaN for pads without one
+        return source_voltage - self.transfer.dot(self.port_currents(pad_currents))
+
+    def conductance(self):
+        # port conductance matrix, the inverse of the resistance matrix (units: siemens)
+        return np.linalg.inv(self.resistance)
+
+    def to_arrays(self):
+        return {'ports': self.ports, 'transfer': self.transfer}
+
+    def to_dict(self):
+        # plain values only, for machine readable output. Pads without a voltage have no
+        # transfer row.
+        return {
+            'net': self.netname,
+            'source': self.pad_names[self.source_pad],
+            'ports': [self.pad_names[pad] for pad in self.ports.tolist()],
+            'resistance': self.resistance.tolist(),
+            'transfer': dict((name, None if np.isnan(row).any() else row.tolist())
+                             for name, row in zip(self.pad_names, self.transfer)),
+        }
+
+    def subcircuit_lines(self, name=None):
+        # the model as a SPICE subcircuit between the source pin and one pin per port: a
+        # resistor from every port to the source and between every coupled pair of ports
+        if name is None:
+            name = "pdn_" + _spice_name(self.netname)
+        conductance = self.conductance()
+        pins = ["p{}".format(port + 1) for port in range(self.n_ports)]
+        threshold = SUBCIRCUIT_MIN_CONDUCTANCE * np.abs(conductance).max() if self.n_ports > 0 else 0.0
+
+        yield "* port model of net {}, source {}".format(self.netname, self.pad_names[self.source_pad])
+        for pin, pad in zip(pins, self.ports.tolist()):
+            yield "* {} {}".format(pin, self.pad_names[pad])
+        yield ".subckt {} src {}".format(name, " ".join(pins))
+
+        n = 0
+        shunts = conductance.sum(axis=1)
+        for i in range(self.n_ports):
+            if shunts[i] > threshold:
+                n += 1
+                yield "R{} {} src {!r}".format(n, pins[i], float(1.0 / shunts[i]))
+            for j in range(i + 1, self.n_ports):
+                if -conductance[i, j] > threshold:
+                    n += 1
+                    yield "R{} {} {} {!r}".format(n, pins[i], pins[j], float(-1.0 / conductance[i, j]))
+        yield ".ends {}".format(name)
+
+    def write(self, path):
+        # .json: the matrix and port names, .csv: the matrix with a header of port names,
+        # anything else: a SPICE subcircuit
+        extension = path.lower().rsplit('.', 1)[-1]
+        with open(path, 'w') as f:
+            if extension == 'json':
+                json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+                f.write("\n")
+            elif extension == 'csv':
+                f.write(",".join([""] + [self.pad_names[pad] for pad in self.ports.tolist()]) + "\n")
+                for pad, row in zip(self.ports.tolist(), self.resistance.tolist()):
+                    f.write(",".join([self.pad_names[pad]] + [repr(value) for value in row]) + "\n")
+            else:
+                for line in self.subcircuit_lines():
+                    f.write(line + "\n")
+
+
+def _model_key(cache, copper, stack, settings, grid, source_pad, ports):
+    # everything the port resistances depend on, the source voltage and currents aren't
+    return cache.key('ports', PORT_MODEL_VERSION, copper.netname, grid_key(grid),
+                     geometry_hash(copper.index, stack), source_pad, list(ports), settings.tracks,
+                     settings.sheet_resistance, sorted(settings.layer_sheet_resistance.items()))
+
+
+def _pad_averages(node_maps, node_index, n_pads, n_nodes):
+    # (pad, node) matrix averaging the nodes under every pad, like core.pad_voltages does
+    # with the cells; rows of pads off the grid are zero
+    values = node_maps.ravel()
+    on_pad = values > COPPER
+    pads = values[on_pad] - 1
+    nodes = node_index.ravel()[on_pad]
+    counts = np.bincount(pads, minlength=n_pads)
+    return sp.csr_matrix((1.0 / counts[pads], (pads, nodes)), shape=(n_pads, n_nodes))
+
+
+def build_port_model(copper, stack, settings, source_pad, load_pads, progress=None, cache=None):
+    # port model of a net with the load pads as its ports, on the uniform mesh and always
+    # solved natively. With a RasterCache the model of copper that was reduced before is read
+    # back instead.
+    if settings.mesh != 'uniform':
+        raise AnalysisError("Port models need the uniform mesh")
+    if progress is None:
+        progress = Progress()
+
+    copper_bounds = copper.index.bounds()
+    if copper_bounds is None:
+        raise AnalysisError("Net has no copper to analyze")
+    grid = AnalysisGrid.around(copper_bounds, settings.grid_spacing)
+    ports = sorted(set(load_pads) - set([source_pad]))
+
+    key = None
+    if cache is not None:
+        key = _model_key(cache, copper, stack, settings, grid, source_pad, ports)
+        arrays = cache.load(key)
+        if arrays is not None:
+            progress.record('ports', len(arrays['ports']))
+            return PortModel(copper.netname, copper.pad_names, source_pad, arrays['ports'], arrays['transfer'])
+
+    # the same network a sweep over these loads factors, loads on islands are an error
+    sweep = NetSweep(copper, stack, settings.copy(backend='native'), source_pad, ports, progress, cache)
+    progress.record('ports', len(ports))
+    averages = _pad_averages(sweep.node_maps, sweep.node_index, copper.n_pads, len(sweep.kept))
+
+    # with the source at 0 V, an ampere drawn at one port leaves every pad at minus its
+    # transfer resistance
+    progress.stage("Reducing to ports")
+    transfer = np.zeros((copper.n_pads, len(ports)))
+    for start in range(0, len(ports), PORT_CHUNK):
+        chunk = ports[start:start + PORT_CHUNK]
+        current_sets = [[1.0 if pad == port else 0.0 for pad in range(copper.n_pads)] for port in chunk]
+        node_voltages = expand_voltages(sweep.kept, sweep.network.solve_many(current_sets, [0.0] * len(chunk)))
+        transfer[:, start:start + len(chunk)] = -averages.dot(node_voltages.T)
+        progress.update((start + len(chunk)) / float(len(ports)))
+
+    # pads off the grid have no voltage
+    transfer[np.asarray(averages.sum(axis=1)).ravel() == 0] = np.nan
+    # the port resistances are symmetric up to rounding, make them exactly so
+    resistance = transfer[ports]
+    transfer[ports] = (resistance + resistance.T) / 2.0
+
+    model = PortModel(copper.netname, copper.pad_names, source_pad, ports, transfer)
+    if cache is not None:
+        cache.store(key, **model.to_arrays())
+    return model
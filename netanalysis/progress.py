@@ -0,0 +1,77 @@
+# coding: utf-8
+
+# Power Net Analyzer for KiCad - progress reporting and cancellation
+#
+# A Progress object is handed to every stage of the analysis. Stages report what they are
+# doing through it and call check() (or update(), which checks too) often enough that a
+# cancel() from another thread stops the analysis quickly. Stage boundaries and record()ed
+# counters also go to the AnalysisStats of the progress, and warn()ings about the board are
+# collected for the result.
+
+import threading
+import time
+
+from netanalysis.stats import AnalysisStats
+
+# minimum time between two progress callbacks (units: seconds)
+REPORT_INTERVAL = 0.1
+
+
+class AnalysisCancelled(Exception):
+    pass
+
+
+class Progress(object):
+    def __init__(self, callback=None, stats=None):
+        # callback(stage, fraction, elapsed) is called from the thread running the analysis.
+        # fraction is None when a stage can't tell how far along it is.
+        self._callback = callback
+        self.stats = stats if stats is not None else AnalysisStats()
+        self._cancelled = threading.Event()
+        self._last_report = 0.0
+        self.started = time.time()
+        self.stage_name = None
+        self.warnings = []
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def check(self):
+        if self._cancelled.is_set():
+            raise AnalysisCancelled("Analysis cancelled")
+
+    def stage(self, name):
+        self.check()
+        self.stage_name = name
+        self.stats.begin(name)
+        self._report(0.0, force=True)
+
+    def record(self, key, value):
+        self.stats.record(key, value)
+
+    def warn(self, message):
+        # something about the board the user should know, the analysis goes on
+        print("    - Warning: {}".format(message))
+        self.warnings.append(message)
+
+    def finish(self):
+        # close the last stage's statistics
+        self.stats.end()
+
+    def update(self, fraction=None):
+        self.check()
+        self._report(fraction)
+
+    def _report(self, fraction, force=False):
+        now = time.time()
+        if self._callback is not None and (force or now - self._last_report >= REPORT_INTERVAL):
+            self._last_report = now
+            self._callback(self.stage_name, fraction, now - self.started)
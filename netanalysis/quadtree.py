@@ -0,0 +1,455 @@
+# coding: utf-8
+
+# Power Net Analyzer for KiCad - adaptive quadtree mesh
+#
+# The mesh starts as coarse square cells over the net's copper and splits cells that touch pad
+# edges, tracks and zone fill boundaries, and then cells where the solved voltage changes
+# quickly. The tree is kept 2:1 balanced so a cell's neighbour across a face is at most one
+# level finer or coarser, which keeps the conductance between cells of different sizes simple.
+#
+# Cells are addressed by (level, i, j): level 0 is the coarse grid and a cell at level l has
+# the four children (2i, 2j), (2i + 1, 2j), (2i, 2j + 1) and (2i + 1, 2j + 1) at level l + 1.
+#
+# Every copper layer of the net gets a tree of its own, refined along that layer's copper, and
+# via barrels and plated holes join the leaves they sit in on consecutive layers, like the
+# planes of the uniform mesh.
+
+import math
+
+import numpy as np
+
+from netanalysis.raster import AnalysisGrid, rasterize_net, pad_mask, track_mask
+from netanalysis.solver import build_node_index, named_pads, solve_network
+from netanalysis.spatial import PAD, TRACK, ZONE
+from netanalysis.layers import used_layers, barrel_resistance, _barrels
+from netanalysis.progress import Progress
+
+# leaves are rasterized in tiles of this many cells per side
+RASTER_TILE = 128
+
+# node map value of a leaf that has not been rasterized yet
+UNSET = -2
+
+# conductance of a face between a cell and a neighbour twice its size: the shared face is
+# the small cell's side s and the centers are 1.5 s apart, so s / (1.5 s) squares in parallel
+_MIXED_FACE = 2.0 / 3.0
+
+_KEY_STRIDE = 1 << 31
+
+
+def _key(i, j):
+    return np.asarray(i, dtype=np.int64) * _KEY_STRIDE + np.asarray(j, dtype=np.int64)
+
+
+def _unkey(keys):
+    return keys // _KEY_STRIDE, keys % _KEY_STRIDE
+
+
+def _boundary_points(mask, grid):
+    # grid points on either side of a change in the mask
+    edge = np.zeros(mask.shape, dtype=bool)
+    step = mask[:-1, :] != mask[1:, :]
+    edge[:-1, :] |= step
+    edge[1:, :] |= step
+    step = mask[:, :-1] != mask[:, 1:]
+    edge[:, :-1] |= step
+    edge[:, 1:] |= step
+    i, j = np.nonzero(edge)
+    return grid.xs[i], grid.ys[j]
+
+
+def _item_boundary(geometry, i, box, mask_function, spacing, inside=False):
+    # outline of a pad or track, sampled on a local grid around it. With inside, every point
+    # of the item instead.
+    x0, y0, x1, y1 = box
+    grid = AnalysisGrid(x0 - spacing, y0 - spacing, x1 - x0 + 3 * spacing, y1 - y0 + 3 * spacing, spacing)
+    mask = np.zeros(grid.shape, dtype=bool)
+    hit = mask_function(geometry, i, grid)
+    if hit is not None:
+        i0, j0, window = hit
+        mask[i0:i0 + window.shape[0], j0:j0 + window.shape[1]] = window
+    if not mask.any():
+        # smaller than a cell, refine around its center
+        return (np.array([(x0 + x1) // 2]), np.array([(y0 + y1) // 2]))
+    if inside:
+        i, j = np.nonzero(mask)
+        return grid.xs[i], grid.ys[j]
+    return _boundary_points(mask, grid)
+
+
+def geometry_features(index, finest_spacing, layer=None):
+    # points where the copper geometry needs cells of a given size: (x, y, size) arrays. With
+    # a layer, only the copper on that layer.
+    xs, ys, sizes = [], [], []
+
+    def add(px, py, size):
+        xs.append(np.asarray(px, dtype=np.float64))
+        ys.append(np.asarray(py, dtype=np.float64))
+        sizes.append(np.full(len(xs[-1]), float(size)))
+
+    geometry = index.geometry
+
+    def items(kind):
+        if layer is None:
+            return np.arange(geometry.count(kind))
+        return np.flatnonzero(geometry.on_layer(kind, layer))
+
+    # zone fill boundaries, sampled along every edge
+    for zone in items(ZONE):
+        edges = geometry.zone_edges[zone]
+        if len(edges) == 0:
+            continue
+        x0, y0, x1, y1 = edges.T
+        counts = np.ceil(np.hypot(x1 - x0, y1 - y0) / finest_spacing).astype(np.int64) + 1
+        edge = np.repeat(np.arange(len(edges)), counts)
+        t = (np.arange(len(edge)) - np.repeat(np.cumsum(counts) - counts, counts)) / np.maximum(counts[edge] - 1, 1)
+        add(x0[edge] + t * (x1[edge] - x0[edge]), y0[edge] + t * (y1[edge] - y0[edge]), finest_spacing)
+
+    # pad edges at the finest size
+    for i in items(PAD):
+        px, py = _item_boundary(geometry, i, geometry.pad_box[i].tolist(), pad_mask, finest_spacing)
+        add(px, py, finest_spacing)
+
+    # tracks are filled with cells of the finest size: a track only a few cells wide is off by
+    # a whole cell of its width, and the faces between cells of different sizes along a track
+    # conduct as if it was wider
+    for i in items(TRACK):
+        px, py = _item_boundary(geometry, i, geometry.track_box[i].tolist(), track_mask, finest_spacing,
+                                inside=True)
+        add(px, py, finest_spacing)
+
+    if len(xs) == 0:
+        return np.zeros(0), np.zeros(0), np.zeros(0)
+    return np.concatenate(xs), np.concatenate(ys), np.concatenate(sizes)
+
+
+class QuadtreeMesh(object):
+    def __init__(self, index, bounds, finest_spacing, levels, layer=None):
+        # the copper of one layer, or of all layers flattened into one plane without a layer
+        self.index = index
+        self.layer = layer
+        self.levels = levels
+        self.finest_spacing = finest_spacing
+
+        coarse = AnalysisGrid.around(bounds, self.spacing(0))
+        self.corner_x = coarse.root_x - self.spacing(0) // 2
+        self.corner_y = coarse.root_y - self.spacing(0) // 2
+        self.coarse_shape = coarse.shape
+
+        # sorted keys and node map values of the leaves at each level
+        self.keys = [np.zeros(0, dtype=np.int64) for level in range(levels + 1)]
+        self.values = [np.zeros(0, dtype=np.int32) for level in range(levels + 1)]
+
+        i, j = np.meshgrid(np.arange(coarse.shape[0]), np.arange(coarse.shape[1]), indexing='ij')
+        self.keys[0] = np.sort(_key(i.ravel(), j.ravel()))
+        self.values[0] = np.full(len(self.keys[0]), UNSET, dtype=np.int32)
+
+    def spacing(self, level):
+        # cell size at a level (units: nanometers)
+        return self.finest_spacing * 2 ** (self.levels - level)
+
+    def centers(self, level, i, j):
+        h = self.spacing(level)
+        return self.corner_x + i * h + h // 2, self.corner_y + j * h + h // 2
+
+    def leaf_count(self):
+        return sum(len(keys) for keys in self.keys)
+
+    def _offsets(self):
+        return np.cumsum([0] + [len(keys) for keys in self.keys])
+
+    def leaf_values(self):
+        return np.concatenate(self.values)
+
+    def leaf_positions(self):
+        # (i, j) of every leaf's corner in cells of the finest level
+        positions = []
+        for level, keys in enumerate(self.keys):
+            i, j = _unkey(keys)
+            scale = 2 ** (self.levels - level)
+            positions.append(np.column_stack([i * scale, j * scale]))
+        return np.vstack(positions)
+
+    def split(self, level, keys):
+        # replace the leaves with the given keys at a level by their four children
+        keys = np.unique(keys)
+        if len(keys) == 0 or level >= self.levels:
+            return 0
+
+        keep = ~np.isin(self.keys[level], keys)
+        self.keys[level] = self.keys[level][keep]
+        self.values[level] = self.values[level][keep]
+
+        i, j = _unkey(keys)
+        children = _key(np.concatenate([2 * i, 2 * i + 1, 2 * i, 2 * i + 1]),
+                        np.concatenate([2 * j, 2 * j, 2 * j + 1, 2 * j + 1]))
+        merged = np.concatenate([self.keys[level + 1], children])
+        values = np.concatenate([self.values[level + 1], np.full(len(children), UNSET, dtype=np.int32)])
+        order = np.argsort(merged, kind='stable')
+        self.keys[level + 1] = merged[order]
+        self.values[level + 1] = values[order]
+        return len(keys)
+
+    def split_leaves(self, leaves):
+        # split leaves given by their position in the flat leaf arrays
+        offsets = self._offsets()
+        leaves = np.unique(leaves)
+        targets = []
+        for level in range(self.levels):
+            at_level = leaves[(leaves >= offsets[level]) & (leaves < offsets[level + 1])] - offsets[level]
+            targets.append(self.keys[level][at_level])
+
+        # splitting changes the finer levels, so look every key up before splitting any
+        return sum(self.split(level, keys) for level, keys in enumerate(targets))
+
+    def refine_to_features(self, px, py, sizes):
+        # split every leaf that contains a feature point needing smaller cells than the leaf
+        for level in range(self.levels):
+            h = self.spacing(level)
+            need = sizes < h
+            if not need.any():
+                continue
+            i = (px[need] - self.corner_x) // h
+            j = (py[need] - self.corner_y) // h
+            scale = 2 ** level
+            inside = (i >= 0) & (j >= 0) & (i < self.coarse_shape[0] * scale) & (j < self.coarse_shape[1] * scale)
+            keys = np.unique(_key(i[inside], j[inside]))
+            self.split(level, keys[np.isin(keys, self.keys[level])])
+
+    def balance(self):
+        # split leaves until no leaf has a neighbour more than one level finer
+        changed = True
+        while changed:
+            changed = False
+            for level in range(self.levels, 1, -1):
+                if len(self.keys[level]) == 0:
+                    continue
+
+                # the cells next to this leaf's parent must not be leaves more than a level coarser
+                i, j = _unkey(self.keys[level])
+                ni = np.concatenate([i // 2 - 1, i // 2 + 1, i // 2, i // 2])
+                nj = np.concatenate([j // 2, j // 2, j // 2 - 1, j // 2 + 1])
+                valid = (ni >= 0) & (nj >= 0)
+                ni = ni[valid]
+                nj = nj[valid]
+
+                for coarse in range(level - 2, -1, -1):
+                    shift = level - 1 - coarse
+                    keys = np.unique(_key(ni >> shift, nj >> shift))
+                    hit = keys[np.isin(keys, self.keys[coarse])]
+                    if len(hit) > 0:
+                        self.split(coarse, hit)
+                        changed = True
+
+    def update_values(self, progress=None):
+        # rasterize the leaves that don't have a node map value yet, one tile at a time
+        if progress is None:
+            progress = Progress()
+
+        for level in range(self.levels + 1):
+            unset = np.flatnonzero(self.values[level] == UNSET)
+            if len(unset) == 0:
+                continue
+
+            i, j = _unkey(self.keys[level][unset])
+            tiles = _key(i // RASTER_TILE, j // RASTER_TILE)
+            order = np.argsort(tiles, kind='stable')
+            starts = np.flatnonzero(np.r_[True, tiles[order][1:] != tiles[order][:-1]])
+            for group in np.split(order, starts[1:]):
+                progress.update()
+                gi = i[group]
+                gj = j[group]
+                i0, j0 = gi.min(), gj.min()
+                xs, ys = self.centers(level, np.arange(i0, gi.max() + 1), np.arange(j0, gj.max() + 1))
+                node_map = rasterize_net(self.index, AnalysisGrid.from_points(xs, ys, self.spacing(level)),
+                                         self.layer, progress)
+                self.values[level][unset[group]] = node_map[gi - i0, gj - j0]
+
+    def _lookup(self, level, i, j):
+        # position in the flat leaf arrays of the leaves at (level, i, j), or -1
+        keys = self.keys[level]
+        wanted = _key(i, j)
+        if len(keys) == 0:
+            return np.full(wanted.shape, -1, dtype=np.int64)
+        position = np.minimum(np.searchsorted(keys, wanted), len(keys) - 1)
+        found = (keys[position] == wanted) & (np.asarray(i) >= 0) & (np.asarray(j) >= 0)
+        return np.where(found, self._offsets()[level] + position, -1)
+
+    def edges(self):
+        # every pair of face-adjacent leaves once, as (a, b, squares) where squares is the
+        # shared face over the distance between the cell centers
+        offsets = self._offsets()
+        src, dst, squares = [], [], []
+
+        def add(a, b, factor):
+            keep = b >= 0
+            src.append(a[keep])
+            dst.append(b[keep])
+            squares.append(np.full(np.count_nonzero(keep), factor))
+
+        for level in range(self.levels + 1):
+            i, j = _unkey(self.keys[level])
+            a = offsets[level] + np.arange(len(i))
+
+            # only look right and down, the other faces belong to the neighbour
+            for di, dj in ((1, 0), (0, 1)):
+                add(a, self._lookup(level, i + di, j + dj), 1.0)
+
+                if level > 0:
+                    add(a, self._lookup(level - 1, (i + di) // 2, (j + dj) // 2), _MIXED_FACE)
+
+                if level < self.levels:
+                    for k in (0, 1):
+                        ci = 2 * i + 2 if di else 2 * i + k
+                        cj = 2 * j + 2 if dj else 2 * j + k
+                        add(a, self._lookup(level + 1, ci, cj), _MIXED_FACE)
+
+        return np.concatenate(src), np.concatenate(dst), np.concatenate(squares)
+
+    def locate(self, x, y):
+        # the leaf containing every point, or -1 outside the mesh
+        x = np.asarray(x)
+        y = np.asarray(y)
+        leaf = np.full(x.shape, -1, dtype=np.int64)
+        for level in range(self.levels + 1):
+            h = self.spacing(level)
+            missing = leaf < 0
+            i = ((x[missing] - self.corner_x) // h).astype(np.int64)
+            j = ((y[missing] - self.corner_y) // h).astype(np.int64)
+            leaf[missing] = self._lookup(level, i, j)
+        return leaf
+
+    def sample(self, grid, leaf_data, fill=np.nan):
+        # look up a per-leaf array at every point of a regular grid, e.g. for plotting
+        x, y = np.meshgrid(grid.xs, grid.ys, indexing='ij')
+        leaf = self.locate(x, y)
+
+        result = np.full(x.shape, fill, dtype=np.float64)
+        result[leaf >= 0] = leaf_data[leaf[leaf >= 0]]
+        return result
+
+
+def build_adaptive_mesh(index, finest_spacing, coarse_spacing, progress=None, layer=None):
+    # quadtree over the net's copper, refined down to finest_spacing along its geometry
+    levels = max(0, int(math.ceil(math.log(float(coarse_spacing) / finest_spacing, 2))))
+    mesh = QuadtreeMesh(index, index.bounds(), finest_spacing, levels, layer)
+    mesh.refine_to_features(*geometry_features(index, finest_spacing, layer))
+    mesh.balance()
+    mesh.update_values(progress)
+    return mesh
+
+
+def build_layer_meshes(index, stack, finest_spacing, coarse_spacing, progress=None):
+    # one quadtree per layer the net has copper on, as the layers and their meshes. All trees
+    # cover the same area, so their cells line up across layers.
+    present = []
+    meshes = []
+    for layer in used_layers(index, stack):
+        mesh = build_adaptive_mesh(index, finest_spacing, coarse_spacing, progress, layer)
+        if (mesh.leaf_values() >= 0).any():
+            present.append(layer)
+            meshes.append(mesh)
+    return present, meshes
+
+
+def _leaf_offsets(meshes):
+    return np.cumsum([0] + [mesh.leaf_count() for mesh in meshes])
+
+
+def mesh_barrel_edges(index, stack, present, meshes, node_index):
+    # vertical resistors of every via and plated hole between the leaves its center is in on
+    # consecutive layers, as (src, dst, conductance) node arrays
+    geometry = index.geometry
+    offsets = _leaf_offsets(meshes)
+    src, dst, conductance = [], [], []
+    for kind, item, mask_function, drill in _barrels(geometry):
+        planes = [k for k, layer in enumerate(present) if geometry.on_layer(kind, layer)[item]]
+        x, y = geometry.pad_position[item] if kind == PAD else geometry.track_start[item]
+        nodes = {}
+        for k in planes:
+            leaf = int(meshes[k].locate(np.array([x]), np.array([y]))[0])
+            nodes[k] = node_index[offsets[k] + leaf] if leaf >= 0 else -1
+        for a, b in zip(planes[:-1], planes[1:]):
+            na, nb = nodes[a], nodes[b]
+            if na >= 0 and nb >= 0 and na != nb:
+                height = stack.depth(present[b]) - stack.depth(present[a])
+                src.append(na)
+                dst.append(nb)
+                conductance.append(1.0 / barrel_resistance(drill, height))
+    return np.array(src, dtype=np.int64), np.array(dst, dtype=np.int64), np.array(conductance, dtype=np.float64)
+
+
+def solve_adaptive(index, stack, present, meshes, pad_currents, source_pad, source_voltage, sheet_resistances,
+                   gradient_rounds=2, gradient_tolerance=0.02, progress=None, backend='native', pad_names=None):
+    # solve on the meshes of the layers, then split cells across which the voltage drops by
+    # more than gradient_tolerance of the total drop and solve again. Returns the voltage of
+    # every leaf of every mesh, in mesh order (NaN off the net and on copper without a path to
+    # the source).
+    if progress is None:
+        progress = Progress()
+
+    for round in range(gradient_rounds + 1):
+        progress.stage("Building network")
+        offsets = _leaf_offsets(meshes)
+        values = np.concatenate([mesh.leaf_values() for mesh in meshes])
+        node_index, pad_nodes, n_nodes = build_node_index(values, named_pads(pad_currents, source_pad))
+
+        # (layer, i, j) of every node, in cells of the finest level
+        positions = np.zeros((n_nodes, 3), dtype=np.int64)
+        for k, mesh in enumerate(meshes):
+            nodes = node_index[offsets[k]:offsets[k + 1]]
+            on_net = nodes >= 0
+            positions[nodes[on_net], 0] = k
+            positions[nodes[on_net], 1:] = mesh.leaf_positions()[on_net]
+
+        # refining doesn't change the islands, they're only warned about once
+        def describe_node(node):
+            layer, i, j = positions[node]
+            x = meshes[layer].corner_x + (i + 0.5) * meshes[layer].finest_spacing
+            y = meshes[layer].corner_y + (j + 0.5) * meshes[layer].finest_spacing
+            return "({:.2f}, {:.2f}) mm on {}".format(x / 1e6, y / 1e6, stack.name(present[layer]))
+
+        a, b, conductance = [], [], []
+        for k, mesh in enumerate(meshes):
+            mesh_a, mesh_b, squares = mesh.edges()
+            a.append(mesh_a + offsets[k])
+            b.append(mesh_b + offsets[k])
+            conductance.append(squares / sheet_resistances[k])
+        a = np.concatenate(a)
+        b = np.concatenate(b)
+        conductance = np.concatenate(conductance)
+        na = node_index[a]
+        nb = node_index[b]
+        keep = (na >= 0) & (nb >= 0) & (na != nb)
+        a, b, na, nb, conductance = a[keep], b[keep], na[keep], nb[keep], conductance[keep]
+
+        barrel_src, barrel_dst, barrel_conductance = mesh_barrel_edges(index, stack, present, meshes, node_index)
+        node_voltages = solve_network(n_nodes, np.concatenate([na, barrel_src]), np.concatenate([nb, barrel_dst]),
+                                      np.concatenate([conductance, barrel_conductance]), pad_nodes,
+                                      pad_currents, source_pad, source_voltage, progress=progress,
+                                      backend=backend, pad_names=pad_names, node_positions=positions,
+                                      describe_node=describe_node, warn=round == 0)
+
+        if round == gradient_rounds:
+            break
+
+        total_drop = source_voltage - np.nanmin(node_voltages)
+        steep = np.abs(node_voltages[na] - node_voltages[nb]) > gradient_tolerance * total_drop
+        if total_drop <= 0 or not steep.any():
+            break
+        progress.stage("Refining mesh")
+        leaves = np.concatenate([a[steep], b[steep]])
+        split = 0
+        for k, mesh in enumerate(meshes):
+            mine = leaves[(leaves >= offsets[k]) & (leaves < offsets[k + 1])] - offsets[k]
+            if len(mine) > 0 and mesh.split_leaves(mine) > 0:
+                split += 1
+                mesh.balance()
+                mesh.update_values(progress)
+        if split == 0:
+            break
+
+    leaf_voltages = np.full(len(values), np.nan)
+    on_net = node_index >= 0
+    leaf_voltages[on_net] = node_voltages[node_index[on_net]]
+    return leaf_voltages
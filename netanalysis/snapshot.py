@@ -0,0 +1,205 @@
+# coding: utf-8
+
+# Power Net Analyzer for KiCad - copper snapshots of pcbnew boards
+#
+# The only module that talks to pcbnew. Every pad, track and zone of a net is read once,
+# crossing into KiCad's C++ a handful of times per item, and stored in a NetGeometry of plain
+# arrays. The rest of the analysis only ever sees those arrays.
+
+import numpy as np
+import pcbnew
+
+from netanalysis.geometry import NetGeometry, PAD_CIRCLE, PAD_RECT, PAD_OVAL, PAD_ROUNDRECT, PAD_POLYGON
+from netanalysis.core import NetCopper
+from netanalysis.solver import AnalysisError
+
+# pad shapes the rasterizer handles analytically, the rest become polygons
+_PAD_SHAPES = {
+    pcbnew.PAD_SHAPE_CIRCLE: PAD_CIRCLE,
+    pcbnew.PAD_SHAPE_RECT: PAD_RECT,
+    pcbnew.PAD_SHAPE_OVAL: PAD_OVAL,
+    pcbnew.PAD_SHAPE_ROUNDRECT: PAD_ROUNDRECT,
+}
+
+
+def load_board(filename):
+    return pcbnew.LoadBoard(filename)
+
+
+def pad_name(pad):
+    return "{}-Pad{}".format(pad.GetParent().GetReference(), pad.GetPadName())
+
+
+def polygon_edges(poly_set):
+    # (x0, y0, x1, y1) edges of every outline and hole of a SHAPE_POLY_SET
+    edges = []
+    for n in range(poly_set.OutlineCount()):
+        chains = [poly_set.Outline(n)]
+        chains += [poly_set.Hole(n, h) for h in range(poly_set.HoleCount(n))]
+        for chain in chains:
+            count = chain.PointCount()
+            if count < 3:
+                continue
+            points = np.array([(chain.CPoint(k).x, chain.CPoint(k).y) for k in range(count)], dtype=np.float64)
+            edges.append(np.hstack([points, np.roll(points, -1, axis=0)]))
+
+    if len(edges) == 0:
+        return np.zeros((0, 4))
+    return np.vstack(edges)
+
+
+def _pad_polygon(pad):
+    poly_set = pcbnew.SHAPE_POLY_SET()
+    try:
+        pad.TransformShapeWithClearanceToPolygon(poly_set, 0)
+    except TypeError:
+        # KiCad 5.0 wants the segments per circle and the correction factor
+        pad.TransformShapeWithClearanceToPolygon(poly_set, 0, 32, 1.0)
+    return polygon_edges(poly_set)
+
+
+def _box(box):
+    # EDA_RECT as (x0, y0, x1, y1)
+    x0, x1 = sorted((box.GetX(), box.GetX() + box.GetWidth()))
+    y0, y1 = sorted((box.GetY(), box.GetY() + box.GetHeight()))
+    return (x0, y0, x1, y1)
+
+
+def snapshot_net(netname, pads, tracks, zones, layers):
+    # NetGeometry of the given pcbnew items. layers are the copper layers to record, usually
+    # the board's whole copper stack.
+    geometry = NetGeometry(netname, layers)
+
+    def on_layers(item):
+        return [item.IsOnLayer(layer) for layer in geometry.layers]
+
+    shapes, positions, offsets, sizes, orientations, radii, drills, polygons, boxes, pad_layers = \
+        [], [], [], [], [], [], [], [], [], []
+    for pad in pads:
+        shape = _PAD_SHAPES.get(pad.GetShape(), PAD_POLYGON)
+        position = pad.GetPosition()
+        offset = pad.GetOffset()
+        size = pad.GetSize()
+        plated = pad.GetAttribute() == pcbnew.PAD_ATTRIB_STANDARD
+        geometry.pad_names.append(pad_name(pad))
+        shapes.append(shape)
+        positions.append((position.x, position.y))
+        offsets.append((offset.x, offset.y))
+        sizes.append((size.x, size.y))
+        orientations.append(pad.GetOrientation() / 10.0)
+        radii.append(pad.GetRoundRectCornerRadius() if shape == PAD_ROUNDRECT else 0)
+        drills.append(pad.GetDrillSize().x if plated else 0)
+        polygons.append(_pad_polygon(pad) if shape == PAD_POLYGON else None)
+        boxes.append(_box(pad.GetBoundingBox()))
+        pad_layers.append(on_layers(pad))
+
+    if len(pads) > 0:
+        geometry.pad_shape = np.array(shapes, dtype=np.int8)
+        geometry.pad_position = np.array(positions, dtype=np.float64)
+        geometry.pad_offset = np.array(offsets, dtype=np.float64)
+        geometry.pad_size = np.array(sizes, dtype=np.float64)
+        geometry.pad_orientation = np.array(orientations, dtype=np.float64)
+        geometry.pad_corner_radius = np.array(radii, dtype=np.float64)
+        geometry.pad_drill = np.array(drills, dtype=np.float64)
+        geometry.pad_polygons = polygons
+        geometry.pad_box = np.array(boxes, dtype=np.int64)
+        geometry.pad_layers = np.array(pad_layers, dtype=bool).reshape(len(pads), len(geometry.layers))
+
+    starts, ends, widths, drills, boxes, track_layers = [], [], [], [], [], []
+    for track in tracks:
+        start = track.GetStart()
+        end = track.GetEnd()
+        starts.append((start.x, start.y))
+        ends.append((end.x, end.y))
+        widths.append(track.GetWidth())
+        drills.append(pcbnew.Cast_to_VIA(track).GetDrillValue() if track.Type() == pcbnew.PCB_VIA_T else 0)
+        boxes.append(_box(track.GetBoundingBox()))
+        track_layers.append(on_layers(track))
+
+    if len(starts) > 0:
+        geometry.track_start = np.array(starts, dtype=np.float64)
+        geometry.track_end = np.array(ends, dtype=np.float64)
+        geometry.track_width = np.array(widths, dtype=np.float64)
+        geometry.track_drill = np.array(drills, dtype=np.float64)
+        geometry.track_box = np.array(boxes, dtype=np.int64)
+        geometry.track_layers = np.array(track_layers, dtype=bool).reshape(len(starts), len(geometry.layers))
+
+    boxes, zone_layers = [], []
+    for zone in zones:
+        # unfilled zones carry no copper. Zones are bounded by their fill, which can be much
+        # smaller than their outline.
+        fill = zone.GetFilledPolysList()
+        if fill.OutlineCount() == 0:
+            continue
+        geometry.zone_edges.append(polygon_edges(fill))
+        boxes.append(_box(fill.BBox()))
+        zone_layers.append(on_layers(zone))
+
+    if len(boxes) > 0:
+        geometry.zone_box = np.array(boxes, dtype=np.int64)
+        geometry.zone_layers = np.array(zone_layers, dtype=bool).reshape(len(boxes), len(geometry.layers))
+
+    return geometry
+
+
+class BoardIndex(object):
+    # pads, tracks and zones of every net of a board keyed on net code, sorted out in a single
+    # pass over the board instead of scanning every pad of the board for each net. The board's
+    # item counts are checked on every lookup and the index is rebuilt when they changed, so
+    # items added or deleted while the plugin is open are picked up. Items moved to another
+    # net leave the counts alone: a lookup checks the net codes of the net's own items, which
+    # catches items moved off the net, and callers invalidate the index before an analysis to
+    # catch items moved onto it.
+    def __init__(self, board):
+        self.board = board
+        self._signature = None
+        self._items = {}    # net code -> ([pad, ...], [track, ...], [zone, ...])
+
+    def _board_signature(self):
+        board = self.board
+        return (board.GetPadCount(), board.GetNumSegmTrack(), board.GetAreaCount())
+
+    def invalidate(self):
+        # rebuild on the next lookup, for changes that keep the item counts
+        self._signature = None
+
+    def refresh(self):
+        # rebuild the index if the board changed, returns whether it did
+        signature = self._board_signature()
+        if signature == self._signature:
+            return False
+
+        items = {}
+
+        def add(kind, item):
+            items.setdefault(item.GetNetCode(), ([], [], []))[kind].append(item)
+
+        for pad in self.board.GetPads():
+            add(0, pad)
+        for track in self.board.GetTracks():
+            add(1, track)
+        for i in range(self.board.GetAreaCount()):
+            add(2, self.board.GetArea(i))
+
+        self._items = items
+        self._signature = signature
+        return True
+
+    def _net_items(self, code):
+        return self._items.get(code, ([], [], []))
+
+    def collect(self, netname):
+        # a fresh snapshot of the copper of a net, so moved items and zone refills are seen
+        self.refresh()
+        net = self.board.FindNet(netname)
+        if net is None:
+            raise AnalysisError("Net {} is not on the board".format(netname))
+        code = net.GetNet()
+        pads, tracks, zones = self._net_items(code)
+        if any(item.GetNetCode() != code for items in (pads, tracks, zones) for item in items):
+            self.invalidate()
+            self.refresh()
+            pads, tracks, zones = self._net_items(code)
+        layers = list(self.board.GetEnabledLayers().CuStack())
+        return NetCopper(snapshot_net(netname, pads, tracks, zones, layers))
+
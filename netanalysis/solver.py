@@ -0,0 +1,452 @@
+# coding: utf-8
+
+# Power Net Analyzer for KiCad - DC IR-drop solvers
+#
+# The grid of copper nodes is a resistor lattice, so a DC operating point is a sparse
+# Laplacian solve. The native backend assembles and solves it with SciPy; the ngspice
+# backend writes the same lattice as a netlist and is kept as a cross-check.
+
+import re
+import threading
+
+import numpy as np
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
+from scipy.sparse.csgraph import connected_components
+
+from netanalysis.raster import OFF_NET
+from netanalysis.progress import Progress, AnalysisCancelled, REPORT_INTERVAL
+from netanalysis.netlist import netlist_lines, spice_node
+from netanalysis.spicepool import SpiceError
+from netanalysis.multigrid import MultigridSolver
+
+# conductance from every node to ground, like ngspice's gmin, so floating copper doesn't
+# make the matrix singular
+GMIN = 1e-12
+
+# above this many unknowns the direct solver's fill-in gets too large, use multigrid (or
+# plain CG for networks without node positions) instead
+DIRECT_SOLVE_LIMIT = 500000
+
+SOLVE_METHODS = ('direct', 'cg', 'multigrid')
+
+# floating islands are warned about one by one up to this many, the rest are summed up
+MAX_ISLAND_WARNINGS = 10
+
+# SpicePool the ngspice backend hands its networks to, or None to run ngspice in this process
+_spice_pool = None
+
+
+# a SPICE number: mantissa, optional scale factor and any trailing unit letters
+_SPICE_NUMBER = re.compile(r'^\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:e[-+]?\d+)?)(meg|mil|[tgkmunpf])?[a-z]*\s*$', re.IGNORECASE)
+_SCALE_FACTORS = {'meg': 1e6, 'mil': 25.4e-6, 't': 1e12, 'g': 1e9, 'k': 1e3, 'm': 1e-3,
+                  'u': 1e-6, 'n': 1e-9, 'p': 1e-12, 'f': 1e-15}
+
+
+class AnalysisError(Exception):
+    pass
+
+
+def set_spice_pool(pool):
+    # run ngspice analyses in a pool of worker processes (None: in this process)
+    global _spice_pool
+    _spice_pool = pool
+
+
+def spice_number(text):
+    # parse a value the way SPICE would, e.g. "1.5", "500m" or "2A"
+    match = _SPICE_NUMBER.match(str(text))
+    if match is None:
+        raise ValueError("Not a number: {}".format(text))
+    mantissa, scale = match.groups()
+    return float(mantissa) * (_SCALE_FACTORS[scale.lower()] if scale else 1.0)
+
+
+def named_pads(pad_currents, source_pad):
+    # pads with a nonzero current draw or that are the source are a single node
+    return [current != 0 or index == source_pad for index, current in enumerate(pad_currents)]
+
+
+def build_node_index(node_map, pad_is_named):
+    # number the nodes of the grid: -1 off the net, named pads share one index per pad
+    node_index = np.full(node_map.shape, -1, dtype=np.int32)
+    pad_nodes = {}
+
+    on_net = node_map != OFF_NET
+    merged = np.zeros(node_map.shape, dtype=bool)
+    for pad, named in enumerate(pad_is_named):
+        if named:
+            cells = node_map == pad + 1
+            if cells.any():
+                merged |= cells
+
+    free = on_net & ~merged
+    n_nodes = int(np.count_nonzero(free))
+    node_index[free] = np.arange(n_nodes, dtype=np.int32)
+
+    for pad, named in enumerate(pad_is_named):
+        if named:
+            cells = node_map == pad + 1
+            if cells.any():
+                node_index[cells] = n_nodes
+                pad_nodes[pad] = n_nodes
+                n_nodes += 1
+
+    return node_index, pad_nodes, n_nodes
+
+
+def grid_edges(node_index):
+    # each pair of neighbouring on-net cells, once, as (src, dst) node arrays
+    src = []
+    dst = []
+    for a, b in ((node_index[:-1, :], node_index[1:, :]), (node_index[:, :-1], node_index[:, 1:])):
+        keep = (a >= 0) & (b >= 0) & (a != b)
+        src.append(a[keep])
+        dst.append(b[keep])
+    return np.concatenate(src), np.concatenate(dst)
+
+
+def conductance_matrix(n_nodes, src, dst, conductance):
+    # nodal conductance matrix of a resistor network given as edge arrays
+    rows = np.concatenate([src, dst, src, dst])
+    cols = np.concatenate([dst, src, src, dst])
+    vals = np.concatenate([-conductance, -conductance, conductance, conductance])
+    matrix = sp.coo_matrix((vals, (rows, cols)), shape=(n_nodes, n_nodes)).tocsr()
+    return matrix + GMIN * sp.identity(n_nodes, format='csr')
+
+
+def load_vector(n_nodes, pad_nodes, pad_currents):
+    # current sources draw their current out of the load pad nodes
+    check_missing_loads(pad_nodes, pad_currents)
+    rhs = np.zeros(n_nodes)
+    for pad, current in enumerate(pad_currents):
+        if current != 0:
+            rhs[pad_nodes[pad]] -= current
+    return rhs
+
+
+def eliminate_source(matrix, source):
+    # the source node is fixed: drop its row and column. Returns the unknown node mask, the
+    # reduced matrix and the source column, which times the source voltage moves to the right
+    # hand side.
+    unknown = np.ones(matrix.shape[0], dtype=bool)
+    unknown[source] = False
+    reduced = matrix[unknown][:, unknown].tocsc()
+    source_column = matrix[unknown][:, source].toarray().ravel()
+    return unknown, reduced, source_column
+
+
+def cell_voltages(node_index, node_voltages, dtype=np.float64):
+    # voltage of every cell of a node index in one gather, NaN for off-net cells
+    voltages = np.append(node_voltages, np.nan).astype(dtype)
+    return voltages[node_index]
+
+
+def prune_floating(n_nodes, src, dst, conductance, pad_nodes, source_pad):
+    # drop the copper that has no path to the source. It carries no current, and only GMIN
+    # would hold it to a voltage. Returns the mask of the kept nodes, the network of the kept
+    # nodes numbered in their original order and the removed islands as arrays of their nodes.
+    adjacency = sp.coo_matrix((np.ones(len(src), dtype=np.int8), (src, dst)), shape=(n_nodes, n_nodes))
+    n_components, labels = connected_components(adjacency, directed=False)
+    kept = labels == labels[pad_nodes[source_pad]]
+    if kept.all():
+        return kept, (n_nodes, src, dst, conductance, pad_nodes), []
+
+    removed = np.nonzero(~kept)[0]
+    order = np.argsort(labels[removed], kind='stable')
+    removed = removed[order]
+    starts = np.nonzero(np.diff(labels[removed]))[0] + 1
+    islands = np.split(removed, starts)
+
+    renumber = np.cumsum(kept) - 1
+    edges = kept[src]       # an edge's nodes are both kept or both removed
+    network = (int(np.count_nonzero(kept)), renumber[src[edges]].astype(src.dtype),
+               renumber[dst[edges]].astype(dst.dtype), conductance[edges],
+               dict((pad, int(renumber[node])) for pad, node in pad_nodes.items() if kept[node]))
+    return kept, network, islands
+
+
+def _pad_list(pads, pad_names):
+    return ", ".join(pad_names[pad] if pad_names is not None else "pad{}".format(pad) for pad in pads)
+
+
+def check_missing_loads(pad_nodes, pad_currents, pad_names=None):
+    # a load without a node, e.g. a pad smaller than the grid spacing, would silently draw
+    # nothing, the analysis can't go on
+    missing = [pad for pad, current in enumerate(pad_currents) if current != 0 and pad not in pad_nodes]
+    if len(missing) > 0:
+        raise AnalysisError("Load pads not on the analysis grid: {}".format(_pad_list(missing, pad_names)))
+
+
+def check_floating_loads(kept, pad_nodes, pad_currents, pad_names=None):
+    # a load on an island has no path for its current, the analysis can't go on
+    floating = [pad for pad, current in enumerate(pad_currents)
+                if current != 0 and pad in pad_nodes and not kept[pad_nodes[pad]]]
+    if len(floating) > 0:
+        raise AnalysisError("Load pads not connected to the source: {}".format(_pad_list(floating, pad_names)))
+
+
+def warn_islands(progress, islands, describe_node=None):
+    # one warning per island with its size and a location, largest first
+    islands = sorted(islands, key=len, reverse=True)
+    progress.record('islands', len(islands))
+    progress.record('island_nodes', sum(len(island) for island in islands))
+    for island in islands[:MAX_ISLAND_WARNINGS]:
+        where = "" if describe_node is None else " at {}".format(describe_node(int(island[0])))
+        progress.warn("Copper island of {} node{}{} is not connected to the source".format(
+            len(island), "" if len(island) == 1 else "s", where))
+    if len(islands) > MAX_ISLAND_WARNINGS:
+        rest = islands[MAX_ISLAND_WARNINGS:]
+        progress.warn("{} more copper islands of {} nodes are not connected to the source".format(
+            len(rest), sum(len(island) for island in rest)))
+
+
+def prune_network(n_nodes, src, dst, conductance, pad_nodes, pad_currents, source_pad, progress, pad_names=None,
+                  describe_node=None, warn=True):
+    # prune_floating() with the loads checked for a node and the islands checked for loads
+    # and warned about
+    check_missing_loads(pad_nodes, pad_currents, pad_names)
+    kept, network, islands = prune_floating(n_nodes, src, dst, conductance, pad_nodes, source_pad)
+    if len(islands) > 0:
+        check_floating_loads(kept, pad_nodes, pad_currents, pad_names)
+        if warn:
+            warn_islands(progress, islands, describe_node)
+    return kept, network
+
+
+def expand_voltages(kept, node_voltages):
+    # voltages of a pruned network back in the original numbering, NaN on the islands
+    expanded = np.full(node_voltages.shape[:-1] + kept.shape, np.nan)
+    expanded[..., kept] = node_voltages
+    return expanded
+
+
+class FactoredNetwork(object):
+    # a resistor network with the source node eliminated and the rest LU factored once. Every
+    # solve after that is only a forward and back substitution, so sweeping load currents or
+    # the source voltage costs about one factorization in total. The pads that may draw
+    # current must be named (single nodes) when the network is built.
+    def __init__(self, n_nodes, src, dst, conductance, pad_nodes, source_pad, pad_is_named=None,
+                 progress=None):
+        if progress is None:
+            progress = Progress()
+        if source_pad not in pad_nodes:
+            raise AnalysisError("Source pad is not on the analysis grid")
+
+        self.n_nodes = n_nodes
+        self.pad_nodes = pad_nodes
+        self.pad_is_named = pad_is_named
+        self.source = pad_nodes[source_pad]
+
+        matrix = conductance_matrix(n_nodes, src, dst, conductance)
+        self.unknown, reduced, self.source_column = eliminate_source(matrix, self.source)
+
+        # SuperLU can't be interrupted, cancelling takes effect once it returns
+        progress.check()
+        self.lu = spla.splu(reduced)
+        progress.check()
+
+    def _rhs(self, pad_currents, source_voltage):
+        if self.pad_is_named is not None:
+            for pad, current in enumerate(pad_currents):
+                if current != 0 and not self.pad_is_named[pad]:
+                    raise ValueError("Pad {} was not a load when the network was factored".format(pad))
+        rhs = load_vector(self.n_nodes, self.pad_nodes, pad_currents)
+        return rhs[self.unknown] - self.source_column * source_voltage
+
+    def solve(self, pad_currents, source_voltage):
+        return self.solve_many([pad_currents], [source_voltage])[0]
+
+    def solve_many(self, current_sets, source_voltages):
+        # voltage of every node for every (currents, source voltage) pair, as one row each.
+        # All right hand sides go through the factorization in a single call.
+        rhs = np.column_stack([self._rhs(currents, voltage)
+                               for currents, voltage in zip(current_sets, source_voltages)])
+        node_voltages = np.empty((rhs.shape[1], self.n_nodes))
+        node_voltages[:, self.unknown] = self.lu.solve(rhs).T
+        node_voltages[:, self.source] = source_voltages
+        return node_voltages
+
+
+def solve_network(n_nodes, src, dst, conductance, pad_nodes, pad_currents, source_pad, source_voltage,
+                  method='auto', progress=None, backend='native', pad_names=None, node_positions=None,
+                  describe_node=None, warn=True, initial_voltages=None):
+    # voltage of every node of a resistor network driven by the source and load pads, NaN for
+    # copper without a path to the source. node_positions, (layer, i, j) of every node on the
+    # analysis grid, enables the multigrid method (see netanalysis.multigrid.node_positions).
+    # Islands are warned about unless warn is False, describe_node(node) says where a node is
+    # on the board. initial_voltages, a guess of every node's voltage (NaN where there is
+    # none), warm starts the iterative methods.
+    if progress is None:
+        progress = Progress()
+    if source_pad not in pad_nodes:
+        raise AnalysisError("Source pad is not on the analysis grid")
+
+    kept, network = prune_network(n_nodes, src, dst, conductance, pad_nodes, pad_currents, source_pad, progress,
+                                  pad_names, describe_node, warn)
+    n_connected, src, dst, conductance, connected_pads = network
+    if node_positions is not None and n_connected < n_nodes:
+        node_positions = np.asarray(node_positions)[kept]
+    if initial_voltages is not None and n_connected < n_nodes:
+        initial_voltages = np.asarray(initial_voltages)[kept]
+
+    if backend == 'ngspice':
+        node_voltages = solve_network_ngspice(n_connected, src, dst, conductance, connected_pads, pad_currents,
+                                              source_pad, source_voltage, pad_names, progress)
+    elif backend == 'native':
+        node_voltages = _solve_native(n_connected, src, dst, conductance, connected_pads, pad_currents,
+                                      source_pad, source_voltage, method, progress, node_positions,
+                                      initial_voltages)
+    else:
+        raise ValueError("Unknown backend: {}".format(backend))
+    return node_voltages if n_connected == n_nodes else expand_voltages(kept, node_voltages)
+
+
+def _solve_native(n_nodes, src, dst, conductance, pad_nodes, pad_currents, source_pad, source_voltage, method,
+                  progress, node_positions, initial_voltages=None):
+    if method == 'auto':
+        # a direct solve can't use a good guess, multigrid converges from it in a few iterations
+        warm_multigrid = initial_voltages is not None and node_positions is not None
+        if n_nodes - 1 <= DIRECT_SOLVE_LIMIT and not warm_multigrid:
+            method = 'direct'
+        else:
+            method = 'cg' if node_positions is None else 'multigrid'
+
+    if method not in SOLVE_METHODS:
+        raise ValueError("Unknown solve method: {}".format(method))
+    if method == 'multigrid' and node_positions is None:
+        raise ValueError("The multigrid method needs the node positions")
+
+    progress.stage("Solving ({})".format(method))
+    progress.record('nodes', n_nodes)
+    progress.record('edges', len(src))
+
+    if method == 'direct':
+        network = FactoredNetwork(n_nodes, src, dst, conductance, pad_nodes, source_pad, progress=progress)
+        return network.solve(pad_currents, source_voltage)
+
+    matrix = conductance_matrix(n_nodes, src, dst, conductance)
+    source = pad_nodes[source_pad]
+    unknown, reduced, source_column = eliminate_source(matrix, source)
+    rhs = load_vector(n_nodes, pad_nodes, pad_currents)[unknown] - source_column * source_voltage
+    if initial_voltages is None:
+        x0 = np.full(len(rhs), float(source_voltage))
+    else:
+        x0 = np.asarray(initial_voltages, dtype=np.float64)[unknown]
+        x0 = np.where(np.isnan(x0), float(source_voltage), x0)
+
+    if method == 'multigrid':
+        solution = _solve_multigrid(reduced, rhs, x0, np.asarray(node_positions)[unknown], progress)
+        return _with_source(solution, unknown, source, source_voltage)
+
+    # Jacobi preconditioned conjugate gradient, the matrix is symmetric positive definite.
+    # The callback runs every iteration, so cancelling stops the solve right away.
+    preconditioner = sp.diags(1.0 / reduced.diagonal())
+    iterations = [0]
+
+    def iteration(x):
+        iterations[0] += 1
+        progress.update()
+
+    solution, info = spla.cg(reduced, rhs, x0=x0,
+                             rtol=1e-10, maxiter=20 * reduced.shape[0], M=preconditioner, callback=iteration)
+    progress.record('iterations', iterations[0])
+    if info != 0:
+        raise AnalysisError("Iterative solver did not converge")
+    return _with_source(solution, unknown, source, source_voltage)
+
+
+def _solve_multigrid(matrix, rhs, x0, positions, progress):
+    multigrid = MultigridSolver(matrix, positions)
+    progress.record('levels', multigrid.n_levels)
+    progress.check()
+    try:
+        solution, iterations = multigrid.solve(rhs, x0=x0, progress=progress)
+    except ArithmeticError as error:
+        raise AnalysisError(str(error))
+    progress.record('iterations', iterations)
+    return solution
+
+
+def _with_source(solution, unknown, source, source_voltage):
+    # every node's voltage from the solution for the unknown nodes
+    node_voltages = np.empty(len(unknown))
+    node_voltages[unknown] = solution
+    node_voltages[source] = source_voltage
+    return node_voltages
+
+
+def solve_network_ngspice(n_nodes, src, dst, conductance, pad_nodes, pad_currents, source_pad, source_voltage,
+                          pad_names=None, progress=None):
+    # the same network solved by ngspice, to cross-check the native solver
+    if progress is None:
+        progress = Progress()
+    if pad_names is None:
+        pad_names = ["pad{}".format(pad) for pad in range(len(pad_currents))]
+
+    if _spice_pool is not None:
+        progress.stage("Solving (ngspice pool)")
+        progress.record('nodes', n_nodes)
+        progress.record('edges', len(src))
+        try:
+            return _spice_pool.solve(n_nodes, src, dst, conductance, pad_nodes, pad_names, pad_currents,
+                                     source_pad, source_voltage, progress)
+        except SpiceError as error:
+            raise AnalysisError(str(error))
+
+    from lyngspice.lyngspice import NgSpice
+
+    # run in ngspice's background thread so a cancel can halt it. The thread callback fires
+    # when the background thread starts and again when it stops.
+    transitions = []
+    changed = threading.Event()
+
+    def thread_callback(is_running, lib_id):
+        transitions.append(is_running)
+        changed.set()
+        return 0
+
+    ng = NgSpice()
+    ng.set_thread_callback(thread_callback)
+
+    # the netlist goes straight from the edge arrays to a file ngspice sources
+    progress.stage("Writing netlist")
+    error, n_bytes, n_lines = ng.source_lines(netlist_lines(src, dst, conductance, pad_nodes, pad_names,
+                                                            pad_currents, source_pad, source_voltage))
+    print("    - Netlist: {} lines, {:.1f} MB".format(n_lines, n_bytes / 1e6))
+    progress.record('netlist_lines', n_lines)
+    progress.record('netlist_bytes', n_bytes)
+    if error:
+        raise AnalysisError("ngspice could not load the netlist")
+
+    progress.stage("Solving (ngspice)")
+    progress.record('nodes', n_nodes)
+    progress.record('edges', len(src))
+    if ng.bg_run():
+        raise AnalysisError("ngspice could not start the analysis")
+
+    while len(transitions) < 2:
+        changed.wait(REPORT_INTERVAL)
+        changed.clear()
+        if progress.cancelled:
+            ng.bg_halt()
+            raise AnalysisCancelled("Analysis cancelled")
+        progress.update()
+
+    # only the nodes in the netlist have a voltage, floating cells without any resistor are NaN
+    progress.stage("Reading voltages")
+    in_netlist = np.zeros(n_nodes, dtype=bool)
+    in_netlist[src] = True
+    in_netlist[dst] = True
+    in_netlist[list(pad_nodes.values())] = True
+    nodes = np.nonzero(in_netlist)[0]
+
+    # fetch just those voltages, copied out before ng (and the memory it owns) goes away
+    names = [spice_node(node) for node in nodes.tolist()]
+    op = ng.get_vectors("op1", names, copy=True)
+    if len(op) != len(names):
+        raise AnalysisError("ngspice did not solve every node of the netlist")
+    node_voltages = np.full(n_nodes, np.nan)
+    node_voltages[nodes] = np.concatenate([op[name] for name in names])
+    return node_voltages
+
@@ -0,0 +1,94 @@
+# coding: utf-8
+
+# Power Net Analyzer for KiCad - spatial index of a net's copper
+#
+# A uniform grid of buckets keyed on bounding boxes. Every pad, track and zone of the net is
+# registered in each bucket its bounding box touches, so region queries only look at the few
+# objects near them. The index works on the bounding boxes of a NetGeometry and keeps the
+# geometry with it for the rasterizers.
+
+import numpy as np
+
+PAD = 'pad'
+TRACK = 'track'
+ZONE = 'zone'
+
+# default bucket size (units: nanometers)
+DEFAULT_BUCKET_SIZE = 1000000 # 1 mm
+
+
+class SpatialIndex(object):
+    def __init__(self, geometry, bucket_size=DEFAULT_BUCKET_SIZE):
+        self.geometry = geometry
+        self.bucket_size = bucket_size
+        self._boxes = []   # (x0, y0, x1, y1) of every entry
+        self._entries = [] # (kind, index of the item in the geometry) of every entry
+        self._buckets = {}
+
+    @classmethod
+    def from_geometry(cls, geometry, bucket_size=DEFAULT_BUCKET_SIZE):
+        index = cls(geometry, bucket_size)
+        for kind in (PAD, TRACK, ZONE):
+            for i, box in enumerate(geometry.boxes(kind).tolist()):
+                index.insert(kind, i, box)
+        return index
+
+    def insert(self, kind, i, box):
+        x0, y0, x1, y1 = box
+        entry = len(self._entries)
+        self._entries.append((kind, i))
+        self._boxes.append((x0, y0, x1, y1))
+
+        for key in self._bucket_keys(x0, y0, x1, y1):
+            self._buckets.setdefault(key, []).append(entry)
+
+    def _bucket_keys(self, x0, y0, x1, y1):
+        size = self.bucket_size
+        for bx in range(int(x0 // size), int(x1 // size) + 1):
+            for by in range(int(y0 // size), int(y1 // size) + 1):
+                yield (bx, by)
+
+    def bounds(self):
+        # union bounding box of everything in the index, or None if it is empty
+        if len(self._boxes) == 0:
+            return None
+        boxes = np.array(self._boxes)
+        return (int(boxes[:, 0].min()), int(boxes[:, 1].min()), int(boxes[:, 2].max()), int(boxes[:, 3].max()))
+
+    def query_box(self, x0, y0, x1, y1, kinds=(PAD, TRACK, ZONE)):
+        # objects whose bounding box overlaps the region, as {kind: [index, ...]} in insertion order
+        candidates = set()
+        for key in self._bucket_keys(x0, y0, x1, y1):
+            candidates.update(self._buckets.get(key, ()))
+
+        found = dict((kind, []) for kind in kinds)
+        for entry in sorted(candidates):
+            bx0, by0, bx1, by1 = self._boxes[entry]
+            kind, index = self._entries[entry]
+            if kind in found and bx0 <= x1 and x0 <= bx1 and by0 <= y1 and y0 <= by1:
+                found[kind].append(index)
+        return found
+
+    def query_point(self, x, y, kinds=(PAD, TRACK, ZONE)):
+        return self.query_box(x, y, x, y, kinds)
+
+    def hit_test(self, x, y):
+        # objects that actually cover the point, pads first, then tracks, then zone fills
+        from netanalysis.raster import AnalysisGrid, pad_mask, track_mask, polygon_mask
+
+        # a grid of just the point, so the rasterizers' shapes decide what covers it
+        point = AnalysisGrid.from_points([x], [y], 1)
+        found = self.query_point(x, y)
+        hits = []
+        for index in found[PAD]:
+            hit = pad_mask(self.geometry, index, point)
+            if hit is not None and hit[2].any():
+                hits.append((PAD, index))
+        for index in found[TRACK]:
+            hit = track_mask(self.geometry, index, point)
+            if hit is not None and hit[2].any():
+                hits.append((TRACK, index))
+        for index in found[ZONE]:
+            if polygon_mask(self.geometry.zone_edges[index], point).any():
+                hits.append((ZONE, index))
+        return hits
@@ -0,0 +1,251 @@
+# coding: utf-8
+
+# Power Net Analyzer for KiCad - pool of ngspice worker processes
+#
+# ngspice's shared library is global state, so one process can only simulate one circuit at a
+# time, and loading and initializing the library costs time on every analysis. A SpicePool
+# keeps worker processes with ngspice already attached and feeds them networks through
+# queues. Edge arrays go to the workers and node voltages come back through shared memory;
+# each worker writes its own netlist from the arrays, so no netlist text or Python lists
+# cross the process boundary. Workers reset ngspice every few runs to bound its leaks.
+#
+# This module doesn't import pcbnew, so the workers can be started from any Python.
+
+import collections
+import multiprocessing
+import traceback
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue   # Python 2 (KiCad 5)
+
+import numpy as np
+
+from netanalysis.netlist import netlist_lines, spice_node
+from netanalysis.progress import Progress, REPORT_INTERVAL
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+# runs before a worker reloads the ngspice library
+DEFAULT_RUNS_PER_RESET = 20
+
+
+class SpiceError(Exception):
+    pass
+
+
+def _layout(n_nodes, n_edges):
+    # offsets of src, dst, conductance and node voltages in a job's shared memory block, and
+    # its size. Every array starts on an 8 byte boundary.
+    src = 0
+    dst = src + 4 * n_edges
+    conductance = dst + 4 * n_edges
+    conductance += conductance % 8
+    voltages = conductance + 8 * n_edges
+    return src, dst, conductance, voltages, voltages + 8 * max(n_nodes, 1)
+
+
+def _arrays(buffer, n_nodes, n_edges):
+    src, dst, conductance, voltages, size = _layout(n_nodes, n_edges)
+    return (np.ndarray(n_edges, dtype=np.int32, buffer=buffer, offset=src),
+            np.ndarray(n_edges, dtype=np.int32, buffer=buffer, offset=dst),
+            np.ndarray(n_edges, dtype=np.float64, buffer=buffer, offset=conductance),
+            np.ndarray(n_nodes, dtype=np.float64, buffer=buffer, offset=voltages))
+
+
+def _simulate(ng, task):
+    job, memory_name, n_nodes, n_edges, pad_nodes, pad_names, pad_currents, source_pad, source_voltage = task
+    memory = shared_memory.SharedMemory(name=memory_name)
+    src, dst, conductance, voltages = _arrays(memory.buf, n_nodes, n_edges)
+    try:
+        error, n_bytes, n_lines = ng.source_lines(netlist_lines(src, dst, conductance, pad_nodes, pad_names,
+                                                                pad_currents, source_pad, source_voltage))
+        if error:
+            raise SpiceError("ngspice could not load the netlist")
+        if ng.command('run'):
+            raise SpiceError("ngspice could not run the analysis")
+
+        # nodes that aren't in the netlist (floating, without any resistor) are NaN
+        in_netlist = np.zeros(n_nodes, dtype=bool)
+        in_netlist[src] = True
+        in_netlist[dst] = True
+        in_netlist[list(pad_nodes.values())] = True
+        nodes = np.nonzero(in_netlist)[0]
+        names = [spice_node(node) for node in nodes.tolist()]
+
+        # the views into ngspice's memory are copied out before its plots are destroyed
+        op = ng.get_vectors("op1", names)
+        if len(op) != len(names):
+            raise SpiceError("ngspice did not solve every node of the netlist")
+        voltages[:] = np.nan
+        voltages[nodes] = np.concatenate([op[name] for name in names])
+        del op
+        ng.command('destroy all')
+    finally:
+        # the views have to go before the block can be closed
+        del src, dst, conductance, voltages
+        memory.close()
+
+
+def _serve(tasks, results, runs_per_reset):
+    # worker process: keep ngspice attached and simulate tasks until told to stop
+    from lyngspice.lyngspice import NgSpice
+
+    ng = NgSpice()
+    runs = 0
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        try:
+            _simulate(ng, task)
+        except Exception:
+            results.put((task[0], traceback.format_exc()))
+        else:
+            results.put((task[0], None))
+
+        runs += 1
+        if runs >= runs_per_reset:
+            ng.reset()
+            runs = 0
+
+
+class _Worker(object):
+    def __init__(self, context, results, runs_per_reset):
+        self.tasks = context.Queue()
+        self.process = context.Process(target=_serve, args=(self.tasks, results, runs_per_reset))
+        self.process.daemon = True
+        self.process.start()
+        self.job = None
+
+
+class SpicePool(object):
+    def __init__(self, processes=None, runs_per_reset=DEFAULT_RUNS_PER_RESET):
+        if shared_memory is None:
+            raise SpiceError("ngspice worker pools need Python 3.8 or newer")
+
+        # spawned, not forked: the parent may be running a GUI and other threads
+        self._context = multiprocessing.get_context('spawn')
+        self._results = self._context.Queue()
+        self._runs_per_reset = runs_per_reset
+        self._workers = [self._start_worker() for n in range(processes or multiprocessing.cpu_count())]
+
+        self._next_job = 0
+        self._pending = collections.deque()
+        self._jobs = {}         # job -> (shared memory, n_nodes, n_edges)
+        self._done = {}         # job -> error message or None
+        self._cancelled = set() # jobs whose worker was stopped, their result may still come
+
+    def _start_worker(self):
+        return _Worker(self._context, self._results, self._runs_per_reset)
+
+    def submit(self, n_nodes, src, dst, conductance, pad_nodes, pad_names, pad_currents, source_pad,
+               source_voltage):
+        # queue a network for simulation, returns a job to pass to result()
+        n_edges = len(src)
+        memory = shared_memory.SharedMemory(create=True, size=_layout(n_nodes, n_edges)[-1])
+        shared_src, shared_dst, shared_conductance, voltages = _arrays(memory.buf, n_nodes, n_edges)
+        shared_src[:] = src
+        shared_dst[:] = dst
+        shared_conductance[:] = conductance
+        del shared_src, shared_dst, shared_conductance, voltages
+
+        job = self._next_job
+        self._next_job += 1
+        self._jobs[job] = (memory, n_nodes, n_edges)
+        self._pending.append((job, memory.name, n_nodes, n_edges, dict(pad_nodes), list(pad_names),
+                              list(pad_currents), source_pad, float(source_voltage)))
+        self._dispatch()
+        return job
+
+    def _dispatch(self):
+        for worker in self._workers:
+            if worker.job is None and self._pending:
+                task = self._pending.popleft()
+                worker.job = task[0]
+                worker.tasks.put(task)
+
+    def _collect(self, timeout):
+        # take finished jobs off the result queue, waiting up to timeout for the first, and
+        # replace workers that died on their job
+        while True:
+            try:
+                job, error = self._results.get(timeout=timeout)
+            except queue.Empty:
+                break
+            timeout = 0
+            if job in self._cancelled:
+                self._cancelled.discard(job)
+                continue
+            self._done[job] = error
+            for worker in self._workers:
+                if worker.job == job:
+                    worker.job = None
+
+        for k, worker in enumerate(self._workers):
+            if worker.job is not None and not worker.process.is_alive():
+                self._done.setdefault(worker.job, "ngspice worker exited during the simulation")
+                self._workers[k] = self._start_worker()
+        self._dispatch()
+
+    def cancel(self, job):
+        # drop a queued job, or stop the worker simulating it. A job that has finished only
+        # loses its result, its worker carries on. The job can't be waited for afterwards.
+        self._pending = collections.deque(task for task in self._pending if task[0] != job)
+        self._collect(0)
+        self._done.pop(job, None)
+        for k, worker in enumerate(self._workers):
+            if worker.job == job:
+                worker.process.terminate()
+                worker.process.join()
+                self._workers[k] = self._start_worker()
+                # it may have sent its result just before it stopped
+                self._cancelled.add(job)
+        self._dispatch()
+
+    def result(self, job, progress=None):
+        # wait for a job and return the voltage of every node (NaN for floating nodes)
+        if progress is None:
+            progress = Progress()
+        try:
+            while job not in self._done:
+                if progress.cancelled:
+                    self.cancel(job)
+                progress.check()
+                self._collect(REPORT_INTERVAL)
+                progress.update()
+
+            error = self._done.pop(job)
+            if error is not None:
+                raise SpiceError(error)
+            memory, n_nodes, n_edges = self._jobs[job]
+            voltages = _arrays(memory.buf, n_nodes, n_edges)[3]
+            node_voltages = voltages.copy()
+            del voltages
+            return node_voltages
+        finally:
+            memory = self._jobs.pop(job)[0]
+            memory.close()
+            memory.unlink()
+
+    def solve(self, n_nodes, src, dst, conductance, pad_nodes, pad_names, pad_currents, source_pad,
+              source_voltage, progress=None):
+        job = self.submit(n_nodes, src, dst, conductance, pad_nodes, pad_names, pad_currents, source_pad,
+                          source_voltage)
+        return self.result(job, progress)
+
+    def close(self):
+        for job in list(self._jobs):
+            self.cancel(job)
+            memory = self._jobs.pop(job)[0]
+            memory.close()
+            memory.unlink()
+        for worker in self._workers:
+            worker.tasks.put(None)
+        for worker in self._workers:
+            worker.process.join()
+        self._workers = []
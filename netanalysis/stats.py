@@ -0,0 +1,130 @@
+# coding: utf-8
+
+# Power Net Analyzer for KiCad - per-stage timing and memory statistics
+#
+# Every stage of an analysis records its wall time, CPU time, the resident memory of the
+# process when it ended and how much the stage added to it (the process's lifetime peak would
+# only show the largest stage so far), and counters such as the node, edge and solver
+# iteration counts. The Progress object handed to the stages opens and closes them, so stages
+# only need to call progress.stage() and progress.record().
+
+import contextlib
+import ctypes
+import json
+import os
+import sys
+import time
+
+# CPU time of the whole process (time.clock on Python 2, where process_time is missing)
+_process_time = getattr(time, 'process_time', None) or time.clock
+
+
+if sys.platform == 'win32':
+    class _MemoryCounters(ctypes.Structure):
+        _fields_ = [('cb', ctypes.c_uint32), ('PageFaultCount', ctypes.c_uint32),
+                    ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                    ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                    ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                    ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+
+def current_rss():
+    # resident memory of this process now (units: bytes), None where it can't be read
+    if sys.platform == 'win32':
+        counters = _MemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        kernel32 = ctypes.windll.kernel32
+        if kernel32.K32GetProcessMemoryInfo(kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+            return counters.WorkingSetSize
+        return None
+    try:
+        # Linux: resident pages are the second field
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+class StageStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.wall = 0.0         # seconds
+        self.cpu = 0.0          # seconds of CPU time of the whole process
+        self.rss = None         # bytes when the stage ended
+        self.rss_change = None  # bytes the stage added (negative if it freed more)
+        self.counters = {}      # e.g. nodes, edges, iterations
+
+    def to_dict(self):
+        values = {'stage': self.name, 'wall': self.wall, 'cpu': self.cpu, 'rss': self.rss,
+                  'rss_change': self.rss_change}
+        values.update(self.counters)
+        return values
+
+
+class AnalysisStats(object):
+    def __init__(self, log=None, context=None):
+        # log: file to write a JSON line to as every stage ends, with the context's items
+        self.log = log
+        self.context = dict(context or {})
+        self.stages = []        # in the order they first ran, repeated stages add up
+        self._by_name = {}
+        self._current = None
+        self._started = None
+
+    def begin(self, name):
+        self.end()
+        if name not in self._by_name:
+            self._by_name[name] = StageStats(name)
+            self.stages.append(self._by_name[name])
+        self._current = self._by_name[name]
+        self._started = (time.time(), _process_time(), current_rss())
+
+    def end(self):
+        if self._current is None:
+            return
+        stage = self._current
+        wall, cpu, rss = self._started
+        stage.wall += time.time() - wall
+        stage.cpu += _process_time() - cpu
+        stage.rss = current_rss()
+        if stage.rss is not None and rss is not None:
+            stage.rss_change = (stage.rss_change or 0) + stage.rss - rss
+        self._current = None
+
+        if self.log is not None:
+            line = dict(self.context)
+            line.update(stage.to_dict())
+            self.log.write(json.dumps(line, sort_keys=True) + "\n")
+            self.log.flush()
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        # for stages outside of the analysis, e.g. "with stats.measure('Plotting'):"
+        self.begin(name)
+        try:
+            yield self
+        finally:
+            self.end()
+
+    def record(self, key, value):
+        # set a counter of the running stage
+        if self._current is not None:
+            self._current.counters[key] = value
+
+    @property
+    def wall(self):
+        return sum(stage.wall for stage in self.stages)
+
+    def to_dict(self):
+        return {'stages': [stage.to_dict() for stage in self.stages], 'wall': self.wall, 'rss': current_rss()}
+
+    def table(self):
+        # (stage, wall, cpu, memory, counters) rows of text for display
+        rows = []
+        for stage in self.stages:
+            rss = "" if stage.rss is None else "{:.0f} MB".format(stage.rss / 1e6)
+            if stage.rss_change is not None:
+                rss += " ({:+.0f} MB)".format(stage.rss_change / 1e6)
+            counters = ", ".join("{} {}".format(key, stage.counters[key]) for key in sorted(stage.counters))
+            rows.append([stage.name, "{:.3f} s".format(stage.wall), "{:.3f} s".format(stage.cpu), rss, counters])
+        return rows
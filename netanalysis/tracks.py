@@ -0,0 +1,180 @@
+# coding: utf-8
+
+# Power Net Analyzer for KiCad - lumped track model
+#
+# A track is a strip of copper of constant width, so between two points where current can
+# enter or leave it, it is a single resistor of length / width squares. With the lumped model
+# only pads and zone fills are rasterized; every track is cut where it touches meshed copper,
+# another track or a via, and the pieces become resistors between those points. A 20 mm long
+# track between two pads is one resistor instead of hundreds of grid nodes.
+#
+# Points where tracks end or meet off the meshed copper become nodes of their own. Points on
+# meshed copper use the node of the grid cell they are in.
+
+import numpy as np
+
+from netanalysis.spatial import TRACK
+from netanalysis.netlist import edge_resistance
+
+# pieces of a track shorter than this join their ends instead (units: nanometers)
+MIN_PIECE_LENGTH = 1.0
+
+
+def _cells(grid, x, y):
+    # indices of the grid points nearest to board points, clipped to the grid
+    i = np.clip(np.rint((np.asarray(x, dtype=np.float64) - grid.xs[0]) / grid.spacing), 0, len(grid.xs) - 1)
+    j = np.clip(np.rint((np.asarray(y, dtype=np.float64) - grid.ys[0]) / grid.spacing), 0, len(grid.ys) - 1)
+    return i.astype(np.int64), j.astype(np.int64)
+
+
+def _segment_t(px, py, x0, y0, x1, y1):
+    # position along the segment of the point nearest to (px, py) as a fraction of its length,
+    # and the distance to that point
+    dx = float(x1 - x0)
+    dy = float(y1 - y0)
+    length_sq = dx * dx + dy * dy
+    t = 0.0 if length_sq == 0 else min(max(((px - x0) * dx + (py - y0) * dy) / length_sq, 0.0), 1.0)
+    return t, np.hypot(px - (x0 + t * dx), py - (y0 + t * dy))
+
+
+class _Points(object):
+    # points on the tracks of a net, joined into groups that are one node each
+    def __init__(self):
+        self.parent = []
+        self.plane = []
+        self.cell = []
+        self.grid_node = []     # node of the meshed copper the point is on, or -1
+
+    def add(self, plane, cell, grid_node):
+        self.parent.append(len(self.parent))
+        self.plane.append(plane)
+        self.cell.append(cell)
+        self.grid_node.append(int(grid_node))
+        return len(self.parent) - 1
+
+    def find(self, point):
+        root = point
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[point] != root:
+            self.parent[point], point = root, self.parent[point]
+        return root
+
+    def join(self, a, b):
+        a = self.find(a)
+        b = self.find(b)
+        if a != b:
+            self.parent[max(a, b)] = min(a, b)
+
+
+def track_network(index, grid, present, node_index, n_nodes, sheet_resistances):
+    # resistors of the net's tracks on the planes of a layer network whose node maps hold no
+    # tracks. Returns the new node count, (src, dst, conductance) edge arrays, the (plane, i, j)
+    # positions of the added nodes and the node of every via on every plane it is on, as
+    # {via: [(plane, node), ...]}.
+    geometry = index.geometry
+    points = _Points()
+    pieces = []         # (point, point, plane, length, width)
+    via_points = {}
+
+    def grid_point(plane, x, y):
+        i, j = _cells(grid, x, y)
+        return points.add(plane, (int(i), int(j)), node_index[plane][i, j])
+
+    for plane, layer in enumerate(present):
+        on_layer = geometry.on_layer(TRACK, layer)
+        tracks = np.flatnonzero(on_layer & (geometry.track_drill == 0))
+        vias = np.flatnonzero(on_layer & (geometry.track_drill > 0))
+
+        for v in vias:
+            via_points.setdefault(v, []).append((plane, grid_point(plane, *geometry.track_start[v])))
+        via_point = dict((v, via_points[v][-1][1]) for v in vias)
+
+        # ends of every track, joined where tracks end on the same spot
+        ends = {}
+        at = {}
+        for t in tracks:
+            for end in (geometry.track_start[t], geometry.track_end[t]):
+                key = (float(end[0]), float(end[1]))
+                if key not in at:
+                    at[key] = grid_point(plane, *end)
+                ends.setdefault(t, []).append(at[key])
+
+        tracks_on_plane = set(tracks.tolist())
+        vias_on_plane = set(vias.tolist())
+        for t in tracks:
+            x0, y0 = geometry.track_start[t]
+            x1, y1 = geometry.track_end[t]
+            width = geometry.track_width[t]
+            length = float(np.hypot(x1 - x0, y1 - y0))
+
+            # where current can get on and off: the track's own ends, the ends of tracks and
+            # the vias touching it, and the meshed copper under it
+            attached = [(0.0, ends[t][0]), (1.0, ends[t][1])]
+            box = geometry.track_box[t]
+            found = index.query_box(box[0], box[1], box[2], box[3], kinds=(TRACK,))[TRACK]
+            for other in found:
+                if other in tracks_on_plane and other != t:
+                    reach = (width + geometry.track_width[other]) / 2.0
+                    for k, end in enumerate((geometry.track_start[other], geometry.track_end[other])):
+                        s, distance = _segment_t(end[0], end[1], x0, y0, x1, y1)
+                        if distance <= reach:
+                            attached.append((s, ends[other][k]))
+                elif other in vias_on_plane:
+                    s, distance = _segment_t(geometry.track_start[other][0], geometry.track_start[other][1],
+                                             x0, y0, x1, y1)
+                    if distance <= (width + geometry.track_width[other]) / 2.0:
+                        attached.append((s, via_point[other]))
+
+            samples = np.linspace(0.0, 1.0, max(2, int(np.ceil(2 * length / grid.spacing)) + 1))
+            i, j = _cells(grid, x0 + samples * (x1 - x0), y0 + samples * (y1 - y0))
+            nodes = node_index[plane][i, j]
+            new_cell = np.ones(len(samples), dtype=bool)
+            new_cell[1:] = (i[1:] != i[:-1]) | (j[1:] != j[:-1])
+            for k in np.flatnonzero(new_cell & (nodes >= 0)):
+                attached.append((float(samples[k]), points.add(plane, (int(i[k]), int(j[k])), nodes[k])))
+
+            attached.sort(key=lambda item: item[0])
+            for (s0, a), (s1, b) in zip(attached[:-1], attached[1:]):
+                piece = (s1 - s0) * length
+                if piece < MIN_PIECE_LENGTH:
+                    points.join(a, b)
+                else:
+                    pieces.append((a, b, plane, piece, width))
+
+    # one node per group of joined points: the grid node it's on, or a new node. A group on
+    # several grid nodes ties them together with a square of copper each.
+    node = np.full(len(points.parent), -1, dtype=np.int64)
+    group_node = {}
+    positions = []
+    src, dst, conductance = [], [], []
+    for point in range(len(points.parent)):
+        root = points.find(point)
+        grid_node = points.grid_node[point]
+        if root not in group_node:
+            if grid_node >= 0:
+                group_node[root] = grid_node
+            else:
+                continue
+        elif grid_node >= 0 and grid_node != group_node[root]:
+            src.append(group_node[root])
+            dst.append(grid_node)
+            conductance.append(1.0 / edge_resistance(sheet_resistances[points.plane[point]], 1, 1))
+
+    for point in range(len(points.parent)):
+        root = points.find(point)
+        if root not in group_node:
+            group_node[root] = n_nodes + len(positions)
+            positions.append((points.plane[root],) + points.cell[root])
+        node[point] = group_node[root]
+
+    for a, b, plane, length, width in pieces:
+        if node[a] != node[b]:
+            src.append(node[a])
+            dst.append(node[b])
+            conductance.append(1.0 / edge_resistance(sheet_resistances[plane], length, width))
+
+    via_nodes = dict((v, [(plane, int(node[point])) for plane, point in planes]) for v, planes in via_points.items())
+    positions = np.array(positions, dtype=np.int64).reshape(len(positions), 3)
+    return (n_nodes + len(positions), np.array(src, dtype=np.int64), np.array(dst, dtype=np.int64),
+            np.array(conductance, dtype=np.float64), positions, via_nodes)
@@ -29,15 +29,42 @@ import pcbnew
 import wx
 import wx.dataview
 import os
+import threading
+import traceback
 
 import matplotlib.pyplot as plt
 import numpy as np
 
-from lyngspice.lyngspice import NgSpice
+from netanalysis.core import AnalysisSettings, analyze_net, analyze_progressive
+from netanalysis.ports import build_port_model
+from netanalysis.snapshot import BoardIndex
+from netanalysis.layers import LayerStack
+from netanalysis.cache import RasterCache
+from netanalysis.solver import spice_number, AnalysisError
+from netanalysis.progress import Progress, AnalysisCancelled
 
 class PowerNetAnalyzerGui(wx.Frame):
     def __init__(self, parent, board):
         self.board = board
+        self.layer_stack = LayerStack.from_board(board)
+
+        # the copper of every net, sorted out once instead of on every net selection
+        self.board_index = BoardIndex(board)
+
+        # node maps of nets analyzed before, so changing only currents skips the rasterization
+        self.raster_cache = RasterCache()
+
+        # TODO: these should be configurable via the UI
+        self.analysis_settings = AnalysisSettings(
+            grid_spacing=100000,           # 100000 nm (0.1 mm, 10 nodes per mm)
+            sheet_resistance=0.0005,       # 5milliohms/sq (copper)
+            layer_sheet_resistance={},     # per layer name overrides, e.g. {"In1.Cu": 0.001}
+            source_voltage=3.3,
+            backend="native",              # or "ngspice" to cross-check against SPICE
+            mesh="uniform",                # or "adaptive" for a quadtree mesh
+            finest_spacing=20000,          # 20000 nm (0.02 mm), smallest adaptive cell
+            coarse_spacing=1280000,        # 1.28 mm, largest adaptive cell
+            tracks="lumped")               # or "raster" to mesh tracks like pours
 
         # initialize frame and create panel
         wx.Frame.__init__(self, parent, title="Power Net Analyzer")
@@ -67,6 +94,7 @@ class PowerNetAnalyzerGui(wx.Frame):
         self.pad_config.AppendTextColumn("Pad Name")
         self.pad_config.AppendTextColumn("Current Draw", mode=wx.dataview.DATAVIEW_CELL_EDITABLE)
         self.pad_config.AppendToggleColumn("Source")
+        self.pad_config.AppendTextColumn("Voltage")
         self.pad_config.Fit()
 
         # set source row
@@ -74,6 +102,43 @@ class PowerNetAnalyzerGui(wx.Frame):
 
         self.start_button = wx.Button(self.panel, label="Start Analysis")
         self.start_button.Disable()
+
+        # solve on a coarse grid first and refine from there, plotting every grid on the way.
+        # Cancelling keeps the finest plot so far.
+        self.progressive_check = wx.CheckBox(self.panel, label="Coarse-to-fine preview")
+        self.progressive_check.SetValue(True)
+
+        # port resistance matrix of the net, once built every edit of the current draw updates
+        # the pad voltages right away
+        self.port_model = None
+        self.port_model_button = wx.Button(self.panel, label="Build Port Model")
+        self.port_model_button.Disable()
+        self.export_button = wx.Button(self.panel, label="Export Port Model")
+        self.export_button.Disable()
+
+        # progress of a running analysis
+        self.cancel_button = wx.Button(self.panel, label="Cancel")
+        self.cancel_button.Disable()
+        self.progress_gauge = wx.Gauge(self.panel, range=100, size=wx.Size(350, -1))
+        self.status_label = wx.StaticText(self.panel, label="")
+        self.elapsed_label = wx.StaticText(self.panel, label="")
+        self.timer = wx.Timer(self)
+
+        # time, memory and counters of every stage of the last analysis
+        stats_label = wx.StaticText(self.panel, label="Analysis statistics")
+        self.stats_view = wx.dataview.DataViewListCtrl(self.panel, size=wx.Size(350, 120))
+        self.stats_view.AppendTextColumn("Stage")
+        self.stats_view.AppendTextColumn("Wall")
+        self.stats_view.AppendTextColumn("CPU")
+        self.stats_view.AppendTextColumn("Memory")
+        self.stats_view.AppendTextColumn("Counters")
+
+        # analysis running on the worker thread
+        self.worker = None
+        self.progress = None
+
+        # figure the voltages are plotted in, previews redraw it
+        self.figure = None
         
         # create a layout box and add the elements
         self.box = wx.BoxSizer(wx.VERTICAL)
@@ -82,11 +147,25 @@ class PowerNetAnalyzerGui(wx.Frame):
         self.box.Add(pad_cfg_label, proportion=0)
         self.box.Add(self.pad_config, proportion=0)
         self.box.Add(self.start_button,  proportion=0)
+        self.box.Add(self.progressive_check, proportion=0)
+        self.box.Add(self.port_model_button, proportion=0)
+        self.box.Add(self.export_button, proportion=0)
+        self.box.Add(self.progress_gauge, proportion=0)
+        self.box.Add(self.status_label, proportion=0)
+        self.box.Add(self.elapsed_label, proportion=0)
+        self.box.Add(self.cancel_button, proportion=0)
+        self.box.Add(stats_label, proportion=0)
+        self.box.Add(self.stats_view, proportion=0)
         
         self.panel.SetSizer(self.box)
 
         # Bind events to functions
         self.Bind(wx.EVT_BUTTON, self.OnStartAnalysis, id=self.start_button.GetId())
+        self.Bind(wx.EVT_BUTTON, self.OnCancelAnalysis, id=self.cancel_button.GetId())
+        self.Bind(wx.EVT_BUTTON, self.OnBuildPortModel, id=self.port_model_button.GetId())
+        self.Bind(wx.EVT_BUTTON, self.OnExportPortModel, id=self.export_button.GetId())
+        self.Bind(wx.EVT_TIMER, self.OnTimer, self.timer)
+        self.Bind(wx.EVT_CLOSE, self.OnClose)
         self.Bind(wx.EVT_COMBOBOX, self.OnSelectNet, id=netcb.GetId())
         self.Bind(wx.dataview.EVT_DATAVIEW_ITEM_VALUE_CHANGED, self.OnSelectSource, id=self.pad_config.GetId())
 
@@ -101,33 +180,30 @@ class PowerNetAnalyzerGui(wx.Frame):
         self.pad_config.DeleteAllItems()
         self.source_row = -1
         self.start_button.Disable()
+        self.set_port_model(None)
+
+        # snapshot the pads, tracks and fills of the chosen net, the analysis thread only ever
+        # sees the snapshot and never calls into pcbnew
+        print("    - Isolating pads, tracks and fills")
+        self.analysis_copper = self.board_index.collect(self.analysis_netname)
+        self.analysis_padnames = self.analysis_copper.pad_names
+
+        # populate the pad config
+        for name in self.analysis_padnames:
+            self.pad_config.AppendItem([name, "0", False, ""])
 
-        # select all pads belonging to the chosen net
-        pads = self.board.GetPads()
-        if len(pads) > 0:
-            self.analysis_padnames = []
-            self.analysis_pads = []
-            for pad in pads:
-                if pad.GetNet().GetNetname() == self.analysis_netname:
-                    # add this pad to the list of pads on the analysis net
-                    self.analysis_pads.append(pad)
-
-                    # get information about the pad and the parent module
-                    pad_num = pad.GetPadName()
-                    parent_ref = pad.GetParent().GetReference()
-
-                    # create a pad name and put it in the padnames list
-                    self.analysis_padnames.append("{}-Pad{}".format(parent_ref, pad_num))
-
-                    # populate the pad config
-                    self.pad_config.AppendItem([self.analysis_padnames[-1], "0", False])
-                
-        
     def OnSelectSource(self, event):
+        # a new current draw is a dense product away with a port model
+        if event.GetColumn() == 1:
+            self.update_port_voltages()
+
         # if event occured in the source selection column
         if event.GetColumn() == 2:
             row = self.pad_config.ItemToRow(event.GetItem())
 
+            # the port model is of the old source
+            self.set_port_model(None)
+
             # if selected row is the same as the currently chosen row, then the user has unchecked the source.
             # Reset source_row and disable starting the simulation.
             if self.source_row == row:
@@ -146,147 +222,255 @@ class PowerNetAnalyzerGui(wx.Frame):
                 self.source_row = row
                 self.start_button.Enable()
 
+            self.port_model_button.Enable(self.source_row != -1 and self.worker is None)
+
     def OnStartAnalysis(self, event):
-        if self.source_row != -1:
+        if self.source_row != -1 and self.worker is None:
             self.run_analysis()
 
+    def OnBuildPortModel(self, event):
+        if self.source_row != -1 and self.worker is None:
+            self.run_port_model()
+
+    def OnExportPortModel(self, event):
+        if self.port_model is None:
+            return
+        dialog = wx.FileDialog(self, "Export port model", defaultFile="{}.cir".format(self.analysis_netname),
+                               wildcard="SPICE subcircuit (*.cir)|*.cir|JSON (*.json)|*.json|CSV (*.csv)|*.csv",
+                               style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT)
+        if dialog.ShowModal() == wx.ID_OK:
+            try:
+                self.port_model.write(dialog.GetPath())
+            except (IOError, OSError) as error:
+                wx.MessageBox(str(error), "Power Net Analyzer", wx.OK | wx.ICON_ERROR)
+        dialog.Destroy()
+
+    def OnCancelAnalysis(self, event):
+        if self.progress is not None:
+            self.progress.cancel()
+            self.status_label.SetLabel("Cancelling...")
+            self.cancel_button.Disable()
+
+    def OnClose(self, event):
+        # stop a running analysis so it doesn't report back to a closed window
+        if self.progress is not None:
+            self.progress.cancel()
+        event.Skip()
+
+    def OnTimer(self, event):
+        if self.progress is not None:
+            self.elapsed_label.SetLabel("Elapsed: {:.1f} s".format(self.progress.elapsed))
+
+    def set_port_model(self, model):
+        self.port_model = model
+        self.export_button.Enable(model is not None)
+        self.update_port_voltages()
+
+    def update_port_voltages(self):
+        # pad voltages of the current draw in the table, from the port model
+        if self.port_model is None:
+            for row in range(self.pad_config.GetItemCount()):
+                self.pad_config.SetTextValue("", row, 3)
+            return
+        try:
+            pad_currents = [spice_number(self.pad_config.GetTextValue(i, 1)) for i in range(len(self.analysis_padnames))]
+            voltages = self.port_model.pad_voltages(pad_currents, self.analysis_settings.source_voltage)
+        except (ValueError, AnalysisError) as error:
+            self.status_label.SetLabel(str(error))
+            return
+        for row, voltage in enumerate(voltages):
+            self.pad_config.SetTextValue("" if np.isnan(voltage) else "{:.4f}".format(voltage), row, 3)
+
+    def check_copper(self):
+        # the board may have been edited since the net was selected, pick up its current copper.
+        # False if there's nothing to analyze. Items moved onto the net don't change the
+        # board's item counts, so the index is rebuilt once per analysis.
+        self.board_index.invalidate()
+        try:
+            self.analysis_copper = self.board_index.collect(self.analysis_netname)
+        except AnalysisError as error:
+            wx.MessageBox(str(error), "Power Net Analyzer", wx.OK | wx.ICON_ERROR)
+            return False
+        if self.analysis_copper.pad_names != self.analysis_padnames:
+            wx.MessageBox("The pads of the net changed, select the net again", "Power Net Analyzer",
+                          wx.OK | wx.ICON_ERROR)
+            return False
+
+        if self.analysis_copper.index.bounds() is None:
+            wx.MessageBox("Net has no copper to analyze", "Power Net Analyzer", wx.OK | wx.ICON_ERROR)
+            return False
+        return True
+
+    def start_worker(self, target, args):
+        # run target(*args, progress) on a worker thread, it reports back through wx.CallAfter
+        self.progress = Progress(lambda stage, fraction, elapsed: wx.CallAfter(self.OnAnalysisProgress, stage, fraction))
+        self.worker = threading.Thread(target=target, args=args + (self.progress,))
+        self.worker.daemon = True
+
+        self.start_button.Disable()
+        self.port_model_button.Disable()
+        self.cancel_button.Enable()
+        self.progress_gauge.SetValue(0)
+        self.timer.Start(200)
+        self.worker.start()
+
+    def worker_finished(self):
+        self.timer.Stop()
+        self.worker = None
+        self.progress = None
+        self.cancel_button.Disable()
+        self.start_button.Enable(self.source_row != -1)
+        self.port_model_button.Enable(self.source_row != -1)
+        self.progress_gauge.SetValue(0)
+
+    def run_port_model(self):
+        print("Building port model of net: {}".format(self.analysis_netname))
+        if not self.check_copper():
+            return
+
+        # the pads with a current draw are the ports, like the loads of an analysis
+        try:
+            pad_currents = [spice_number(self.pad_config.GetTextValue(i, 1)) for i in range(len(self.analysis_padnames))]
+        except ValueError:
+            wx.MessageBox("Current draw must be a number", "Power Net Analyzer", wx.OK | wx.ICON_ERROR)
+            return
+        load_pads = [pad for pad, current in enumerate(pad_currents) if current != 0]
+
+        self.start_worker(self.port_model_worker, (self.analysis_copper, self.analysis_settings, self.source_row,
+                                                   load_pads))
+
+    def port_model_worker(self, copper, settings, source_row, load_pads, progress):
+        # runs on the worker thread, never touch the GUI from here
+        try:
+            model = build_port_model(copper, self.layer_stack, settings, source_row, load_pads, progress,
+                                     self.raster_cache)
+            progress.finish()
+        except AnalysisCancelled:
+            wx.CallAfter(self.OnPortModelFinished, None, "Port model cancelled")
+        except AnalysisError as error:
+            wx.CallAfter(self.OnPortModelFinished, None, str(error))
+        except Exception as error:
+            traceback.print_exc()
+            wx.CallAfter(self.OnPortModelFinished, None, "Port model failed: {}".format(error))
+        else:
+            wx.CallAfter(self.OnPortModelFinished, model, None)
+
+    def OnPortModelFinished(self, model, message):
+        if not self:
+            return
+        self.worker_finished()
+        if model is None:
+            print("    - {}".format(message))
+            self.status_label.SetLabel(message)
+            return
+        self.status_label.SetLabel("Port model of {} load pads, edit their current draw".format(model.n_ports))
+        self.set_port_model(model)
+
     # TODO: move this to its own class
     def run_analysis(self):
         print("Running analysis of net: {}".format(self.analysis_netname))
+        if not self.check_copper():
+            return
+
+        try:
+            pad_currents = [spice_number(self.pad_config.GetTextValue(i, 1)) for i in range(len(self.analysis_padnames))]
+        except ValueError:
+            wx.MessageBox("Current draw must be a number", "Power Net Analyzer", wx.OK | wx.ICON_ERROR)
+            return
+
+        self.start_worker(self.analysis_worker, (self.analysis_copper, self.analysis_settings, pad_currents,
+                                                 self.source_row, self.progressive_check.GetValue()))
+
+    def analysis_worker(self, copper, settings, pad_currents, source_row, progressive, progress):
+        # runs on the worker thread, never touch the GUI from here
+        result = None
+        try:
+            if progressive:
+                for result in analyze_progressive(copper, self.layer_stack, settings, pad_currents, source_row,
+                                                  progress, self.raster_cache):
+                    if result.grid.spacing != settings.grid_spacing:
+                        wx.CallAfter(self.OnAnalysisPreview, result)
+            else:
+                result = analyze_net(copper, self.layer_stack, settings, pad_currents, source_row, progress,
+                                     self.raster_cache)
+        except AnalysisCancelled:
+            if result is None:
+                wx.CallAfter(self.OnAnalysisFinished, None, "Analysis cancelled")
+            else:
+                # the user has seen enough, the last preview is the result
+                wx.CallAfter(self.OnAnalysisFinished, result,
+                             "Stopped at {:g} mm".format(result.grid.spacing / 1e6))
+        except AnalysisError as error:
+            wx.CallAfter(self.OnAnalysisFinished, None, str(error))
+        except Exception as error:
+            traceback.print_exc()
+            wx.CallAfter(self.OnAnalysisFinished, None, "Analysis failed: {}".format(error))
+        else:
+            wx.CallAfter(self.OnAnalysisFinished, result, None)
+
+    def plot_voltages(self, result):
+        # plot every layer in board coordinates (units: millimeters) on a common color scale.
+        # Off-net cells are NaN and left blank, so only the copper sets the scale. Every plot
+        # goes to the same figure, unless the user closed it.
+        if self.figure is None or not plt.fignum_exists(self.figure.number):
+            self.figure = plt.figure()
+        self.figure.clf()
+
+        node_voltages = result.voltages
+        layer_names = result.layer_names
+        grid = result.grid
+        axes = []
+        for k, name in enumerate(layer_names):
+            axes.append(self.figure.add_subplot(1, len(layer_names), k + 1))
+            image = axes[k].matshow(np.transpose(node_voltages[k]), extent=grid.extent(1e-6),
+                                    vmin=np.nanmin(node_voltages), vmax=np.nanmax(node_voltages))
+            axes[k].set_title(name)
+        self.figure.colorbar(image, ax=axes)
+        self.figure.suptitle("{} at {:g} mm".format(result.netname, grid.spacing / 1e6))
+
+    def OnAnalysisPreview(self, result):
+        if not self or self.progress is None:
+            return
+        print("    - Preview at {:g} mm, max drop {:.4f} V".format(result.grid.spacing / 1e6, result.max_drop))
+        # the worker is still adding to the statistics, leave them alone
+        self.plot_voltages(result)
+        self.figure.canvas.draw_idle()
+        plt.show(block=False)
+
+    def OnAnalysisProgress(self, stage, fraction):
+        if not self or self.progress is None:
+            return
+        self.status_label.SetLabel(stage or "")
+        if fraction is None:
+            self.progress_gauge.Pulse()
+        else:
+            self.progress_gauge.SetValue(int(fraction * 100))
+
+    def OnAnalysisFinished(self, result, message):
+        if not self:
+            return
+        self.worker_finished()
+
+        if result is None:
+            print("    - {}".format(message))
+            self.status_label.SetLabel(message)
+            return
+
+        status = message or "Done"
+        if result.warnings:
+            status += ", {} warnings (see the console)".format(len(result.warnings))
+        self.status_label.SetLabel(status)
+
+        with result.stats.measure("Plotting"):
+            self.plot_voltages(result)
+
+        self.stats_view.DeleteAllItems()
+        for row in result.stats.table():
+            self.stats_view.AppendItem(row)
+        print("    - Finished in {:.2f} s".format(result.stats.wall))
+        plt.show()
 
-        # Get board bounding box in (units: nanometers)
-        bounding_box = self.board.GetBoardEdgesBoundingBox()
-        root_x = bounding_box.GetX()
-        root_y = bounding_box.GetY()
-        width = bounding_box.GetWidth()
-        height = bounding_box.GetHeight()
-
-        # TODO: these should be configurable via the UI
-        self.analysis_grid_spacing = 100000 # 100000 nm (0.1 mm, 10 nodes per mm)
-        self.analysis_sheet_resistance = 0.0005 # 5milliohms/sq (copper)
-        self.analysis_source_voltage = 3.3
-
-        print("    - Isolating tracks")
-        analysis_tracks = self.board.TracksInNet(self.analysis_net.GetNet())
-
-        print("    - Isolating fills")
 
-        # get the number of zones
-        num_areas = self.board.GetAreaCount()
-        
-        # zones in analysis net
-        analysis_zones = []
-
-        # loop through the zones
-        for i in range(num_areas):
-            zone = self.board.GetArea(i)
-            if zone.GetNet().GetNetname() == self.analysis_netname:
-                analysis_zones.append(zone)
-
-        print("    - Creating nodes")
-
-        analysis_nodes = []
-        nodes_to_process = 0
-        i=0
-        for x in range(root_x, root_x + width, self.analysis_grid_spacing):
-            line = []
-            j=0
-            for y in range(root_y, root_y + height, self.analysis_grid_spacing):
-                test_point = pcbnew.wxPoint(x,y)
-                node_name = "n{}x{}".format(i,j)
-                node_on_net = False
-
-                # check if node belongs to each pad
-                for index, pad in enumerate(self.analysis_pads):
-                    if pad.HitTest(test_point):
-                        # Set node name to pad name if pad has nonzero current draw or is the source
-                        if self.pad_config.GetTextValue(index, 1) != "0" or self.pad_config.GetToggleValue(index, 2):
-                            node_name = self.pad_config.GetTextValue(index, 0)
-
-                        node_on_net = True
-                        nodes_to_process += 1
-                        break
-
-                # check if node belongs to each track
-                if not node_on_net:
-                    for track in analysis_tracks:
-                        if track.HitTest(test_point):
-                            node_on_net = True
-                            nodes_to_process += 1
-                            break
-
-                # check if node belongs to each fill
-                if not node_on_net:
-                    for zone in analysis_zones:
-                        if zone.HitTestFilledArea(test_point):
-                            node_on_net = True
-                            nodes_to_process += 1
-                            break
-
-                # add the node name to the list if it is in the net
-                if node_on_net:
-                    line.append(node_name)
-                else:
-                    line.append("")
-                    
-                j+=1
-
-            analysis_nodes.append(line)
-            i+=1
-
-        print("    - Need to process {} nodes".format(nodes_to_process))
-
-        print("    - Creating SPICE simulation")
-
-        analysis_netlist = ['analysis'] # first line is name of netlist, in this case 'analysis'
-        n=1
-        for i in range(1, len(analysis_nodes)-1):
-            for j in range(1, len(analysis_nodes[0])-1):
-                if analysis_nodes[i][j] != "":
-                    # connect to node to the right if it is on the net
-                    if analysis_nodes[i+1][j] != "":
-                        analysis_netlist.append("R{} {} {} {}".format(n, analysis_nodes[i][j], analysis_nodes[i+1][j], self.analysis_sheet_resistance))
-                        n+=1
-                    # connect to node to the bottom if it is on the net
-                    if analysis_nodes[i][j+1] != "":
-                        analysis_netlist.append("R{} {} {} {}".format(n, analysis_nodes[i][j], analysis_nodes[i][j+1], self.analysis_sheet_resistance))
-                        n+=1
-                    # connect to node to the left if it is on the net
-                    if analysis_nodes[i-1][j] != "":
-                        analysis_netlist.append("R{} {} {} {}".format(n, analysis_nodes[i][j], analysis_nodes[i-1][j], self.analysis_sheet_resistance))
-                        n+=1
-                    # connect to node to the top if it is on the net
-                    if analysis_nodes[i][j-1] != "":
-                        analysis_netlist.append("R{} {} {} {}".format(n, analysis_nodes[i][j], analysis_nodes[i][j-1], self.analysis_sheet_resistance))
-                        n+=1
-        
-        # add a voltage source to the selected source pad node
-        analysis_netlist.append("V1 {} 0 {}".format(self.pad_config.GetTextValue(self.source_row,0), self.analysis_source_voltage))
-
-        # add current nodes to each load pad node
-        for i,pad in enumerate(self.analysis_padnames):
-            if self.pad_config.GetTextValue(i,1) != "0":
-                analysis_netlist.append("I{} {} 0 {}".format(i, self.pad_config.GetTextValue(i,0), self.pad_config.GetTextValue(i,1)))
-
-        analysis_netlist.append(".op")
-        analysis_netlist.append(".end")
-
-        print("    - Running SPICE simulation")
-        ng = NgSpice()
-        data,_ = ng.run(analysis_netlist)
-
-        node_voltages = []
-        for i in range(len(analysis_nodes)):
-            line = []
-            for j in range(len(analysis_nodes[0])):
-                if analysis_nodes[i][j] != "":
-                    line.append(data["op1"][analysis_nodes[i][j].lower()][0])
-                else:
-                    line.append(self.analysis_source_voltage)
-            node_voltages.append(line)
-
-        plt.matshow(np.transpose(node_voltages))
-        plt.show()
 
 
 class PowerNetAnalyzerPlugin(pcbnew.ActionPlugin):
@@ -0,0 +1,100 @@
+# coding: utf-8
+
+# Power Net Analyzer for KiCad - netlist regression tests
+#
+# A 3x3 plane of copper with the source pad in one corner and a load pad in the opposite one:
+# every pair of neighbouring cells must be exactly one resistor of one square, and the netlist
+# must describe the same circuit the native solver solves.
+
+import numpy as np
+import pytest
+
+from netanalysis.raster import COPPER
+from netanalysis.netlist import netlist_lines, edge_resistance
+from netanalysis.solver import build_node_index, grid_edges, named_pads, solve_network
+
+SHEET_RESISTANCE = 0.0005
+SOURCE_VOLTAGE = 3.3
+PAD_NAMES = ["J1-Pad1", "U1-Pad1"]
+PAD_CURRENTS = [0.0, 2.0]
+SOURCE_PAD = 0
+
+
+def plane_network():
+    # node map of the plane, pad k stored as k + 1, and its resistor network
+    node_map = np.full((3, 3), COPPER, dtype=np.int32)
+    node_map[0, 0] = 1
+    node_map[2, 2] = 2
+    node_index, pad_nodes, n_nodes = build_node_index(node_map, named_pads(PAD_CURRENTS, SOURCE_PAD))
+    src, dst = grid_edges(node_index)
+    conductance = np.full(len(src), 1.0 / edge_resistance(SHEET_RESISTANCE, 1, 1))
+    return n_nodes, src, dst, conductance, pad_nodes
+
+
+def plane_netlist():
+    n_nodes, src, dst, conductance, pad_nodes = plane_network()
+    return list(netlist_lines(src, dst, conductance, pad_nodes, PAD_NAMES, PAD_CURRENTS, SOURCE_PAD,
+                              SOURCE_VOLTAGE))
+
+
+def solve_netlist(lines, n_nodes):
+    # node voltages of a netlist of resistors, one voltage source to ground and current
+    # sources to ground, by nodal analysis with the source node fixed
+    def node(name):
+        return int(name[1:])
+
+    matrix = np.zeros((n_nodes, n_nodes))
+    rhs = np.zeros(n_nodes)
+    source = None
+    for line in lines:
+        fields = line.split()
+        if line.startswith('R'):
+            a, b, g = node(fields[1]), node(fields[2]), 1.0 / float(fields[3])
+            matrix[a, a] += g
+            matrix[b, b] += g
+            matrix[a, b] -= g
+            matrix[b, a] -= g
+        elif line.startswith('V'):
+            source, voltage = node(fields[1]), float(fields[3])
+        elif line.startswith('I'):
+            # SPICE current flows from the first node through the source to the second
+            rhs[node(fields[1])] -= float(fields[3])
+
+    unknown = np.arange(n_nodes) != source
+    voltages = np.full(n_nodes, voltage)
+    voltages[unknown] = np.linalg.solve(matrix[unknown][:, unknown],
+                                        rhs[unknown] - matrix[unknown][:, source] * voltage)
+    return voltages
+
+
+def test_one_resistor_per_edge():
+    resistors = [line.split() for line in plane_netlist() if line.startswith('R')]
+    assert len(resistors) == 12
+    assert len(set(frozenset(fields[1:3]) for fields in resistors)) == 12
+    for fields in resistors:
+        assert float(fields[3]) == pytest.approx(SHEET_RESISTANCE)
+
+
+def test_netlist_matches_native_solver():
+    n_nodes, src, dst, conductance, pad_nodes = plane_network()
+    native = solve_network(n_nodes, src, dst, conductance, pad_nodes, PAD_CURRENTS, SOURCE_PAD, SOURCE_VOLTAGE,
+                           method='direct')
+    netlist = solve_netlist(plane_netlist(), n_nodes)
+    assert np.allclose(netlist, native, rtol=0, atol=1e-9)
+    # the load draws current, so the far corner sags below the source
+    assert native[pad_nodes[1]] < SOURCE_VOLTAGE
+
+
+def test_ngspice_matches_native_solver():
+    try:
+        from lyngspice.lyngspice import NgSpice
+        NgSpice()
+    except Exception:
+        pytest.skip("ngspice is not available")
+
+    n_nodes, src, dst, conductance, pad_nodes = plane_network()
+    native = solve_network(n_nodes, src, dst, conductance, pad_nodes, PAD_CURRENTS, SOURCE_PAD, SOURCE_VOLTAGE,
+                           method='direct')
+    spice = solve_network(n_nodes, src, dst, conductance, pad_nodes, PAD_CURRENTS, SOURCE_PAD, SOURCE_VOLTAGE,
+                          backend='ngspice', pad_names=PAD_NAMES)
+    assert np.allclose(spice, native, rtol=0, atol=1e-6)
@@ -0,0 +1,50 @@
+# coding: utf-8
+
+# Power Net Analyzer for KiCad - adaptive mesh regression tests
+#
+# A straight track between two square pads has the resistance of its length between the pads
+# in squares of its width. The adaptive mesh must get it from the track's copper without
+# losing or adding width, wherever the track sits relative to the cells.
+
+import pytest
+
+import benchmarks  # noqa: F401 - puts the pcbnew stand-in on the path
+import pcbnew
+
+from netanalysis.core import AnalysisSettings, analyze_net
+from netanalysis.layers import LayerStack
+from netanalysis.snapshot import BoardIndex
+
+MM = 1000000
+SHEET_RESISTANCE = 0.0005
+TRACK_START = 1 * MM
+TRACK_END = 20 * MM
+
+
+def track_board(width, offset):
+    # one track on the top layer with a pad of its width at either end
+    board = pcbnew.BOARD(2)
+    net = board.net("VCC")
+    layer = board.GetEnabledLayers().CuStack()[0]
+    y = 5 * MM + offset
+    board.Add(pcbnew.TRACK(net, layer, (TRACK_START, y), (TRACK_END, y), width))
+    for reference, x in (("J1", TRACK_START), ("U1", TRACK_END)):
+        board.Add(pcbnew.D_PAD(net, [layer], pcbnew.MODULE(reference), "1", pcbnew.PAD_SHAPE_RECT, (x, y),
+                               (width, width)))
+    return board
+
+
+@pytest.mark.parametrize("width, offset", [(200000, 0), (200000, 7777), (200000, 33333), (300000, 12345)])
+def test_adaptive_track_resistance(width, offset):
+    board = track_board(width, offset)
+    copper = BoardIndex(board).collect("VCC")
+    stack = LayerStack.from_board(board)
+    source_pad = copper.pad_names.index("J1-Pad1")
+    pad_currents = [1.0 if name == "U1-Pad1" else 0.0 for name in copper.pad_names]
+    settings = AnalysisSettings(sheet_resistance=SHEET_RESISTANCE, mesh='adaptive')
+
+    result = analyze_net(copper, stack, settings, pad_currents, source_pad)
+
+    # 1 A through the track between the pads' inner edges
+    exact = SHEET_RESISTANCE * (TRACK_END - TRACK_START - width) / width
+    assert result.max_drop == pytest.approx(exact, rel=0.01)
@@ -0,0 +1,98 @@
+# coding: utf-8
+
+# Power Net Analyzer for KiCad - rasterizer regression tests
+#
+# The vectorized rasterizer must give the node map the original per-point loop gave: every
+# grid point hit tested against the net's pads (the first pad hit wins), then its tracks, then
+# its zone fills. The board has pads of every shape the rasterizer draws, a rotated one,
+# tracks across a zone cutout, a pad inside the cutout, a via, and copper of another net on
+# top of it all. Coordinates are off the grid so no grid point sits on an edge.
+
+import numpy as np
+import pytest
+
+import benchmarks  # noqa: F401 - puts the pcbnew stand-in on the path
+import pcbnew
+
+from netanalysis.raster import AnalysisGrid, rasterize_net, OFF_NET, COPPER
+from netanalysis.snapshot import BoardIndex
+
+UM = 1000
+MM = 1000000
+GRID_SPACING = 100 * UM
+
+
+def synthetic_board():
+    board = pcbnew.BOARD(2)
+    net = board.net("VCC")
+    other = board.net("GND")
+    top, bottom = board.GetEnabledLayers().CuStack()
+
+    # pour with a slanted edge and a rectangular cutout
+    outline = [(0, 0), (10 * MM, 0), (10 * MM, 6 * MM), (3 * MM, 8 * MM), (0, 6 * MM)]
+    cutout = [(4050 * UM, 2050 * UM), (6550 * UM, 2050 * UM), (6550 * UM, 4450 * UM), (4050 * UM, 4450 * UM)]
+    board.Add(pcbnew.ZONE_CONTAINER(net, top, pcbnew.SHAPE_POLY_SET([(outline, [cutout])])))
+
+    def pad(reference, layers, shape, position, size, **options):
+        board.Add(pcbnew.D_PAD(net, layers, pcbnew.MODULE(reference), "1", shape, position, size, **options))
+
+    pad("J1", [top, bottom], pcbnew.PAD_SHAPE_CIRCLE, (1033 * UM, 1017 * UM), (1200 * UM, 1200 * UM),
+        attribute=pcbnew.PAD_ATTRIB_STANDARD, drill=600 * UM)
+    pad("U1", [top], pcbnew.PAD_SHAPE_RECT, (8011 * UM, 3023 * UM), (1500 * UM, 600 * UM), orientation=300)
+    pad("U2", [top], pcbnew.PAD_SHAPE_OVAL, (5303 * UM, 3207 * UM), (1000 * UM, 500 * UM))
+    pad("U3", [top], pcbnew.PAD_SHAPE_ROUNDRECT, (2507 * UM, 7011 * UM), (1200 * UM, 800 * UM),
+        corner_radius=200 * UM)
+    # overlaps U2, which was added first and wins
+    pad("U4", [top], pcbnew.PAD_SHAPE_CIRCLE, (5803 * UM, 3207 * UM), (700 * UM, 700 * UM))
+
+    # into the cutout and across the board underneath, and a via at the far end
+    board.Add(pcbnew.TRACK(net, top, (1033 * UM, 1017 * UM), (5303 * UM, 3207 * UM), 250 * UM))
+    board.Add(pcbnew.TRACK(net, bottom, (1033 * UM, 1017 * UM), (9013 * UM, 7007 * UM), 300 * UM))
+    board.Add(pcbnew.VIA(net, [top, bottom], (9013 * UM, 7007 * UM), 600 * UM, 300 * UM))
+
+    # another net's copper inside the cutout, which must stay off the net
+    board.Add(pcbnew.TRACK(other, top, (4503 * UM, 4007 * UM), (6003 * UM, 2307 * UM), 400 * UM))
+    board.Add(pcbnew.D_PAD(other, [top], pcbnew.MODULE("R1"), "1", pcbnew.PAD_SHAPE_RECT, (4607 * UM, 2503 * UM),
+                           (500 * UM, 500 * UM)))
+    return board
+
+
+def hit_test_node_map(board, copper, grid, layer=None):
+    # the original loop: every grid point against every item of the net, in pcbnew
+    code = board.FindNet(copper.netname).GetNet()
+
+    def on_net(item):
+        return item.GetNetCode() == code and (layer is None or item.IsOnLayer(layer))
+
+    by_name = dict(("{}-Pad{}".format(pad.GetParent().GetReference(), pad.GetPadName()), pad)
+                   for pad in board.GetPads())
+    pads = [(k, by_name[name]) for k, name in enumerate(copper.pad_names) if on_net(by_name[name])]
+    tracks = [track for track in board.GetTracks() if on_net(track)]
+    zones = [zone for zone in (board.GetArea(i) for i in range(board.GetAreaCount())) if on_net(zone)]
+
+    node_map = np.full(grid.shape, OFF_NET, dtype=np.int32)
+    for i, x in enumerate(grid.xs):
+        for j, y in enumerate(grid.ys):
+            point = pcbnew.wxPoint(int(x), int(y))
+            hit = [k for k, pad in pads if pad.HitTest(point)]
+            if hit:
+                node_map[i, j] = hit[0] + 1
+            elif any(track.HitTest(point) for track in tracks) or \
+                    any(zone.HitTestFilledArea(point) for zone in zones):
+                node_map[i, j] = COPPER
+    return node_map
+
+
+@pytest.mark.parametrize("layer", [None, pcbnew.F_Cu, pcbnew.B_Cu])
+def test_node_map_matches_hit_tests(layer):
+    board = synthetic_board()
+    copper = BoardIndex(board).collect("VCC")
+    grid = AnalysisGrid.around(copper.index.bounds(), GRID_SPACING)
+
+    node_map = rasterize_net(copper.index, grid, layer)
+
+    expected = hit_test_node_map(board, copper, grid, layer)
+    assert (node_map == expected).all(), "{} of {} points differ".format((node_map != expected).sum(), node_map.size)
+    # every kind of copper made it onto the grid
+    assert (node_map == COPPER).any()
+    assert len(np.unique(node_map[node_map > COPPER])) == (5 if layer != pcbnew.B_Cu else 1)